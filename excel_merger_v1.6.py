@@ -4,17 +4,1711 @@ import time
 import psutil
 from datetime import datetime
 import pandas as pd
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
-from tkinterdnd2 import DND_FILES, TkinterDnD
+import numpy as np
+try:
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
+except ImportError:  # 没有图形界面的服务器上只能使用命令行模式
+    tk = filedialog = messagebox = ttk = None
 import os
-import xlwings as xw
+import types
 import chardet
 import threading
+import itertools
+import atexit
 from queue import Queue
+try:
+    import xlwings as xw
+except ImportError:  # 没有安装Excel的服务器上使用openpyxl写入引擎
+    xw = None
+
+# 数据块全局加载序号，用于在多个工作表之间判断哪些数据块最早加载
+_chunk_sequence = itertools.count()
+
+# Excel单个工作表的最大行数
+EXCEL_MAX_ROWS = 1048576
+
+def sorted_contains(sorted_values, values):
+    """向量化判断values中的每个值是否出现在升序数组sorted_values中（二分查找，不对sorted_values重新排序）"""
+    if len(sorted_values) == 0:
+        return np.zeros(len(values), dtype=bool)
+    positions = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    return sorted_values[positions] == values
+
+def spill_frame(df, base_path):
+    """将DataFrame写入磁盘，返回文件路径
+    
+    优先使用zstd压缩的Parquet列式文件；列类型混杂等原因导致Parquet写入失败时，
+    退回到gzip压缩的pickle文件，保证任何数据都可以溢出。
+    """
+    try:
+        # Parquet要求列名为字符串，原始列名由调用方保存，读回时恢复
+        parquet_df = df.copy(deep=False)
+        parquet_df.columns = [str(col) for col in df.columns]
+        spill_path = base_path + ".parquet"
+        parquet_df.to_parquet(spill_path, compression="zstd", index=False)
+    except Exception:
+        if os.path.exists(base_path + ".parquet"):
+            os.remove(base_path + ".parquet")
+        spill_path = base_path + ".pkl.gz"
+        df.to_pickle(spill_path, compression="gzip")
+    return spill_path
+
+def load_spilled_frame(spill_path, columns):
+    """读回spill_frame写入的文件，恢复原始列名"""
+    if spill_path.endswith(".parquet"):
+        df = pd.read_parquet(spill_path)
+        df.columns = columns
+        return df
+    return pd.read_pickle(spill_path, compression="gzip")
+
+class SubDataStore:
+    """副表数据分块累加器
+
+    每次加载只把新读取的DataFrame作为一个不可变数据块追加到列表中，
+    不再对已加载的数据重复执行pd.concat，累计加载耗时与加载行数成线性关系。
+    内存超出预算时，最早加载的数据块可以溢出到本地磁盘的压缩列式文件，
+    合并时通过iter_chunks()逐块流式读回，峰值内存只取决于单个数据块。
+    """
+
+    def __init__(self):
+        # 每个数据块记录来源文件、行数、列名、内存占用和数据本身（溢出后为None）
+        self.chunks = []
+
+    def append(self, df, file_path=None, file_hash=None):
+        """追加一个数据块（调用方不应再修改传入的DataFrame）"""
+        self.chunks.append({
+            "seq": next(_chunk_sequence),
+            "file": file_path,
+            "hash": file_hash,
+            "rows": len(df),
+            "columns": list(df.columns),
+            "bytes": int(df.memory_usage(deep=True).sum()),
+            "df": df,
+            "spill_path": None,
+        })
+
+    def __len__(self):
+        return sum(chunk["rows"] for chunk in self.chunks)
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    def has_file_hash(self, file_hash):
+        """检查具有相同内容哈希的文件是否已经加载"""
+        return any(chunk["hash"] == file_hash for chunk in self.chunks)
+
+    def in_memory_chunks(self):
+        """返回仍驻留在内存中的数据块"""
+        return [chunk for chunk in self.chunks if chunk["df"] is not None]
+
+    def spill_chunk(self, chunk, spill_dir):
+        """将数据块写入磁盘（格式见spill_frame）并释放内存，返回释放的字节数"""
+        df = chunk["df"]
+        if df is None:
+            return 0
+
+        chunk["spill_path"] = spill_frame(df, os.path.join(spill_dir, f"chunk_{chunk['seq']}"))
+        chunk["df"] = None
+        return chunk["bytes"]
+
+    def load_chunk(self, chunk):
+        """返回数据块的数据，已溢出的数据块从磁盘读回（不重新驻留内存）"""
+        if chunk["df"] is not None:
+            return chunk["df"]
+        return load_spilled_frame(chunk["spill_path"], chunk["columns"])
+
+    def iter_chunks(self):
+        """按加载顺序逐块返回(文件路径, 数据)"""
+        for chunk in self.chunks:
+            yield chunk["file"], self.load_chunk(chunk)
+
+    def iter_frames(self):
+        """按加载顺序逐块返回数据"""
+        for _, df in self.iter_chunks():
+            yield df
+
+    def file_row_counts(self):
+        """按加载顺序返回(文件路径, 行数)列表，用于日期列填充等按文件处理的场景"""
+        return [(chunk["file"], chunk["rows"]) for chunk in self.chunks]
+
+    def file_column_counts(self):
+        """按加载顺序返回(文件路径, 列数)列表，无需读回已溢出的数据块"""
+        return [(chunk["file"], len(chunk["columns"])) for chunk in self.chunks]
+
+    def to_frame(self):
+        """一次性物化为单个DataFrame"""
+        frames = list(self.iter_frames())
+        if not frames:
+            return pd.DataFrame()
+        if len(frames) == 1:
+            return frames[0].reset_index(drop=True)
+        return pd.concat(frames, ignore_index=True)
+
+class SortedRun:
+    """多路归并中的一个已按日期排序的数据块
+    
+    默认驻留内存；内存超出预算时按批溢出到磁盘（排序键仍保留在内存中，每行8字节），
+    归并时逐批读回，读完的批立即删除，同一组中重叠的数据块不需要同时驻留内存。
+    """
+
+    def __init__(self, chunk, df, keys):
+        self.chunk = chunk
+        self.columns = list(df.columns)
+        self.df = df
+        self.keys = keys
+        self.parts = []  # 溢出后的批：[(文件路径, 排序键数组), ...]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def spill(self, spill_dir, batch_rows=50000):
+        """按批写入磁盘并释放内存"""
+        if self.df is None:
+            return
+        for number, start in enumerate(range(0, len(self.keys), batch_rows)):
+            base_path = os.path.join(spill_dir, f"run_{self.chunk['seq']}_{number}")
+            self.parts.append((spill_frame(self.df.iloc[start:start + batch_rows], base_path),
+                               self.keys[start:start + batch_rows]))
+        self.df = None
+
+    def iter_batches(self):
+        """按顺序返回(数据, 排序键)批"""
+        if self.df is not None:
+            yield self.df, self.keys
+            return
+        for spill_path, keys in self.parts:
+            df = load_spilled_frame(spill_path, self.columns)
+            os.remove(spill_path)
+            yield df, keys
+
+def quote_identifier(name):
+    """为SQL标识符加双引号，支持中文列名和特殊字符"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+class DuckDBStagingStore(SubDataStore):
+    """基于本地DuckDB暂存库的副表数据存储
+
+    每个副表文件只导入一次，保存为库中的独立表，并在staged_files目录表中登记；
+    程序重启后可以从目录表恢复尚未合并的文件，无需重新解析。
+    筛选、排序和汇总在库内以SQL完成，合并时流式读取查询结果，数据不需要常驻内存。
+    """
+
+    def __init__(self, connection, sheet_name):
+        super().__init__()
+        self.connection = connection
+        self.sheet_name = sheet_name
+
+    @staticmethod
+    def open_connection(db_path):
+        """打开（必要时创建）暂存库，并确保目录表存在"""
+        import duckdb
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        connection = duckdb.connect(db_path)
+        connection.execute("""
+            CREATE TABLE IF NOT EXISTS staged_files (
+                load_order BIGINT,
+                sheet VARCHAR,
+                file VARCHAR,
+                hash VARCHAR,
+                table_name VARCHAR,
+                rows BIGINT,
+                columns VARCHAR,
+                loaded_at TIMESTAMP,
+                merged_at TIMESTAMP
+            )""")
+        return connection
+
+    def restore(self):
+        """从目录表恢复该工作表尚未合并的文件"""
+        import json
+        records = self.connection.execute(
+            "SELECT file, hash, table_name, rows, columns FROM staged_files "
+            "WHERE sheet = ? AND merged_at IS NULL ORDER BY load_order", [self.sheet_name]).fetchall()
+        for file_path, file_hash, table_name, rows, columns in records:
+            self.chunks.append({"seq": next(_chunk_sequence), "file": file_path, "hash": file_hash, "rows": rows,
+                                "columns": json.loads(columns), "bytes": 0, "df": None, "spill_path": None,
+                                "table": table_name})
+
+    def append(self, df, file_path=None, file_hash=None):
+        """将数据导入为库中的独立表并登记到目录表"""
+        import json
+        import uuid
+        table_name = f"file_{file_hash[:16]}" if file_hash else f"file_{uuid.uuid4().hex[:16]}"
+
+        staged = df.copy(deep=False)
+        staged.columns = [str(col) for col in df.columns]
+        try:
+            self.connection.register("incoming_df", staged)
+            self.connection.execute(f"CREATE OR REPLACE TABLE {quote_identifier(table_name)} AS SELECT * FROM incoming_df")
+        except Exception:
+            # 对象列中混有数字和文本时无法推断类型，按文本导入
+            object_columns = staged.select_dtypes(include='object').columns
+            staged[object_columns] = staged[object_columns].astype(str).where(staged[object_columns].notna(), None)
+            self.connection.register("incoming_df", staged)
+            self.connection.execute(f"CREATE OR REPLACE TABLE {quote_identifier(table_name)} AS SELECT * FROM incoming_df")
+        finally:
+            self.connection.unregister("incoming_df")
+
+        # 同一文件重新导入时替换尚未合并的登记；已合并的登记是合并历史，保留
+        self.connection.execute("DELETE FROM staged_files WHERE table_name = ? AND merged_at IS NULL", [table_name])
+        self.connection.execute(
+            "INSERT INTO staged_files SELECT COALESCE(MAX(load_order), 0) + 1, ?, ?, ?, ?, ?, ?, now(), NULL FROM staged_files",
+            [self.sheet_name, file_path, file_hash, table_name, len(df), json.dumps(list(df.columns), ensure_ascii=False, default=str)])
+
+        self.chunks.append({"seq": next(_chunk_sequence), "file": file_path, "hash": file_hash, "rows": len(df),
+                            "columns": list(df.columns), "bytes": 0, "df": None, "spill_path": None,
+                            "table": table_name})
+
+    def in_memory_chunks(self):
+        """暂存库中的数据不占用进程内存"""
+        return []
+
+    def spill_chunk(self, chunk, spill_dir):
+        return 0
+
+    def load_chunk(self, chunk):
+        df = self.connection.execute(f"SELECT * FROM {quote_identifier(chunk['table'])}").df()
+        df.columns = chunk["columns"]
+        return df
+
+    def build_union_sql(self, chunks):
+        """按位置合并多个文件表，附加数据块序号和行号用于排序与来源追踪"""
+        return " UNION ALL ".join(
+            f"SELECT *, {position} AS __chunk, rowid AS __row FROM {quote_identifier(chunk['table'])}"
+            for position, chunk in enumerate(chunks))
+
+    def iter_query_pieces(self, chunks, order_col=None, batch_rows=100000):
+        """在库内完成排序后流式返回(数据块记录, 数据)
+
+        未指定日期列时按传入的文件顺序及文件内行顺序输出；指定日期列时按该列排序，
+        无法解析的日期排在最后，日期相同则保持文件和行的原有顺序。
+        """
+        if not chunks:
+            return
+
+        order_by = "__chunk, __row"
+        if order_col is not None and order_col in chunks[0]["columns"]:
+            column = quote_identifier(order_col)
+            order_by = (f"COALESCE(TRY_CAST({column} AS TIMESTAMP), TRY_STRPTIME(CAST({column} AS VARCHAR), '%Y%m%d')) "
+                        f"NULLS LAST, {order_by}")
+        result = self.connection.execute(f"SELECT * FROM ({self.build_union_sql(chunks)}) ORDER BY {order_by}")
+
+        # 每次读取若干个向量（每个向量2048行），按数据块序号切分为连续的数据段
+        vectors_per_batch = max(1, batch_rows // 2048)
+        while True:
+            batch = result.fetch_df_chunk(vectors_per_batch)
+            if batch is None or batch.empty:
+                break
+            chunk_ids = batch["__chunk"].to_numpy()
+            data = batch.drop(columns=["__chunk", "__row"])
+            breaks = np.flatnonzero(np.diff(chunk_ids) != 0) + 1
+            for start, end in zip(np.r_[0, breaks], np.r_[breaks, len(batch)]):
+                chunk = chunks[int(chunk_ids[start])]
+                yield chunk, data.iloc[start:end].set_axis(chunk["columns"], axis=1)
+
+    def iter_aggregated_pieces(self, sheet_name, chunks, spec, aggregate_columns):
+        """在库内以GROUP BY完成合并前汇总，返回单个汇总数据段
+
+        分组按首次出现的顺序输出，输出列保持副表中的原有顺序。
+        """
+        if not chunks:
+            return
+        source_columns = [str(col) for col in chunks[0]["columns"]]
+        missing = [col for col in aggregate_columns if col not in source_columns]
+        if missing:
+            raise Exception(f"{sheet_name}副表中找不到汇总列：{', '.join(missing)}")
+
+        select_list = []
+        for col in [col for col in source_columns if col in aggregate_columns]:
+            column = quote_identifier(col)
+            if col in spec.get("mean", []):
+                select_list.append(f"AVG(TRY_CAST({column} AS DOUBLE)) AS {column}")
+            elif col in spec.get("count", []):
+                select_list.append(f"COUNT({column}) AS {column}")
+            elif col in spec.get("sum", []):
+                select_list.append(f"SUM(TRY_CAST({column} AS DOUBLE)) AS {column}")
+            else:
+                select_list.append(column)
+        group_by = ", ".join(quote_identifier(col) for col in spec["group_by"])
+        result = self.connection.execute(
+            f"SELECT {', '.join(select_list)} FROM ({self.build_union_sql(chunks)}) "
+            f"GROUP BY {group_by} ORDER BY MIN(__chunk * 4294967296 + __row)").df()
+
+        sources = [(chunk, chunk["rows"]) for chunk in chunks]
+        yield {"seq": next(_chunk_sequence), "file": f"汇总_{datetime.now():%Y%m%d%H%M%S}_{len(sources)}个文件",
+               "hash": None, "sources": sources}, result
+
+    def mark_merged(self, chunks):
+        """保存成功后将文件标记为已合并，重启后不再恢复，数据表保留以供查询历史"""
+        for chunk in chunks:
+            self.connection.execute("UPDATE staged_files SET merged_at = now() WHERE table_name = ? AND merged_at IS NULL",
+                                    [chunk["table"]])
+
+    def discard_pending(self):
+        """删除该工作表尚未合并的暂存文件，已合并的登记仍在使用的数据表（同一文件重新导入）保留"""
+        records = self.connection.execute(
+            "SELECT table_name FROM staged_files WHERE sheet = ? AND merged_at IS NULL AND table_name NOT IN "
+            "(SELECT table_name FROM staged_files WHERE merged_at IS NOT NULL)", [self.sheet_name]).fetchall()
+        for (table_name,) in records:
+            self.connection.execute(f"DROP TABLE IF EXISTS {quote_identifier(table_name)}")
+        self.connection.execute("DELETE FROM staged_files WHERE sheet = ? AND merged_at IS NULL", [self.sheet_name])
+        self.chunks = []
+
+def column_index(letters):
+    """列字母转换为从1开始的列号"""
+    index = 0
+    for letter in letters.upper():
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index
+
+def column_letter(index):
+    """从1开始的列号转换为列字母"""
+    letters = ""
+    while index > 0:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+def parse_cell_address(address):
+    """解析A1、A1:B10、3:10（整行）格式的地址，返回(起始行, 起始列, 结束行, 结束列)，整行地址的列为None"""
+    import re
+    match = re.fullmatch(r'\$?([A-Za-z]*)\$?(\d*)(?::\$?([A-Za-z]*)\$?(\d*))?', address.strip())
+    if not match:
+        raise ValueError(f"无法解析单元格地址：{address}")
+    first_col, first_row, last_col, last_row = match.groups()
+    if last_col is None and last_row is None:
+        last_col, last_row = first_col, first_row
+    to_col = lambda letters: column_index(letters) if letters else None
+    return int(first_row), to_col(first_col), int(last_row), to_col(last_col)
+
+def to_cell_value(value):
+    """将numpy/pandas的值转换为openpyxl可写入的值，缺失值写为空单元格"""
+    if value is None or value is pd.NaT or value is pd.NA:
+        return None
+    if isinstance(value, np.datetime64):
+        value = pd.Timestamp(value)
+    elif isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    return value
+
+def shift_formula_rows(formula, deleted_blocks, own_sheet, deleted_sheet):
+    """按Excel删除整行的规则调整公式中对deleted_sheet的行引用
+    
+    deleted_blocks为同时删除的整行区域[(起始行, 结束行), ...]（删除前的行号，互不重叠），公式只解析一次，
+    各区域从下往上依次应用：删除区域上方的引用不变，下方的引用上移，完全位于删除区域内的引用变为#REF!，
+    跨越删除区域的区域引用收缩。own_sheet为公式所在的工作表，其中不带工作表名的引用指向该工作表；
+    外部工作簿的引用和名称保持不变。
+    """
+    import re
+    from openpyxl.formula.tokenizer import Tokenizer, Token
+    blocks = sorted(deleted_blocks, reverse=True)
+    part_pattern = re.compile(r'^(\$?[A-Za-z]{1,3})?(\$?)(\d+)?$')
+    changed = False
+    tokenizer = Tokenizer(formula)
+    for token in tokenizer.items:
+        if token.type != Token.OPERAND or token.subtype != Token.RANGE:
+            continue
+        prefix, _, ref = token.value.rpartition('!')
+        if '[' in prefix:
+            continue
+        sheet = prefix.strip("'").replace("''", "'") if prefix else own_sheet
+        if sheet != deleted_sheet:
+            continue
+        parts = [part_pattern.match(part) for part in ref.split(':')]
+        if not all(parts) or len(parts) > 2 or any(match.group(3) is None for match in parts):
+            continue  # 名称、整列引用等不含行号的引用不受删除行影响
+        rows = [int(match.group(3)) for match in parts]
+        if len(rows) == 1:
+            rows.append(rows[0])
+        new_rows = rows
+        # 从下往上应用，下方区域的删除不改变上方区域的行号
+        for first_row, last_row in blocks:
+            count = last_row - first_row + 1
+            if new_rows[1] < first_row:
+                continue
+            if new_rows[0] >= first_row and new_rows[1] <= last_row:
+                new_rows = None
+                break
+            new_rows = [new_rows[0] if new_rows[0] < first_row else max(new_rows[0] - count, first_row),
+                        new_rows[1] - count if new_rows[1] > last_row else first_row - 1]
+        if new_rows is None:
+            token.value = "#REF!"
+            changed = True
+        elif new_rows != rows:
+            new_parts = [f"{match.group(1) or ''}{match.group(2)}{row}" for match, row in zip(parts, new_rows)]
+            token.value = (prefix + '!' if prefix else '') + ':'.join(new_parts)
+            changed = True
+    if not changed:
+        return formula
+    return "=" + "".join(token.value for token in tokenizer.items)
+
+class OpenpyxlRange:
+    """openpyxl工作表中的单元格区域，提供合并流程用到的xlwings区域接口"""
+
+    def __init__(self, sheet, row, col, last_row=None, last_col=None, options=None):
+        self.sheet = sheet
+        self.row = row
+        self.col = col
+        self.last_row = last_row or row
+        self.last_col = last_col or col
+        self._options = options or {}
+
+    def _get(self, row, col):
+        # 超出已使用范围时不访问单元格，避免openpyxl创建空单元格扩大工作表范围
+        ws = self.sheet.ws
+        if row > ws.max_row or col > ws.max_column:
+            return None
+        return ws.cell(row=row, column=col).value
+
+    def options(self, convert=None, **options):
+        merged = dict(self._options, **options)
+        if convert is not None:
+            merged["convert"] = convert
+        return OpenpyxlRange(self.sheet, self.row, self.col, self.last_row, self.last_col, merged)
+
+    @property
+    def rows(self):
+        return types.SimpleNamespace(count=self.last_row - self.row + 1)
+
+    @property
+    def columns(self):
+        return types.SimpleNamespace(count=self.last_col - self.col + 1)
+
+    @property
+    def last_cell(self):
+        return OpenpyxlRange(self.sheet, self.last_row, self.last_col)
+
+    def offset(self, row_offset=0, column_offset=0):
+        return OpenpyxlRange(self.sheet, self.row + row_offset, self.col + column_offset,
+                             self.last_row + row_offset, self.last_col + column_offset, self._options)
+
+    def resize(self, row_size=None, column_size=None):
+        last_row = self.row + row_size - 1 if row_size else self.last_row
+        last_col = self.col + column_size - 1 if column_size else self.last_col
+        return OpenpyxlRange(self.sheet, self.row, self.col, last_row, last_col, self._options)
+
+    def end(self, direction):
+        """从当前单元格向上移动到最近的非空单元格（与xlwings的end('up')一致），从工作表的最大行开始查找"""
+        if direction != 'up':
+            raise NotImplementedError("openpyxl写入引擎只支持end('up')")
+        row = min(self.row, self.sheet.ws.max_row)
+        while row > 1 and self._get(row, self.col) is None:
+            row -= 1
+        return OpenpyxlRange(self.sheet, row, self.col)
+
+    def expand(self, mode='table'):
+        """从左上角单元格向右/向下扩展到第一个空单元格之前，与xlwings的expand一致"""
+        last_row, last_col = self.row, self.col
+        if mode in ('table', 'right'):
+            while self._get(self.row, last_col + 1) is not None:
+                last_col += 1
+        if mode in ('table', 'down'):
+            while self._get(last_row + 1, self.col) is not None:
+                last_row += 1
+        return OpenpyxlRange(self.sheet, self.row, self.col, last_row, last_col, self._options)
+
+    @property
+    def value(self):
+        source = self
+        if self._options.get("expand"):
+            source = self.resize(1, 1).expand(self._options["expand"])
+        ws = self.sheet.ws
+        last_row = min(source.last_row, ws.max_row)
+        last_col = min(source.last_col, ws.max_column)
+        width = source.last_col - source.col + 1
+        rows = []
+        if source.row <= last_row and source.col <= last_col:
+            for values in ws.iter_rows(min_row=source.row, max_row=last_row, min_col=source.col,
+                                       max_col=last_col, values_only=True):
+                rows.append(list(values) + [None] * (width - len(values)))
+        # 超出已使用范围的部分按空单元格补齐
+        rows += [[None] * width for _ in range(source.last_row - source.row + 1 - len(rows))]
+
+        if self._options.get("convert") is pd.DataFrame:
+            if self._options.get("header", True):
+                return pd.DataFrame(rows[1:], columns=rows[0])
+            return pd.DataFrame(rows)
+        if self._options.get("ndim") == 2:
+            return rows
+        # 与xlwings一致：单个单元格返回标量，单行或单列返回一维列表
+        if len(rows) == 1 and width == 1:
+            return rows[0][0]
+        if len(rows) == 1:
+            return rows[0]
+        if width == 1:
+            return [values[0] for values in rows]
+        return rows
+
+    @value.setter
+    def value(self, data):
+        if isinstance(data, pd.DataFrame):
+            data = data.values
+        if isinstance(data, np.ndarray):
+            rows = data.tolist() if data.ndim == 2 else [data.tolist()]
+        elif isinstance(data, (list, tuple)):
+            # 一维列表按行写入，与xlwings一致
+            rows = [list(values) for values in data] if data and isinstance(data[0], (list, tuple)) else [list(data)]
+        else:
+            rows = [[data] * (self.last_col - self.col + 1) for _ in range(self.last_row - self.row + 1)]
+        ws = self.sheet.ws
+        for i, values in enumerate(rows):
+            for j, value in enumerate(values):
+                # ws.cell(value=None)不会清空已有的值，需要显式赋值
+                ws.cell(row=self.row + i, column=self.col + j).value = to_cell_value(value)
+
+    @property
+    def formula(self):
+        value = self._get(self.row, self.col)
+        if value is None:
+            return ""
+        # 数组公式等对象的公式文本保存在text属性中
+        return str(getattr(value, "text", value))
+
+    @formula.setter
+    def formula(self, formulas):
+        # openpyxl以"="开头的字符串保存为公式
+        self.value = formulas
+
+    def clear_contents(self):
+        ws = self.sheet.ws
+        for row in range(self.row, min(self.last_row, ws.max_row) + 1):
+            for col in range(self.col, min(self.last_col, ws.max_column) + 1):
+                ws.cell(row=row, column=col).value = None
+
+    def clear(self):
+        self.clear_contents()
+
+    def delete(self, shift='up'):
+        """删除整行区域，下方的行上移，公式引用按Excel的规则修正"""
+        if shift != 'up':
+            raise NotImplementedError("openpyxl写入引擎仅支持删除整行")
+        self.sheet.delete_row_blocks([(self.row, self.last_row)])
+
+class OpenpyxlSheet:
+    """openpyxl工作表，提供合并流程用到的xlwings工作表接口"""
+
+    def __init__(self, ws):
+        self.ws = ws
+
+    @property
+    def name(self):
+        return self.ws.title
+
+    @property
+    def used_range(self):
+        return OpenpyxlRange(self, self.ws.min_row, self.ws.min_column, self.ws.max_row, self.ws.max_column)
+
+    def range(self, address):
+        first_row, first_col, last_row, last_col = parse_cell_address(address)
+        if first_col is None:
+            # 整行地址覆盖已使用的全部列
+            first_col, last_col = 1, max(self.ws.max_column, 1)
+        return OpenpyxlRange(self, first_row, first_col, last_row, last_col)
+
+    def delete_row_blocks(self, blocks):
+        """一次删除多个整行区域（删除前的行号），并一次性修正工作簿中指向该工作表的公式
+        
+        openpyxl删除行时不会调整公式引用：各区域从下往上删除后，每个公式只解析一次，同时应用全部区域；
+        其他工作表中只解析文本里出现该工作表名称的公式。
+        """
+        ws = self.ws
+        blocks = sorted(blocks, reverse=True)
+        for first_row, last_row in blocks:
+            ws.delete_rows(first_row, last_row - first_row + 1)
+        names = {ws.title, ws.title.replace("'", "''")}
+        for other_ws in ws.parent.worksheets:
+            for cells in other_ws.iter_rows():
+                for cell in cells:
+                    value = cell.value
+                    if not (isinstance(value, str) and value.startswith('=')):
+                        continue
+                    if other_ws is not ws and not any(name in value for name in names):
+                        continue
+                    cell.value = shift_formula_rows(value, blocks, other_ws.title, ws.title)
+
+class OpenpyxlBook:
+    """直接读写xlsx/xlsm文件的工作簿，保留公式、格式和外部链接，不需要安装Excel
+    
+    图表、图片等openpyxl不支持的对象在保存时会丢失，含有这类对象的主表请使用xlwings写入引擎。
+    """
+
+    def __init__(self, app, path):
+        import openpyxl
+        self.app = app
+        self.fullname = os.path.abspath(path)
+        self.wb = openpyxl.load_workbook(path, keep_vba=path.lower().endswith('.xlsm'))
+        self._sheets = {}
+
+    @property
+    def sheets(self):
+        return OpenpyxlSheets(self)
+
+    @property
+    def sheetnames(self):
+        return self.wb.sheetnames
+
+    def sheet(self, name):
+        if name not in self._sheets:
+            self._sheets[name] = OpenpyxlSheet(self.wb[name])
+        return self._sheets[name]
+
+    def save(self, path=None):
+        self.wb.save(path or self.fullname)
+
+    def close(self):
+        self.wb.close()
+        if self in self.app.books:
+            self.app.books.remove(self)
+
+class OpenpyxlSheets:
+    """工作簿中的工作表集合，支持按名称或序号取工作表（openpyxl和zip追加写入引擎共用）"""
+
+    def __init__(self, book):
+        self.book = book
+
+    def __getitem__(self, key):
+        name = self.book.sheetnames[key] if isinstance(key, int) else key
+        return self.book.sheet(name)
+
+    def __iter__(self):
+        return (self.book.sheet(name) for name in self.book.sheetnames)
+
+    def __len__(self):
+        return len(self.book.sheetnames)
+
+class OpenpyxlBooks(list):
+    """已打开的工作簿列表"""
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    def open(self, path):
+        book = OpenpyxlBook(self.app, path)
+        self.append(book)
+        return book
+
+class OpenpyxlApp:
+    """openpyxl写入引擎，接口与xlwings.App一致（仅实现合并流程用到的部分）
+    
+    不启动Excel，直接读写文件，可以在没有Excel的Linux服务器上运行合并，也省去了每次写入的自动化往返。
+    """
+
+    def __init__(self, visible=False):
+        self.books = OpenpyxlBooks(self)
+
+    def quit(self):
+        for book in list(self.books):
+            book.close()
+
+SPREADSHEET_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+RELATIONSHIP_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+PACKAGE_RELATIONSHIP_NS = "http://schemas.openxmlformats.org/package/2006/relationships"
+
+# zip条目的大小或偏移达到此值时需要使用ZIP64扩展
+ZIP64_LIMIT = 0xFFFFFFFF
+
+class ZipEntryStream:
+    """ZipPackageWriter中正在流式写入的条目：边写边压缩并计算CRC，关闭时回填本地文件头"""
+
+    def __init__(self, writer, info, compress_type):
+        import zlib
+        self.writer = writer
+        self.name, self.flags = writer.encode_name(info.filename)
+        self.info = info
+        self.compress_type = compress_type
+        self.offset = writer.file.tell()
+        self.crc = 0
+        self.file_size = 0
+        self.compress_size = 0
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if compress_type == 8 else None
+        # 写入前不知道大小，本地文件头总是带ZIP64扩展，关闭时回填
+        writer.write_local_header(self.name, self.flags, compress_type, info.date_time, 0, 0, 0, zip64=True)
+
+    def write(self, data):
+        import zlib
+        self.crc = zlib.crc32(data, self.crc)
+        self.file_size += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.writer.file.write(data)
+        self.compress_size += len(data)
+
+    def close(self):
+        import struct
+        if self.compressor is not None:
+            tail = self.compressor.flush()
+            self.writer.file.write(tail)
+            self.compress_size += len(tail)
+        file = self.writer.file
+        end = file.tell()
+        file.seek(self.offset + 14)
+        file.write(struct.pack('<L', self.crc))
+        file.seek(self.offset + 30 + len(self.name) + 4)
+        file.write(struct.pack('<QQ', self.file_size, self.compress_size))
+        file.seek(end)
+        self.writer.entries.append((self.name, self.flags, self.compress_type, self.info, self.crc,
+                                    self.compress_size, self.file_size, self.offset, True))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+class ZipPackageWriter:
+    """按顺序写出zip包，只使用ZipInfo的公开字段
+    
+    未改动的部件原样复制压缩数据（不解压、不重新压缩），耗时只与部件的压缩大小有关；
+    重写的部件流式压缩写入。中央目录在关闭时写出，大小、偏移或条目数超出限制时使用ZIP64扩展。
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.entries = []  # [(文件名, 标志位, 压缩方式, 原条目信息, CRC, 压缩大小, 原始大小, 本地文件头偏移, 是否ZIP64), ...]
+
+    @staticmethod
+    def encode_name(filename):
+        """返回(文件名字节, 标志位)，非ASCII文件名按UTF-8编码并设置标志位11"""
+        try:
+            return filename.encode('ascii'), 0
+        except UnicodeEncodeError:
+            return filename.encode('utf-8'), 0x800
+
+    @staticmethod
+    def dos_date_time(date_time):
+        year, month, day, hour, minute, second = date_time
+        return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+    def write_local_header(self, name, flags, compress_type, date_time, crc, compress_size, file_size, zip64):
+        import struct
+        dos_time, dos_date = self.dos_date_time(date_time)
+        extra = b""
+        if zip64:
+            extra = struct.pack('<HHQQ', 1, 16, file_size, compress_size)
+            compress_size = file_size = ZIP64_LIMIT
+        self.file.write(struct.pack('<4s5H3L2H', b'PK\x03\x04', 45 if zip64 else 20, flags, compress_type, dos_time, dos_date,
+                                    crc, compress_size, file_size, len(name), len(extra)))
+        self.file.write(name)
+        self.file.write(extra)
+
+    def copy_entry(self, source_file, info):
+        """从source_file（zip包的二进制文件对象）原样复制info对应条目的压缩数据，压缩方式保持不变
+        
+        CRC和大小取自中央目录，写入新的本地文件头，原条目的数据描述符不再需要。
+        """
+        import struct
+        source_file.seek(info.header_offset)
+        header = source_file.read(30)
+        if len(header) < 30 or header[:4] != b'PK\x03\x04':
+            raise Exception(f"{info.filename}的本地文件头已损坏")
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        source_file.seek(info.header_offset + 30 + name_length + extra_length)
+
+        name, name_flag = self.encode_name(info.filename)
+        flags = (info.flag_bits & ~0x808) | name_flag
+        zip64 = max(info.file_size, info.compress_size) >= ZIP64_LIMIT
+        offset = self.file.tell()
+        self.write_local_header(name, flags, info.compress_type, info.date_time, info.CRC, info.compress_size, info.file_size, zip64)
+        remaining = info.compress_size
+        while remaining:
+            block = source_file.read(min(remaining, 4 * 1024 * 1024))
+            if not block:
+                raise Exception(f"{info.filename}的压缩数据不完整")
+            self.file.write(block)
+            remaining -= len(block)
+        self.entries.append((name, flags, info.compress_type, info, info.CRC, info.compress_size, info.file_size, offset, zip64))
+
+    def open(self, info, compress_type=8):
+        """流式写入一个新条目，文件名、时间和属性沿用info，默认使用deflate压缩"""
+        return ZipEntryStream(self, info, compress_type)
+
+    def writestr(self, info, data, compress_type=8):
+        with self.open(info, compress_type) as output:
+            output.write(data)
+
+    def close(self):
+        import struct
+        directory_offset = self.file.tell()
+        for name, flags, compress_type, info, crc, compress_size, file_size, offset, zip64 in self.entries:
+            dos_time, dos_date = self.dos_date_time(info.date_time)
+            # ZIP64扩展中按原始大小、压缩大小、偏移的顺序只写入超出限制的字段
+            large = [value for value in (file_size, compress_size, offset) if value >= ZIP64_LIMIT]
+            extra = struct.pack(f'<HH{len(large)}Q', 1, 8 * len(large), *large) if large else b""
+            version = 45 if zip64 or large else 20
+            self.file.write(struct.pack('<4s6H3L5H2L', b'PK\x01\x02', (info.create_system << 8) | version, version, flags,
+                                        compress_type, dos_time, dos_date, crc, min(compress_size, ZIP64_LIMIT),
+                                        min(file_size, ZIP64_LIMIT), len(name), len(extra), 0, 0, 0, info.external_attr,
+                                        min(offset, ZIP64_LIMIT)))
+            self.file.write(name)
+            self.file.write(extra)
+        directory_size = self.file.tell() - directory_offset
+        count = len(self.entries)
+        if count >= 0xFFFF or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+            record_offset = self.file.tell()
+            self.file.write(struct.pack('<4sQ2H2L4Q', b'PK\x06\x06', 44, 45, 45, 0, 0, count, count, directory_size, directory_offset))
+            self.file.write(struct.pack('<4sLQL', b'PK\x06\x07', 0, record_offset, 1))
+        self.file.write(struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                    min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+def zip_stream_insert(source_zip, output, info, marker_pattern, insert_chunks, head_patch=None):
+    """流式重写一个XML部件并写入output：在第一个匹配marker_pattern的位置之前插入insert_chunks生成的内容
+
+    marker_pattern需匹配结束标签（如</sheetData>）或自闭合标签（如<sheetData/>，此时改写为成对标签）；
+    head_patch可以改写部件开头的一段（如dimension）。
+    """
+    import re
+    with source_zip.open(info) as source:
+        pending = b""
+        inserted = False
+        first = True
+        while True:
+            block = source.read(4 * 1024 * 1024)
+            data = pending + block
+            pending = b""
+            if first and head_patch:
+                data = head_patch(data)
+            first = False
+            if inserted:
+                output.write(data)
+            else:
+                match = marker_pattern.search(data)
+                if match:
+                    output.write(data[:match.start()])
+                    tag = match.group(0)
+                    if tag.endswith(b"/>"):
+                        # 自闭合标签改写为成对标签
+                        name = re.match(rb'<([\w:]+)', tag).group(1)
+                        output.write(b"<" + name + b">")
+                        for chunk in insert_chunks:
+                            output.write(chunk)
+                        output.write(b"</" + name + b">")
+                    else:
+                        for chunk in insert_chunks:
+                            output.write(chunk)
+                        output.write(tag)
+                    output.write(data[match.end():])
+                    inserted = True
+                elif block:
+                    # 保留末尾一段，避免标签跨越数据块边界
+                    output.write(data[:-64])
+                    pending = data[-64:]
+                else:
+                    raise Exception(f"{info.filename}中找不到插入位置")
+            if not block:
+                break
+
+def patch_dimension(data, last_ref):
+    """将工作表XML开头dimension的结束单元格改为last_ref"""
+    import re
+    return re.sub(rb'(<(?:\w+:)?dimension\b[^>]*?\bref=")([A-Z]+\d+)(?::[A-Z]+\d+)?(")',
+                  lambda m: m.group(1) + m.group(2) + b":" + last_ref.encode() + m.group(3), data, count=1)
+
+def build_sheet_part(source_path, sheet, last_ref, output_path):
+    """重写单个工作表部件并写入只含该部件的临时zip文件，返回新公式单元格的位置
+    
+    在工作进程中执行时，sheet为去掉工作簿引用后传入的副本；部件在工作进程中压缩，组装最终文件时原样复制。
+    """
+    import re
+    import zipfile
+    from functools import partial
+    formula_cells = []
+    with zipfile.ZipFile(source_path) as source, ZipPackageWriter(output_path) as target:
+        info = source.getinfo(sheet.part_name)
+        with target.open(info) as output:
+            zip_stream_insert(source, output, info, re.compile(rb'</(?:\w+:)?sheetData>|<(?:\w+:)?sheetData\s*/>'),
+                              sheet.iter_rows_xml(formula_cells), partial(patch_dimension, last_ref=last_ref))
+    return formula_cells
+
+class ZipAppendRange:
+    """zip追加写入引擎中的单元格区域：写入新行时只记录到缓冲区，保存时统一生成XML"""
+
+    def __init__(self, sheet, row, col, last_row=None, last_col=None, options=None):
+        self.sheet = sheet
+        self.row = row
+        self.col = col
+        self.last_row = last_row or row
+        self.last_col = last_col or col
+        self._options = options or {}
+
+    def options(self, convert=None, **options):
+        merged = dict(self._options, **options)
+        if convert is not None:
+            merged["convert"] = convert
+        return ZipAppendRange(self.sheet, self.row, self.col, self.last_row, self.last_col, merged)
+
+    @property
+    def rows(self):
+        return types.SimpleNamespace(count=self.last_row - self.row + 1)
+
+    @property
+    def columns(self):
+        return types.SimpleNamespace(count=self.last_col - self.col + 1)
+
+    @property
+    def last_cell(self):
+        return ZipAppendRange(self.sheet, self.last_row, self.last_col)
+
+    def offset(self, row_offset=0, column_offset=0):
+        return ZipAppendRange(self.sheet, self.row + row_offset, self.col + column_offset,
+                              self.last_row + row_offset, self.last_col + column_offset, self._options)
+
+    def resize(self, row_size=None, column_size=None):
+        last_row = self.row + row_size - 1 if row_size else self.last_row
+        last_col = self.col + column_size - 1 if column_size else self.last_col
+        return ZipAppendRange(self.sheet, self.row, self.col, last_row, last_col, self._options)
+
+    def expand(self, mode='table'):
+        """只支持从表头行向右扩展（已有数据行不解析）"""
+        if mode != 'right' and not (mode == 'table' and self.row == 1):
+            raise NotImplementedError("zip追加写入引擎不能读取已有数据行")
+        last_col = self.col
+        while self.sheet.header.get(last_col + 1) is not None:
+            last_col += 1
+        return ZipAppendRange(self.sheet, self.row, self.col, self.row, last_col, self._options)
+
+    @property
+    def value(self):
+        source = self
+        if self._options.get("expand"):
+            source = self.resize(1, 1).expand(self._options["expand"])
+        rows = self.sheet.read_cells(source.row, source.col, source.last_row, source.last_col)
+        if self._options.get("convert") is pd.DataFrame:
+            # 已有数据行不解析，只返回表头（用于检查列数）
+            return pd.DataFrame(columns=rows[0])
+        if self._options.get("ndim") == 2:
+            return rows
+        if len(rows) == 1 and len(rows[0]) == 1:
+            return rows[0][0]
+        if len(rows) == 1:
+            return rows[0]
+        if len(rows[0]) == 1:
+            return [values[0] for values in rows]
+        return rows
+
+    @value.setter
+    def value(self, data):
+        if isinstance(data, pd.DataFrame):
+            data = data.values
+        if isinstance(data, np.ndarray):
+            rows = data.tolist() if data.ndim == 2 else [data.tolist()]
+        elif isinstance(data, (list, tuple)):
+            rows = [list(values) for values in data] if data and isinstance(data[0], (list, tuple)) else [list(data)]
+        else:
+            rows = [[data] * (self.last_col - self.col + 1) for _ in range(self.last_row - self.row + 1)]
+        self.sheet.write_block(self.row, self.col, rows)
+
+    @property
+    def formula(self):
+        if self.row == 2:
+            return self.sheet.template_formulas.get(self.col, "")
+        return ""
+
+    @formula.setter
+    def formula(self, formulas):
+        # 已有行中的公式保持不变，只为新追加的行写入公式
+        rows = [list(values) if isinstance(values, (list, tuple)) else [values] for values in formulas]
+        skip = max(0, self.sheet.original_last_row - self.row + 1)
+        if skip < len(rows):
+            self.sheet.write_block(self.row + skip, self.col, rows[skip:])
+
+    def clear_contents(self):
+        raise NotImplementedError("zip追加写入引擎只支持追加，不能清除已有单元格")
+
+    def clear(self):
+        self.clear_contents()
+
+    def delete(self, shift='up'):
+        raise NotImplementedError("zip追加写入引擎只支持追加，撤销合并或创建分片请使用其他写入引擎")
+
+class ZipAppendSheet:
+    """zip追加写入引擎中的工作表
+    
+    打开时流式扫描一次工作表XML，只取得最后一行行号、表头、第2行的公式模板和单元格样式；
+    新行按写入块缓存，保存时按行号顺序生成XML插入到</sheetData>之前。
+    """
+
+    def __init__(self, book, name, sheet_id, part_name):
+        self.book = book
+        self.name = name
+        self.sheet_id = sheet_id
+        self.part_name = part_name
+        self.header = {}
+        self.template_formulas = {}
+        self.template_styles = {}
+        self.original_last_row = 0
+        self.original_last_col = 1
+        self.blocks = []
+        self.column_last_rows = {}
+        self.scan()
+
+    def scan(self):
+        import re
+        import xml.etree.ElementTree as ET
+        # 第1、2行：增量解析，读到第3行即停止
+        shared_indexes = {}
+        with self.book.zip.open(self.part_name) as stream:
+            for _, element in ET.iterparse(stream, events=("end",)):
+                tag = element.tag.rsplit('}', 1)[-1]
+                if tag != "row":
+                    continue
+                row_number = int(element.get("r"))
+                if row_number > 2:
+                    break
+                for cell in element:
+                    if cell.tag.rsplit('}', 1)[-1] != "c":
+                        continue
+                    col = column_index(re.match(r'[A-Z]+', cell.get("r")).group())
+                    formula = cell.find(f"{{{SPREADSHEET_NS}}}f")
+                    value = cell.find(f"{{{SPREADSHEET_NS}}}v")
+                    if row_number == 2:
+                        if cell.get("s"):
+                            self.template_styles[col] = cell.get("s")
+                        if formula is not None and formula.text:
+                            self.template_formulas[col] = "=" + formula.text
+                    elif cell.get("t") == "s" and value is not None:
+                        shared_indexes[col] = int(value.text)
+                    elif cell.get("t") == "inlineStr":
+                        self.header[col] = "".join(t.text or "" for t in cell.iter(f"{{{SPREADSHEET_NS}}}t"))
+                    elif value is not None:
+                        self.header[col] = value.text
+                element.clear()
+        if shared_indexes:
+            strings = self.book.read_shared_strings(set(shared_indexes.values()))
+            for col, index in shared_indexes.items():
+                self.header[col] = strings.get(index)
+
+        # 最后一行行号：逐块扫描解压后的XML，不构建元素
+        row_pattern = re.compile(rb'<(?:\w+:)?row\b[^>]*?\br="(\d+)"')
+        dimension_pattern = re.compile(rb'<(?:\w+:)?dimension\b[^>]*?\bref="[A-Z]+\d+:([A-Z]+)\d+"')
+        tail = b""
+        with self.book.zip.open(self.part_name) as stream:
+            while True:
+                block = stream.read(4 * 1024 * 1024)
+                if not block:
+                    break
+                data = tail + block
+                if self.original_last_col == 1:
+                    dimension = dimension_pattern.search(data)
+                    if dimension:
+                        self.original_last_col = column_index(dimension.group(1).decode())
+                matches = row_pattern.findall(data)
+                if matches:
+                    self.original_last_row = max(self.original_last_row, int(matches[-1]))
+                tail = data[-256:]
+        self.original_last_col = max(self.original_last_col, max(self.header, default=1))
+
+    def last_value_row(self, col):
+        """流式扫描工作表XML，返回已有数据中col列最后一个非空单元格的行号（没有时为0），结果按列缓存
+        
+        只有样式、没有值和公式的单元格视为空。按</row>切分数据块，单元格不会跨越块边界。
+        """
+        import re
+        if col not in self.column_last_rows:
+            letters = column_letter(col).encode()
+            cell_pattern = re.compile(rb'<(?:\w+:)?c\b[^>]*?\br="' + letters + rb'(\d+)"[^>]*?(?:/>|>(.*?)</(?:\w+:)?c>)', re.S)
+            content_pattern = re.compile(rb'<(?:\w+:)?(?:v|f|is)\b')
+            last_row = 0
+            pending = b""
+            with self.book.zip.open(self.part_name) as stream:
+                while True:
+                    block = stream.read(4 * 1024 * 1024)
+                    data = pending + block
+                    cut = data.rfind(b"</row>") + len(b"</row>") if block else len(data)
+                    if cut < len(b"</row>"):
+                        cut = 0
+                    for match in cell_pattern.finditer(data, 0, cut):
+                        if match.group(2) and content_pattern.search(match.group(2)):
+                            last_row = max(last_row, int(match.group(1)))
+                    pending = data[cut:]
+                    if not block:
+                        break
+            self.column_last_rows[col] = last_row
+        return self.column_last_rows[col]
+
+    def __getstate__(self):
+        # 传给工作进程时不带工作簿（zip文件句柄）
+        state = self.__dict__.copy()
+        state["book"] = None
+        return state
+
+    @property
+    def last_row(self):
+        return max([self.original_last_row] + [row + len(values) - 1 for row, _, values, _ in self.blocks])
+
+    @property
+    def next_append_row(self):
+        return self.last_row + 1
+
+    @property
+    def used_range(self):
+        last_col = max([self.original_last_col] + [col + len(values[0]) - 1 for _, col, values, _ in self.blocks if values])
+        return ZipAppendRange(self, 1, 1, self.last_row, last_col)
+
+    def range(self, address):
+        first_row, first_col, last_row, last_col = parse_cell_address(address)
+        if first_col is None:
+            first_col, last_col = 1, self.original_last_col
+        return ZipAppendRange(self, first_row, first_col, last_row, last_col)
+
+    def write_block(self, row, col, values):
+        if not values:
+            return
+        if row <= self.original_last_row:
+            raise NotImplementedError(f"zip追加写入引擎只支持追加新行，不能改写{self.name}工作表第{row}行")
+        self.blocks.append((row, col, values, len(self.blocks)))
+
+    def read_cells(self, first_row, first_col, last_row, last_col):
+        """读取表头行或新写入的行，已有数据行不解析"""
+        if first_row <= self.original_last_row and not (first_row == last_row == 1):
+            raise NotImplementedError("zip追加写入引擎不能读取已有数据行")
+        rows = [[None] * (last_col - first_col + 1) for _ in range(last_row - first_row + 1)]
+        if first_row == 1:
+            rows[0] = [self.header.get(col) for col in range(first_col, last_col + 1)]
+            return rows
+        for row, col, values, _ in self.blocks:
+            for i in range(max(row, first_row), min(row + len(values) - 1, last_row) + 1):
+                block_row = values[i - row]
+                for j in range(max(col, first_col), min(col + len(block_row) - 1, last_col) + 1):
+                    rows[i - first_row][j - first_col] = block_row[j - col]
+        return rows
+
+    def iter_new_rows(self):
+        """按行号顺序返回(行号, {列号: 值})，同一单元格多次写入时以最后一次为准"""
+        import heapq
+        blocks = sorted(self.blocks, key=lambda block: (block[0], block[3]))
+        active = []
+        position = 0
+        row = blocks[0][0] if blocks else 0
+        while position < len(blocks) or active:
+            if not active and blocks[position][0] > row:
+                row = blocks[position][0]
+            while position < len(blocks) and blocks[position][0] == row:
+                block = blocks[position]
+                heapq.heappush(active, (block[0] + len(block[2]) - 1, block[3], block))
+                position += 1
+            cells = {}
+            for _, _, (block_row, col, values, _) in sorted(active, key=lambda item: item[1]):
+                for j, value in enumerate(values[row - block_row]):
+                    cells[col + j] = value
+            yield row, cells
+            while active and active[0][0] <= row:
+                heapq.heappop(active)
+            row += 1
+
+    def build_cell_xml(self, row, col, value):
+        """生成单个单元格的XML，文本使用内联字符串，样式沿用第2行同列单元格"""
+        import re
+        from xml.sax.saxutils import escape
+        value = to_cell_value(value)
+        if value is None:
+            return ""
+        ref = f"{column_letter(col)}{row}"
+        style = f' s="{self.template_styles[col]}"' if col in self.template_styles else ""
+        if isinstance(value, bool):
+            return f'<c r="{ref}"{style} t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, (int, float)):
+            if isinstance(value, float) and value in (float('inf'), float('-inf')):
+                return ""
+            return f'<c r="{ref}"{style}><v>{value!r}</v></c>'
+        if isinstance(value, datetime):
+            serial = (value - datetime(1899, 12, 30)).total_seconds() / 86400
+            return f'<c r="{ref}"{style}><v>{serial!r}</v></c>'
+        if hasattr(value, "toordinal"):
+            return f'<c r="{ref}"{style}><v>{value.toordinal() - 693594}</v></c>'
+        text = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', str(value))
+        if text.startswith("="):
+            return f'<c r="{ref}"{style}><f>{escape(text[1:])}</f></c>'
+        return f'<c r="{ref}"{style} t="inlineStr"><is><t xml:space="preserve">{escape(text)}</t></is></c>'
+
+    def iter_rows_xml(self, formula_cells):
+        """生成新行的XML，并把新公式单元格的位置记录到formula_cells中（用于更新calcChain）"""
+        for row, cells in self.iter_new_rows():
+            parts = []
+            for col in sorted(cells):
+                xml = self.build_cell_xml(row, col, cells[col])
+                if xml:
+                    parts.append(xml)
+                    if "<f>" in xml:
+                        formula_cells.append(f"{column_letter(col)}{row}")
+            if parts:
+                yield f'<row r="{row}">{"".join(parts)}</row>'.encode('utf-8')
+
+class ZipAppendBook:
+    """把主表作为zip包打开的追加写入工作簿
+    
+    保存时未改动的部件流式复制，只流式重写有新行的工作表XML（在</sheetData>之前插入新行并更新dimension），
+    向calcChain追加新公式单元格，并设置打开时完整重算。新文本使用内联字符串，sharedStrings部件保持不变（Excel下次保存时会转换为共享字符串）。
+    追加耗时只与新行数和目标工作表大小有关，与其他工作表无关。
+    """
+
+    def __init__(self, app, path):
+        import zipfile
+        import xml.etree.ElementTree as ET
+        import posixpath
+        self.app = app
+        self.fullname = os.path.abspath(path)
+        self.zip = zipfile.ZipFile(path)
+        self._sheets = {}
+        self.rewritten_parts = None
+
+        workbook = ET.fromstring(self.zip.read("xl/workbook.xml"))
+        relationships = ET.fromstring(self.zip.read("xl/_rels/workbook.xml.rels"))
+        targets = {}
+        self.shared_strings_part = None
+        self.calc_chain_part = None
+        for relationship in relationships.iter(f"{{{PACKAGE_RELATIONSHIP_NS}}}Relationship"):
+            target = relationship.get("Target")
+            target = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+            targets[relationship.get("Id")] = target
+            if relationship.get("Type").endswith("/sharedStrings"):
+                self.shared_strings_part = target
+            elif relationship.get("Type").endswith("/calcChain"):
+                self.calc_chain_part = target
+        self.sheet_parts = []
+        for sheet in workbook.iter(f"{{{SPREADSHEET_NS}}}sheet"):
+            self.sheet_parts.append((sheet.get("name"), sheet.get("sheetId"), targets[sheet.get(f"{{{RELATIONSHIP_NS}}}id")]))
+
+    @property
+    def sheets(self):
+        return OpenpyxlSheets(self)
+
+    @property
+    def sheetnames(self):
+        return [name for name, _, _ in self.sheet_parts]
+
+    def sheet(self, name):
+        if name not in self._sheets:
+            item = next((item for item in self.sheet_parts if item[0] == name), None)
+            if item is None:
+                raise KeyError(name)
+            _, sheet_id, part_name = item
+            self._sheets[name] = ZipAppendSheet(self, name, sheet_id, part_name)
+        return self._sheets[name]
+
+    def read_shared_strings(self, indexes):
+        """流式读取共享字符串表中指定序号的字符串，取到最大序号后即停止"""
+        import xml.etree.ElementTree as ET
+        strings = {}
+        if not self.shared_strings_part or not indexes:
+            return strings
+        last_index = max(indexes)
+        index = 0
+        with self.zip.open(self.shared_strings_part) as stream:
+            for _, element in ET.iterparse(stream, events=("end",)):
+                if element.tag.rsplit('}', 1)[-1] != "si":
+                    continue
+                if index in indexes:
+                    strings[index] = "".join(t.text or "" for t in element.iter(f"{{{SPREADSHEET_NS}}}t"))
+                element.clear()
+                if index >= last_index:
+                    break
+                index += 1
+        return strings
+
+    def save(self, path=None):
+        """保存工作簿：有新行的工作表各自在独立的工作进程中生成XML，完成后按原样组装到新的zip文件中"""
+        import re
+        import shutil
+        import tempfile
+        import zipfile
+        import concurrent.futures
+        target_path = os.path.abspath(path or self.fullname)
+        temp_path = target_path + ".tmp"
+        changed = {sheet.part_name: sheet for sheet in self._sheets.values() if sheet.blocks}
+        part_dir = tempfile.mkdtemp(prefix=".parts_", dir=os.path.dirname(target_path))
+        part_paths = {part_name: os.path.join(part_dir, f"part_{i}.zip") for i, part_name in enumerate(changed)}
+        last_refs = {part_name: f"{column_letter(sheet.used_range.last_col)}{sheet.last_row}" for part_name, sheet in changed.items()}
+        formula_cells = {}
+
+        try:
+            # 多个工作表时并行生成
+            futures = {}
+            pool = None
+            if len(changed) > 1:
+                pool = concurrent.futures.ProcessPoolExecutor(max_workers=min(len(changed), os.cpu_count() or 1))
+                futures = {part_name: pool.submit(build_sheet_part, self.fullname, changed[part_name],
+                                                  last_refs[part_name], part_paths[part_name])
+                           for part_name in changed}
+            try:
+                for part_name, sheet in changed.items():
+                    if part_name not in futures:
+                        formula_cells[sheet.sheet_id] = build_sheet_part(self.fullname, sheet, last_refs[part_name], part_paths[part_name])
+                for part_name, future in futures.items():
+                    formula_cells[changed[part_name].sheet_id] = future.result()
+            finally:
+                if pool is not None:
+                    pool.shutdown()
+
+            # 未改动的部件和工作进程已压缩好的工作表部件都原样复制压缩数据，只有workbook.xml和calcChain在此重新压缩
+            with open(self.fullname, 'rb') as source_file, ZipPackageWriter(temp_path) as target:
+                for info in self.zip.infolist():
+                    if info.filename in changed:
+                        with zipfile.ZipFile(part_paths[info.filename]) as part_zip, open(part_paths[info.filename], 'rb') as part_file:
+                            target.copy_entry(part_file, part_zip.getinfo(info.filename))
+                    elif info.filename == "xl/workbook.xml":
+                        target.writestr(info, self.patch_calc_properties(self.zip.read(info)))
+                    elif info.filename == self.calc_chain_part:
+                        entries = (f'<c r="{ref}" i="{sheet_id}"/>'.encode() for sheet_id, refs in formula_cells.items() for ref in refs)
+                        with target.open(info) as output:
+                            zip_stream_insert(self.zip, output, info, re.compile(rb'</(?:\w+:)?calcChain>'), entries)
+                    else:
+                        target.copy_entry(source_file, info)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            shutil.rmtree(part_dir, ignore_errors=True)
+
+        self.zip.close()
+        os.replace(temp_path, target_path)
+        # 本次重新生成的部件，暂存校验时只需解压这些部件
+        self.rewritten_parts = sorted(set(changed) | {"xl/workbook.xml"} | ({self.calc_chain_part} if self.calc_chain_part else set()))
+        # 保存后重新打开，后续可以继续追加
+        self.zip = zipfile.ZipFile(target_path)
+        self.fullname = target_path
+        for sheet in self._sheets.values():
+            sheet.original_last_row = sheet.last_row
+            sheet.blocks = []
+            sheet.column_last_rows = {}
+
+    def patch_calc_properties(self, workbook_xml):
+        """设置打开时完整重算，新写入的公式没有缓存值"""
+        import re
+        match = re.search(rb'<(?:\w+:)?calcPr\b[^>]*?/?>', workbook_xml)
+        if match:
+            tag = match.group(0)
+            if b'fullCalcOnLoad=' in tag:
+                new_tag = re.sub(rb'fullCalcOnLoad="[^"]*"', b'fullCalcOnLoad="1"', tag)
+            else:
+                new_tag = re.sub(rb'\s*(/?>)$', rb' fullCalcOnLoad="1"\1', tag)
+            return workbook_xml[:match.start()] + new_tag + workbook_xml[match.end():]
+        # calcPr位于definedNames之后、oleSize等元素之前
+        following = re.search(rb'<(?:\w+:)?(?:oleSize|customWorkbookViews|pivotCaches|smartTagPr|smartTagTypes|webPublishing|fileRecoveryPr|webPublishObjects|extLst)\b|</(?:\w+:)?workbook>', workbook_xml)
+        return workbook_xml[:following.start()] + b'<calcPr fullCalcOnLoad="1"/>' + workbook_xml[following.start():]
+
+    def close(self):
+        self.zip.close()
+        if self in self.app.books:
+            self.app.books.remove(self)
+
+class ZipAppendBooks(list):
+    """zip追加写入引擎中已打开的工作簿列表"""
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+
+    def open(self, path):
+        book = ZipAppendBook(self.app, path)
+        self.append(book)
+        return book
+
+class ZipAppendApp:
+    """zip追加写入引擎，接口与xlwings.App一致（只支持追加新行和填充新行的公式）"""
+
+    def __init__(self, visible=False):
+        self.books = ZipAppendBooks(self)
+
+    def quit(self):
+        for book in list(self.books):
+            book.close()
+
+def clone_file(source, target):
+    """以写时复制（reflink）方式克隆文件，文件系统不支持时流式复制，返回所用的方式："reflink"或"copy"
+    
+    Linux（Btrfs、XFS等）使用FICLONE ioctl，macOS（APFS）使用clonefile；克隆只复制元数据，耗时与文件大小无关，
+    之后两个文件各自修改互不影响。
+    """
+    import shutil
+    if sys.platform.startswith('linux'):
+        import fcntl
+        FICLONE = 0x40049409
+        try:
+            with open(source, 'rb') as src, open(target, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            shutil.copystat(source, target)
+            return "reflink"
+        except OSError:
+            pass  # 不支持克隆（如ext4、跨文件系统），下面的复制会覆盖已创建的空文件
+    elif sys.platform == 'darwin':
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            if os.path.exists(target):
+                os.remove(target)  # clonefile要求目标文件不存在
+            if libc.clonefile(os.fsencode(source), os.fsencode(target), 0) == 0:
+                return "reflink"
+        except (OSError, AttributeError):
+            pass
+    shutil.copyfile(source, target)
+    shutil.copystat(source, target)
+    return "copy"
+
+class WorkbookActor:
+    """工作簿操作的唯一执行者：其他线程只生成数据并提交命令，所有工作表调用在执行run的线程中依次执行
+    
+    自动化接口（COM/Apple事件）本身会把调用串行化，多个线程同时操作同一工作表只会增加争用和超时，
+    COM对象也不能跨线程使用，因此由打开工作簿的线程执行run。每次从队列中取出已提交的全部命令，
+    行范围相同且列相邻的公式写入合并为一次二维写入（每次写入不超过max_cells个单元格）。
+    
+    命令：("formula", 列号, 起始行, 结束行, 公式列表)、("call", 函数)；每个生产者提交完毕后提交None。
+    队列最多缓存max_pending个命令，生产者快于写入时等待，已生成未写入的公式不会无限累积。
+    """
+
+    def __init__(self, sheet, max_cells=12000, max_pending=64):
+        self.sheet = sheet
+        self.max_cells = max_cells
+        self.commands = Queue(maxsize=max_pending)
+        self.failed_columns = set()
+        self.stopped = False
+        self.calls = 0       # 实际的工作表写入次数
+        self.submitted = 0   # 提交的公式写入命令数
+
+    def submit(self, command):
+        """提交一个命令，可在任意线程中调用；队列已满时等待，执行者已停止时丢弃命令，生产者不会一直阻塞"""
+        from queue import Full
+        while not self.stopped:
+            try:
+                self.commands.put(command, timeout=0.5)
+                return
+            except Full:
+                continue
+
+    def run(self, producer_count, on_error):
+        """执行命令直到所有生产者提交完毕；写入出错的列调用on_error(列号列表, 异常)，该列之后的命令跳过"""
+        from queue import Empty
+        finished = 0
+        try:
+            while finished < producer_count:
+                batch = [self.commands.get()]
+                while True:
+                    try:
+                        batch.append(self.commands.get_nowait())
+                    except Empty:
+                        break
+                finished += sum(1 for command in batch if command is None)
+                formula_commands = []
+                for command in batch:
+                    if command is None:
+                        continue
+                    if command[0] == "call":
+                        command[1]()
+                    elif command[1] not in self.failed_columns:
+                        formula_commands.append(command)
+                self.submitted += len(formula_commands)
+                for cols, start, end, block in self.coalesce(formula_commands):
+                    if any(col in self.failed_columns for col in cols):
+                        # 同一批中其他行范围的写入已失败的列不再写入，其余列逐列写入
+                        self.write_columns(cols, start, end, block, on_error)
+                        continue
+                    try:
+                        self.sheet.range(f"{column_letter(cols[0])}{start}:{column_letter(cols[-1])}{end}").formula = block
+                        self.calls += 1
+                    except Exception as e:
+                        if len(cols) == 1:
+                            self.failed_columns.update(cols)
+                            on_error(cols, e)
+                        else:
+                            # 合并后的二维写入失败时逐列重试，只有单独写入也失败的列才标记为失败
+                            self.write_columns(cols, start, end, block, on_error)
+        finally:
+            self.stopped = True
+
+    def write_columns(self, cols, start, end, block, on_error):
+        """逐列写入二维公式块中尚未失败的列，写入失败的列调用on_error"""
+        for position, col in enumerate(cols):
+            if col in self.failed_columns:
+                continue
+            try:
+                self.sheet.range(f"{column_letter(col)}{start}:{column_letter(col)}{end}").formula = [[row[position]] for row in block]
+                self.calls += 1
+            except Exception as e:
+                self.failed_columns.add(col)
+                on_error([col], e)
+
+    def coalesce(self, commands):
+        """把行范围相同且列相邻的公式写入合并，返回(列号列表, 起始行, 结束行, 二维公式列表)"""
+        groups = []
+        for _, col, start, end, formulas in sorted(commands, key=lambda command: (command[2], command[3], command[1])):
+            last = groups[-1] if groups else None
+            if (last and last["start"] == start and last["end"] == end and last["cols"][-1] + 1 == col
+                    and (len(last["cols"]) + 1) * (end - start + 1) <= self.max_cells):
+                last["cols"].append(col)
+                last["columns"].append(formulas)
+            else:
+                groups.append({"cols": [col], "start": start, "end": end, "columns": [formulas]})
+        for group in groups:
+            yield group["cols"], group["start"], group["end"], [list(row) for row in zip(*group["columns"])]
+
+class ExcelAppPool:
+    """预热的隐藏Excel实例池，加载和合并时租借实例，避免每次启动Excel的开销
+    
+    实例在后台线程中预先启动，池中只保存进程号，租借时在调用线程中按进程号连接（COM对象不能跨线程使用）。
+    实例归还时关闭其中所有工作簿后放回池中；使用次数达到max_uses或使用中出错的实例退出，并在后台启动新实例补充。
+    """
+
+    def __init__(self, size=1, max_uses=20):
+        self.size = size
+        self.max_uses = max_uses
+        self.idle = []      # 空闲实例的进程号
+        self.uses = {}      # 进程号 -> 已租借次数（包含空闲和租借中的实例）
+        self.leased = {}    # 租借中的应用对象id -> 进程号，重复归还时忽略
+        self.pending = 0    # 后台正在启动的实例数
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def launch(self):
+        """启动一个隐藏的Excel实例（不新建空白工作簿），返回应用对象"""
+        app = xw.App(visible=False, add_book=False)
+        app.display_alerts = False
+        return app
+
+    def warm_up(self):
+        """在后台线程中启动实例，使实例总数达到size"""
+        with self.condition:
+            missing = self.size - len(self.uses) - self.pending
+            if self.closed or missing <= 0:
+                return
+            self.pending += missing
+
+        def run():
+            if sys.platform == 'win32':
+                import pythoncom
+                pythoncom.CoInitialize()
+            for _ in range(missing):
+                pid = None
+                try:
+                    pid = self.launch().pid
+                except Exception:
+                    pass  # 预热失败时，租借时再在调用线程中启动
+                with self.condition:
+                    self.pending -= 1
+                    if pid is not None:
+                        self.uses[pid] = 0
+                        self.idle.append(pid)
+                    self.condition.notify_all()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def acquire(self):
+        """租借一个实例：优先使用空闲实例，后台正在启动时等待其完成，否则在当前线程中启动"""
+        with self.condition:
+            while not self.idle and self.pending > 0:
+                self.condition.wait(timeout=60)
+            pid = self.idle.pop() if self.idle else None
+        app = None
+        if pid is not None:
+            try:
+                app = xw.apps[pid]
+            except Exception:
+                # 空闲实例已退出（例如被用户关闭），丢弃后重新启动
+                with self.condition:
+                    self.uses.pop(pid, None)
+        if app is None:
+            app = self.launch()
+            pid = app.pid
+        with self.condition:
+            self.uses[pid] = self.uses.get(pid, 0) + 1
+            self.leased[id(app)] = pid
+        return app
+
+    def release(self, app, failed=False):
+        """归还实例：关闭其中的工作簿后放回池中，出错、使用次数达到上限或池已关闭时退出该实例"""
+        with self.condition:
+            pid = self.leased.pop(id(app), None)
+        if pid is None:
+            return
+        try:
+            for book in list(app.books):
+                book.close()
+        except Exception:
+            failed = True
+        with self.condition:
+            recycle = (failed or self.closed or self.uses.get(pid, 0) >= self.max_uses
+                       or len(self.idle) >= self.size)
+            if not recycle:
+                self.idle.append(pid)
+                self.condition.notify_all()
+                return
+            self.uses.pop(pid, None)
+        self.quit_app(app)
+        self.warm_up()
+
+    def quit_app(self, app):
+        try:
+            app.quit()
+        except Exception:
+            try:
+                app.kill()
+            except Exception:
+                pass
+
+    def shutdown(self):
+        """退出所有空闲实例，程序退出时调用"""
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for pid in idle:
+            try:
+                self.quit_app(xw.apps[pid])
+            except Exception:
+                pass
+
+class OptionValue:
+    """命令行模式下代替tkinter变量的选项值，提供合并流程用到的get/set接口"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+class ConsoleDialogs:
+    """命令行模式下代替messagebox的对话框：消息输出到控制台，确认对话框一律回答否，并统计出现的错误数"""
 
-class ExcelMerger:
     def __init__(self):
+        self.error_count = 0
+
+    def showerror(self, title, message, **kwargs):
+        self.error_count += 1
+        print(f"[{title}] {message}", file=sys.stderr)
+
+    def showwarning(self, title, message, **kwargs):
+        print(f"[{title}] {message}", file=sys.stderr)
+
+    def showinfo(self, title, message, **kwargs):
+        print(f"[{title}] {message}")
+
+    def askyesno(self, title, message, **kwargs):
+        print(f"[{title}] {message}（命令行模式下按否处理）")
+        return False
+
+class ExcelMerger:
+    def __init__(self, headless=False):
+        """创建合并工具，headless为True时不创建界面，由调用方加载文件并调用merge_files（见main()）"""
         self.main_file = None
         self.sub_files = {}
         self.main_data = {}
@@ -29,6 +1723,89 @@ class ExcelMerger:
             "店铺成交数据源": {"start_col": "H", "formula_end_col": "F", "date_col": "G"}
         }
         
+        # 按键更新（upsert）配置，存储工作表名称与键列（副表列名）的映射关系
+        # 配置键列后，键已存在于主表的行在原位置覆盖，新键的行追加到末尾；为None时保持追加模式
+        # 例如："店铺成交数据源": ["订单编号"]
+        self.upsert_keys = {
+            "全站营销": None,
+            "站内数据源": None,
+            "站外数据源": None,
+            "店铺成交数据源": None
+        }
+        
+        # 合并前汇总配置，存储工作表名称与分组列、汇总列（副表列名）的映射关系
+        # 配置后副表数据先按分组列向量化汇总再写入主表，输出列保持副表中的原有顺序；为None时写入原始行
+        # 例如："站内数据源": {"group_by": ["日期", "计划名称"], "sum": ["花费", "成交金额"], "count": ["订单号"], "mean": ["点击率"]}
+        # 日期列来自文件名的工作表（店铺成交数据源）不支持汇总
+        self.aggregate_config = {
+            "全站营销": None,
+            "站内数据源": None,
+            "站外数据源": None,
+            "店铺成交数据源": None
+        }
+        
+        # 按日期顺序合并时使用的日期列（副表列名），存储工作表名称与日期列的映射关系
+        # 文件先按文件名中的_YYYYMMDD_日期排序；配置日期列后，日期范围重叠的文件再按该列逐行多路归并
+        # 例如："站内数据源": "日期"；店铺成交数据源的日期来自文件名，按文件排序即可
+        self.order_columns = {
+            "全站营销": None,
+            "站内数据源": None,
+            "站外数据源": None,
+            "店铺成交数据源": None
+        }
+        
+        # 派生列计算配置，存储工作表名称与计算步骤列表的映射关系
+        # 勾选"派生列写入计算值"后，按步骤在pandas中向量化计算A列到公式结束列的值并直接写入，这些列不再填充公式；为None时保持公式
+        # 步骤按顺序执行，列名均为副表列名：
+        #   {"op": "rename", "columns": {"旧列名": "新列名"}}                       重命名，仅影响后续步骤的引用
+        #   {"op": "cast", "columns": {"花费": "float", "日期": "date"}}             类型转换（float/int/str/date），写入的数据也随之转换
+        #   {"op": "derive", "target": "A", "expr": "`成交金额` / `花费`"}          算术表达式（DataFrame.eval，中文列名用反引号）
+        #   {"op": "concat", "target": "B", "columns": ["店铺", "计划名称"], "sep": "-"}  字符串拼接
+        #   {"op": "date", "target": "C", "column": "日期", "format": "%Y-%m"}      日期格式化
+        #   {"op": "lookup", "target": "D", "column": "计划ID", "sheet": "计划映射", "key": "计划ID", "value": "负责人"}
+        #                                                                          从主表的映射工作表查找（也可用"mapping": {...}直接给出映射）
+        # 目标列之后可以像普通列一样在后续步骤中引用，例如"`A` * 100"
+        self.transform_config = {
+            "全站营销": None,
+            "站内数据源": None,
+            "站外数据源": None,
+            "店铺成交数据源": None
+        }
+        self.lookup_cache = {}  # 查找表缓存，每次合并开始时清空
+
+        # 列式数据集导出目录，勾选"导出列式数据集"后每次合并把新写入的行按月分区追加为Parquet文件
+        # 为None时使用主表旁的"主表文件名_columnar"目录，也可通过环境变量EXCEL_MERGER_COLUMNAR_DIR设置
+        # 目录结构：<工作表>/month=YYYY-MM/part-<合并时间>-<标识>.parquet，每次合并每个分区一个文件，可直接用pd.read_parquet(目录, columns=[...])读取
+        # 各工作表的列结构在首次导出时固定（<工作表>/_schema.json），附加列_source_file/_source_id/_merged_at（有日期列的工作表另有_file_date）
+        self.columnar_export_dir = os.environ.get("EXCEL_MERGER_COLUMNAR_DIR") or None
+
+        # 主表分片配置：追加后行数将超过max_rows时，剩余行写入与主表同模板的分片工作簿（主表旁的新文件）
+        # mode为"size"时分片按序号滚动（主表文件名_工作表_分片2.xlsx），为"month"时按文件名日期的月份分片（主表文件名_工作表_2024-05.xlsx）
+        # 分片记录保存在主表旁的shards.json中，之后的合并直接写入当前分片；max_rows为0时不分片，超过Excel行数上限时报错
+        # 按键更新的工作表不支持分片
+        self.shard_config = {
+            "max_rows": int(os.environ.get("EXCEL_MERGER_SHARD_MAX_ROWS", 1000000)),
+            "mode": os.environ.get("EXCEL_MERGER_SHARD_MODE", "size")
+        }
+
+        # 合并前快照：每次合并前把主表和辅助数据（合并清单、行来源、键索引、指纹索引、分片记录）克隆到
+        # 辅助数据目录的snapshots中，支持写时复制的文件系统上几乎不占用时间和空间，否则完整复制
+        # keep为保留的快照数量，可通过环境变量EXCEL_MERGER_SNAPSHOT_KEEP设置，为0时不创建快照；分片工作簿不在快照范围内
+        self.snapshot_config = {
+            "keep": int(os.environ.get("EXCEL_MERGER_SNAPSHOT_KEEP", 5))
+        }
+
+        # 分块写入配置：追加数据按块写入，每块只转换本块的数据，块大小根据每次写入调用的耗时自适应调整
+        # 单次调用耗时低于target_seconds的一半时块大小翻倍，超过target_seconds时按比例缩小；
+        # 出现Apple event超时时从最后一个写入成功的块继续，块大小减半后重试，最多重试max_retries次
+        self.write_chunk_config = {
+            "initial_rows": int(os.environ.get("EXCEL_MERGER_WRITE_CHUNK_ROWS", 20000)),
+            "min_rows": 500,
+            "max_rows": 200000,
+            "target_seconds": float(os.environ.get("EXCEL_MERGER_WRITE_CHUNK_SECONDS", 2.0)),
+            "max_retries": 3
+        }
+
         # 文件名关键词映射，用于自动识别副表类型
         self.file_keywords = {
             "全站营销": "全站营销",
@@ -37,7 +1814,44 @@ class ExcelMerger:
             "店铺成交数据源": "全部渠道"
         }
         
-        self.setup_gui()
+        # 副表数据内存预算（MB）：进程RSS超过该值时，最早加载的数据块溢出到本地磁盘
+        # 默认为物理内存的一半，可通过环境变量EXCEL_MERGER_MEMORY_BUDGET_MB调整，设置为0表示不限制
+        total_memory_mb = psutil.virtual_memory().total // (1024 * 1024)
+        self.memory_budget_mb = int(os.environ.get("EXCEL_MERGER_MEMORY_BUDGET_MB", max(1024, total_memory_mb // 2)))
+        self.spill_dir = None  # 溢出目录在首次溢出时创建
+
+        # 本地暂存库（DuckDB）路径，可通过环境变量EXCEL_MERGER_STAGING_DB设置，为None时副表数据保存在内存数据块中
+        # 启用后副表文件只需导入一次，程序重启后未合并的文件自动恢复，筛选、排序和汇总在库内以SQL完成
+        self.staging_db_path = os.environ.get("EXCEL_MERGER_STAGING_DB") or None
+        self.staging_connection = None
+        atexit.register(self.cleanup_spill_dir)
+
+        # 写入引擎：xlwings驱动本机Excel，openpyxl直接读写文件（无需Excel，可在Linux服务器上运行），
+        # zip只追加新行、直接修补工作表XML，未改动的部件原样复制（不支持按键更新、分片和撤销）
+        # 默认优先使用xlwings，可通过环境变量EXCEL_MERGER_BACKEND或界面中的"写入引擎"选择
+        self.default_backend = os.environ.get("EXCEL_MERGER_BACKEND") or ("xlwings" if xw is not None else "openpyxl")
+
+        # xlwings实例池：启动界面时在后台预热size个隐藏的Excel实例，加载和合并时租借，每个实例最多使用max_uses次后重启
+        # 可通过环境变量EXCEL_MERGER_APP_POOL_SIZE和EXCEL_MERGER_APP_MAX_USES调整，size为0时每次新建实例并在用完后退出
+        pool_size = int(os.environ.get("EXCEL_MERGER_APP_POOL_SIZE", 1))
+        self.excel_pool = None
+        if xw is not None and pool_size > 0:
+            self.excel_pool = ExcelAppPool(pool_size, int(os.environ.get("EXCEL_MERGER_APP_MAX_USES", 20)))
+            atexit.register(self.excel_pool.shutdown)
+            if self.default_backend == "xlwings":
+                self.excel_pool.warm_up()
+        
+        # 合并选项的默认值，界面的复选框和命令行模式共用
+        self.option_defaults = {
+            "merge_marketing": True, "merge_internal": True, "merge_external": True, "merge_shop": True,
+            "skip_duplicates": False, "ordered_merge": False, "aggregate_before_merge": False,
+            "write_computed_values": False, "export_columnar": False, "verify_after_merge": False, "debug_mode": False
+        }
+
+        if headless:
+            self.setup_headless()
+        else:
+            self.setup_gui()
         # 注意：debug_mode已在setup_gui()中初始化，此处不需要再次初始化
         
     def adjust_formula_for_row(self, formula, template_row, target_row):
@@ -71,16 +1885,1503 @@ class ExcelMerger:
                 # 如果是对当前行的引用，则调整行号
                 new_row_ref = target_row
             else:
-                # 如果是对其他行的相对引用，则调整行号
-                new_row_ref = row_ref + row_diff
-            
-            # 返回调整后的单元格引用
-            return f"{external_ref}{sheet_ref}{col_ref}{new_row_ref}"
+                # 如果是对其他行的相对引用，则调整行号
+                new_row_ref = row_ref + row_diff
+            
+            # 返回调整后的单元格引用
+            return f"{external_ref}{sheet_ref}{col_ref}{new_row_ref}"
+        
+        # 使用预编译的正则表达式替换所有单元格引用
+        adjusted_formula = self._cell_ref_pattern.sub(adjust_cell_ref, formula)
+        
+        return adjusted_formula
+
+    def create_excel_app(self):
+        """按所选写入引擎创建Excel应用对象，两种引擎提供相同的工作簿操作接口"""
+        backend = self.workbook_backend.get() if hasattr(self, 'workbook_backend') else self.default_backend
+        if backend == "openpyxl":
+            return OpenpyxlApp(visible=False)
+        if backend == "zip":
+            return ZipAppendApp(visible=False)
+        if xw is None:
+            raise Exception("未安装xlwings，请在合并选项中选择openpyxl写入引擎")
+        if self.excel_pool is not None:
+            return self.excel_pool.acquire()
+        return xw.App(visible=False)
+
+    def release_excel_app(self, app, failed=False):
+        """用完Excel应用对象后调用：池中租借的实例归还到池中（出错时重启），其他实例直接退出"""
+        if self.excel_pool is not None and xw is not None and isinstance(app, xw.App):
+            self.excel_pool.release(app, failed)
+        else:
+            app.quit()
+
+    def begin_bulk_session(self, app):
+        """开始批量写入会话：Excel切换为手动计算，关闭屏幕刷新和事件，避免每次写入后重算和重绘
+        
+        返回会话状态（保存原有设置），openpyxl和zip写入引擎不计算公式，返回None。
+        会话必须通过end_bulk_session结束，出错时也要结束以恢复原有设置。
+        """
+        if xw is None or not isinstance(app, xw.App):
+            return None
+        session = {"calculation": app.calculation, "screen_updating": app.screen_updating,
+                   "enable_events": app.enable_events, "active": True}
+        app.screen_updating = False
+        app.enable_events = False
+        app.calculation = 'manual'
+        self.update_status("已切换为手动计算，并关闭屏幕刷新和事件", level='debug')
+        return session
+
+    def end_bulk_session(self, app, session, sheets=()):
+        """结束批量写入会话：只重算本次写入过的工作表，再恢复原有的计算模式、屏幕刷新和事件设置
+        
+        必须在保存前调用，否则手动计算模式会随工作簿一起保存。可以重复调用，只有第一次生效；
+        重算或恢复某项设置失败时继续恢复其余设置。
+        """
+        if session is None or not session["active"]:
+            return
+        session["active"] = False
+        try:
+            for sheet in sheets:
+                # xlwings没有工作表级的计算接口，通过原生对象调用Worksheet.Calculate
+                if sys.platform == 'darwin':
+                    sheet.api.calculate()
+                else:
+                    sheet.api.Calculate()
+            if sheets:
+                self.update_status(f"已重算{len(sheets)}个写入过的工作表", level='debug')
+        except Exception as e:
+            self.update_status(f"警告：重算工作表时出错，恢复自动计算后由Excel重算: {str(e)[:100]}", level='warning')
+        finally:
+            for name in ("calculation", "screen_updating", "enable_events"):
+                try:
+                    setattr(app, name, session[name])
+                except Exception as e:
+                    self.update_status(f"警告：恢复Excel的{name}设置时出错: {str(e)[:100]}", level='warning')
+
+    def extract_file_date(self, file_path, warn=True):
+        """从文件名中提取_YYYYMMDD_格式的日期，提取失败时返回固定值'error'"""
+        import re
+        file_name = os.path.basename(file_path)
+        date_match = re.search(r'_([0-9]{8})_', file_name)
+        if date_match:
+            # 成功提取到日期，转换为整数格式
+            return int(date_match.group(1))
+        if not warn:
+            return "error"
+        print(f"警告：未能从文件名中提取到日期信息: {file_name}，使用固定值'error'")
+        self.update_status(f"警告：未能从文件名中提取到日期信息: {file_name}，使用固定值'error'")
+        return "error"
+
+    def get_staging_connection(self):
+        """获取暂存库连接，未启用、缺少duckdb或暂存库无法打开（文件被占用、损坏、目录无写权限等）时返回None
+        
+        打开失败时本次运行不再使用暂存库，副表数据改为保存在内存数据块（SubDataStore）中。
+        """
+        if not self.staging_db_path:
+            return None
+        if self.staging_connection is None:
+            try:
+                self.staging_connection = DuckDBStagingStore.open_connection(self.staging_db_path)
+            except ImportError:
+                self.update_status("警告：未安装duckdb，暂存库不可用，副表数据将保存在内存中", level='warning')
+                self.staging_db_path = None
+                return None
+            except Exception as e:
+                self.update_status(f"警告：无法打开暂存库{self.staging_db_path}，副表数据将保存在内存中: {str(e)}", level='warning')
+                self.staging_db_path = None
+                return None
+        return self.staging_connection
+
+    def create_sub_store(self, sheet_name):
+        """创建副表数据存储：启用暂存库时使用DuckDB暂存库，否则使用内存数据块"""
+        connection = self.get_staging_connection()
+        if connection is not None:
+            return DuckDBStagingStore(connection, sheet_name)
+        return SubDataStore()
+
+    def restore_staged_files(self):
+        """启动时从暂存库恢复上次导入但尚未合并的副表文件"""
+        connection = self.get_staging_connection()
+        if connection is None:
+            return
+        restored = []
+        for sheet_name in self.sheet_config:
+            store = DuckDBStagingStore(connection, sheet_name)
+            try:
+                store.restore()
+            except Exception as e:
+                self.update_status(f"警告：从暂存库恢复{sheet_name}的副表文件时出错，请重新导入: {str(e)}", level='warning')
+                continue
+            if store.chunks:
+                self.sub_data[sheet_name] = store
+                self.sub_files[sheet_name] = [chunk["file"] for chunk in store.chunks]
+                restored.append(f"{sheet_name}：{len(store.chunks)}个文件，{len(store)}行")
+        if restored:
+            self.update_status("已从暂存库恢复尚未合并的副表文件：\n" + "\n".join(restored))
+
+    def get_spill_dir(self):
+        """获取副表数据块的溢出目录，首次使用时在本地临时目录中创建"""
+        if self.spill_dir is None or not os.path.isdir(self.spill_dir):
+            import tempfile
+            self.spill_dir = tempfile.mkdtemp(prefix="excel_merger_spill_")
+        return self.spill_dir
+
+    def cleanup_spill_dir(self):
+        """删除溢出目录及其中的所有数据块文件"""
+        if self.spill_dir and os.path.isdir(self.spill_dir):
+            import shutil
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        self.spill_dir = None
+
+    def memory_over_budget(self):
+        """进程RSS是否超过内存预算（未设置预算时始终为False）"""
+        if not self.memory_budget_mb:
+            return False
+        return psutil.Process(os.getpid()).memory_info().rss > self.memory_budget_mb * 1024 * 1024
+
+    def enforce_memory_budget(self):
+        """进程RSS超过内存预算时，将最早加载的数据块溢出到磁盘
+        
+        按全局加载序号从旧到新溢出，直到估算释放的内存覆盖超出部分，
+        避免在加载大量文件时触发系统交换。
+        """
+        if not self.memory_budget_mb:
+            return
+
+        rss = psutil.Process(os.getpid()).memory_info().rss
+        budget = self.memory_budget_mb * 1024 * 1024
+        if rss <= budget:
+            return
+
+        # 收集所有工作表中仍在内存中的数据块，按加载顺序排序
+        candidates = [(chunk, store) for store in self.sub_data.values() for chunk in store.in_memory_chunks()]
+        candidates.sort(key=lambda item: item[0]["seq"])
+
+        excess = rss - budget
+        freed = 0
+        spilled_count = 0
+        for chunk, store in candidates:
+            if freed >= excess:
+                break
+            freed += store.spill_chunk(chunk, self.get_spill_dir())
+            spilled_count += 1
+
+        if spilled_count > 0:
+            import gc
+            gc.collect()
+            self.update_status(f"内存占用{rss / 1024 / 1024:.0f}MB超出预算{self.memory_budget_mb}MB，"
+                               f"已将{spilled_count}个数据块（约{freed / 1024 / 1024:.0f}MB）溢出到磁盘", level='debug')
+
+    def get_sidecar_path(self, name, master_path=None):
+        """返回主表旁辅助数据目录（.主表文件名.merger）中的文件路径，目录不存在时自动创建"""
+        master_path = master_path or self.main_file
+        sidecar_dir = os.path.join(os.path.dirname(os.path.abspath(master_path)),
+                                   f".{os.path.basename(master_path)}.merger")
+        os.makedirs(sidecar_dir, exist_ok=True)
+        return os.path.join(sidecar_dir, name)
+
+    def compute_file_hash(self, file_path):
+        """计算文件内容的SHA-256哈希，作为合并清单中源文件的唯一标识"""
+        import hashlib
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            for block in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def load_merge_manifest(self):
+        """加载主表旁的合并清单：文件内容哈希 -> 目标工作表、行数、合并时间"""
+        import json
+        if not self.main_file:
+            return {}
+        manifest_path = self.get_sidecar_path("manifest.json")
+        if not os.path.exists(manifest_path):
+            return {}
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def save_merge_manifest(self, manifest):
+        """保存合并清单，先写入临时文件再替换"""
+        import json
+        manifest_path = self.get_sidecar_path("manifest.json")
+        temp_path = manifest_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file, ensure_ascii=False, indent=2)
+        os.replace(temp_path, manifest_path)
+
+    def check_sub_file(self, file_path, manifest):
+        """在解析副表文件之前检查是否需要跳过
+        
+        返回:
+            (文件内容哈希, 跳过原因)，无需跳过时跳过原因为None
+        """
+        file_hash = self.compute_file_hash(file_path)
+        if file_hash in manifest:
+            record = manifest[file_hash]
+            return file_hash, f"已于{record['merged_at']}合并到{record['sheet']}工作表（{record['rows']}行）"
+        if any(store.has_file_hash(file_hash) for store in self.sub_data.values()):
+            return file_hash, "相同内容的文件已在本次加载过"
+        return file_hash, None
+
+    def normalize_for_compare(self, df):
+        """将数据转换为便于比较的字符串形式（按列位置编号，与列名无关）
+        
+        数值统一按浮点数（保留6位小数）表示，其余值去除首尾空白，空值为空字符串，
+        使CSV中的"1"与Excel中的1.0得到相同结果。
+        """
+        normalized = {}
+        for position in range(df.shape[1]):
+            series = df.iloc[:, position]
+            numeric = pd.to_numeric(series, errors='coerce').astype('float64')
+            text = series.astype(str).str.strip()
+            text = text.where(numeric.isna(), numeric.round(6).astype(str))
+            normalized[position] = text.where(series.notna(), "")
+        return pd.DataFrame(normalized, index=df.index)
+
+    def compute_row_fingerprints(self, df):
+        """向量化计算每行数据的64位指纹"""
+        return pd.util.hash_pandas_object(self.normalize_for_compare(df), index=False).to_numpy(dtype=np.uint64)
+
+    def compute_verify_hashes(self, df):
+        """向量化计算校验用的行哈希
+        
+        在指纹规范化的基础上将日期统一为ISO格式，使写入后被Excel识别为日期的文本（如"2024-01-01"）
+        与读回的日期值得到相同结果。
+        """
+        import re
+        if not hasattr(self, '_date_text_pattern'):
+            self._date_text_pattern = re.compile(r'^\d{4}[-/]\d{1,2}[-/]\d{1,2}( \d{1,2}:\d{2}(:\d{2})?)?$')
+        columns = {}
+        for position in range(df.shape[1]):
+            series = df.iloc[:, position]
+            if pd.api.types.is_datetime64_any_dtype(series):
+                parsed = series
+                is_date = series.notna()
+            elif series.dtype == object:
+                is_date = series.astype(str).str.match(self._date_text_pattern) & series.notna()
+                if not is_date.any():
+                    columns[position] = series
+                    continue
+                parsed = pd.to_datetime(series.where(is_date), errors='coerce')
+                is_date &= parsed.notna()
+            else:
+                columns[position] = series
+                continue
+            text = parsed.dt.strftime('%Y-%m-%d %H:%M:%S').str.replace(' 00:00:00', '', regex=False)
+            columns[position] = series.astype(object).where(~is_date, text)
+        return self.compute_row_fingerprints(pd.DataFrame(columns, index=df.index))
+
+    def verify_written_rows(self, sheet, start_col, columns_count, rows, hashes, batch_rows=50000):
+        """读回工作表中的写入区域，逐行比对哈希，返回行号错误、缺失和错位的行
+        
+        行号连续的部分按批读取（每批一次读取），读回的数据整批向量化计算哈希。
+        哈希与预期不符的行：整行为空记为缺失，哈希出现在本工作表其他预期行中记为错位，其余记为不一致。
+        """
+        order = np.argsort(rows, kind='stable')
+        rows = rows[order]
+        hashes = hashes[order]
+        # 同一行被按键更新多次时以最后一次写入为准
+        is_last = np.append(rows[1:] != rows[:-1], True)
+        rows = rows[is_last]
+        hashes = hashes[is_last]
+        expected_set = np.unique(hashes)
+        result = {"checked": 0, "mismatched": [], "missing": [], "shifted": []}
+
+        # 在行号不连续处切分，每段再按批大小切分
+        breaks = np.flatnonzero(np.diff(rows) != 1) + 1
+        for run_rows, run_hashes in zip(np.split(rows, breaks), np.split(hashes, breaks)):
+            for batch_start in range(0, len(run_rows), batch_rows):
+                batch_row_numbers = run_rows[batch_start:batch_start + batch_rows]
+                batch_hashes = run_hashes[batch_start:batch_start + batch_rows]
+                values = sheet.range(f"{start_col}{int(batch_row_numbers[0])}").resize(
+                    len(batch_row_numbers), columns_count).options(ndim=2).value
+                actual_df = pd.DataFrame(values)
+                actual_hashes = self.compute_verify_hashes(actual_df)
+                result["checked"] += len(batch_row_numbers)
+
+                is_wrong = actual_hashes != batch_hashes
+                if not is_wrong.any():
+                    continue
+                is_empty = actual_df.isna().all(axis=1).to_numpy()
+                is_shifted = np.isin(actual_hashes, expected_set) & ~is_empty
+                result["missing"].extend(batch_row_numbers[is_wrong & is_empty].tolist())
+                result["shifted"].extend(batch_row_numbers[is_wrong & is_shifted].tolist())
+                result["mismatched"].extend(batch_row_numbers[is_wrong & ~is_empty & ~is_shifted].tolist())
+        return result
+
+    def compute_row_keys(self, df, key_positions):
+        """向量化计算每行的键字符串，多个键列之间用不可见分隔符连接"""
+        normalized = self.normalize_for_compare(df.iloc[:, key_positions])
+        keys = normalized.iloc[:, 0]
+        if normalized.shape[1] > 1:
+            keys = keys.str.cat([normalized.iloc[:, i] for i in range(1, normalized.shape[1])], sep="\x1f")
+        return keys
+
+    def load_key_index(self, sheet_name, key_positions):
+        """加载按键更新所用的键索引：键字符串 -> 主表行号
+        
+        索引文件不存在时，根据加载主表时读取的现有数据一次性建立（表头占第1行，数据从第2行开始）。
+        """
+        import json
+        index_path = self.get_sidecar_path(f"keys_{sheet_name}.json")
+        if os.path.exists(index_path):
+            with open(index_path, 'r', encoding='utf-8') as file:
+                return json.load(file)
+
+        existing = self.main_data.get(sheet_name)
+        if existing is None or existing.empty:
+            return {}
+
+        start_col_offset = ord(self.sheet_config[sheet_name]["start_col"]) - ord('A')
+        key_columns = existing.iloc[:, [start_col_offset + position for position in key_positions]]
+        key_columns = key_columns.reset_index(drop=True).dropna(how='all')
+        self.update_status(f"正在为{sheet_name}工作表建立键索引（{len(key_columns)}行）...", level='debug')
+        keys = self.compute_row_keys(key_columns, list(range(len(key_positions))))
+        # DataFrame第i行对应主表第i+2行
+        return dict(zip(keys.tolist(), (keys.index + 2).tolist()))
+
+    def save_key_index(self, sheet_name, key_index):
+        """保存键索引，先写入临时文件再替换"""
+        import json
+        index_path = self.get_sidecar_path(f"keys_{sheet_name}.json")
+        temp_path = index_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(key_index, file, ensure_ascii=False)
+        os.replace(temp_path, index_path)
+
+    def parse_date_series(self, series):
+        """将日期列解析为datetime，无法解析的值为NaT"""
+        try:
+            if pd.api.types.is_numeric_dtype(series):
+                # 20230101这类整数日期按YYYYMMDD解析
+                return pd.to_datetime(series.astype('Int64').astype(str), format='%Y%m%d', errors='coerce')
+            return pd.to_datetime(series, errors='coerce')
+        except Exception:
+            return pd.Series(pd.NaT, index=series.index)
+
+    def compute_order_keys(self, series):
+        """将日期列转换为可排序的int64键，无法解析的值排在最后"""
+        parsed = self.parse_date_series(series)
+        keys = parsed.to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        keys[parsed.isna().to_numpy()] = np.iinfo(np.int64).max
+        return keys
+
+    def kway_merge_sorted(self, runs):
+        """按键对多个已排序的数据块做分段多路归并
+        
+        每次从堆中取出键最小的数据块，用searchsorted一次切出不超过其余数据块最小键的连续行，
+        按段而不是按行输出，键相同时保持数据块原有顺序（稳定）。数据块按批读取，
+        当前批用完后才读取下一批，已溢出到磁盘的数据块不需要整体读回。
+        
+        参数:
+            runs: [SortedRun, ...]，按输出优先级排列
+        """
+        import heapq
+        batches = [run.iter_batches() for run in runs]
+        current = [None] * len(runs)
+        positions = [0] * len(runs)
+        heap = []
+
+        def advance(i):
+            # 读取数据块的下一个非空批，读完时返回False
+            for df, keys in batches[i]:
+                if len(keys) > 0:
+                    current[i] = (df, keys)
+                    positions[i] = 0
+                    return True
+            current[i] = None
+            return False
+
+        for i in range(len(runs)):
+            if advance(i):
+                heap.append((current[i][1][0], i))
+        heapq.heapify(heap)
+        while heap:
+            _, i = heapq.heappop(heap)
+            df, keys = current[i]
+            start = positions[i]
+            if heap:
+                next_key, next_i = heap[0]
+                # 键相同时序号较小的数据块优先，保证归并稳定
+                side = 'right' if i < next_i else 'left'
+                end = max(start + 1, int(np.searchsorted(keys, next_key, side=side)))
+            else:
+                end = len(keys)
+            yield runs[i].chunk, df.iloc[start:end]
+            positions[i] = end
+            if end < len(keys):
+                heapq.heappush(heap, (keys[end], i))
+            elif advance(i):
+                heapq.heappush(heap, (current[i][1][0], i))
+
+    def select_merge_chunks(self, sub_store, manifest):
+        """返回本次需要合并的数据块：跳过合并清单中已合并的文件，按日期顺序合并时按文件名日期排序"""
+        chunks = []
+        for chunk in sub_store.chunks:
+            if chunk["hash"] in manifest:
+                self.update_status(f"已跳过{os.path.basename(chunk['file'])}：该文件已合并过", level='warning')
+                continue
+            chunks.append(chunk)
+
+        if self.ordered_merge.get():
+            # 文件名中没有日期的文件排在最后，同一日期保持加载顺序
+            def file_sort_key(chunk):
+                file_date = self.extract_file_date(chunk["file"], warn=False)
+                return (file_date if isinstance(file_date, int) else 99999999, chunk["seq"])
+            chunks.sort(key=file_sort_key)
+        return chunks
+
+    def iter_merge_pieces(self, sheet_name, sub_store, chunks):
+        """按输出顺序逐段返回(数据块记录, 数据)
+
+        按日期顺序合并时文件已按文件名日期排序；配置了日期列时，日期范围互相重叠的相邻文件组成一组做多路归并，
+        不重叠的文件直接按顺序输出，因此只需对单个文件排序，无需对全部数据做整体排序；
+        组内排序后的数据块在内存超出预算时按批溢出到磁盘，归并时逐批读回。
+        使用暂存库时排序在库内以SQL完成，查询结果流式返回。
+        """
+        order_col = self.order_columns.get(sheet_name) if self.ordered_merge.get() else None
+        if isinstance(sub_store, DuckDBStagingStore):
+            yield from sub_store.iter_query_pieces(chunks, order_col)
+            return
+
+        if not order_col:
+            for chunk in chunks:
+                yield chunk, sub_store.load_chunk(chunk)
+            return
+
+        group = []
+        group_max = None
+        for chunk in chunks:
+            df = sub_store.load_chunk(chunk)
+            if order_col not in df.columns:
+                self.update_status(f"警告：{os.path.basename(chunk['file'])}中没有日期列{order_col}，按文件顺序合并", level='warning')
+                keys = np.zeros(len(df), dtype=np.int64)
+            else:
+                keys = self.compute_order_keys(df[order_col])
+            if len(keys) == 0:
+                yield chunk, df
+                continue
+
+            # 单个文件内按日期稳定排序
+            order = np.argsort(keys, kind='stable')
+            run = SortedRun(chunk, df.iloc[order], keys[order])
+            del df
+
+            # 与当前组的日期范围不重叠时，先输出当前组
+            if group and run.keys[0] >= group_max:
+                yield from self.kway_merge_sorted(group)
+                group = []
+                group_max = None
+            group.append(run)
+            group_max = run.keys[-1] if group_max is None else max(group_max, run.keys[-1])
+            # 组内的数据块需要同时参与归并，内存超出预算时把已排序的数据块按批溢出到磁盘
+            if len(group) > 1 and self.memory_over_budget():
+                for grouped_run in group:
+                    grouped_run.spill(self.get_spill_dir())
+
+        yield from self.kway_merge_sorted(group)
+
+    def filter_duplicate_pieces(self, pieces, state):
+        """逐段过滤掉已合并过的行以及与本次先前数据块重复的行（同一数据块内的相同行保留）
+        
+        已合并行的指纹索引在过滤过程中保持不变，本次新增的指纹单独保存在一个较小的有序数组中，
+        每段只按二分查找判断是否重复，全部数据段过滤完成后才与索引合并一次，代价与索引大小无关。
+        
+        参数:
+            pieces: (数据块记录, 数据)的迭代器
+            state: {"seen": 已合并行指纹的有序数组, "duplicates": 已跳过的行数, "by_chunk": {}}，过滤完成后seen包含本次新增的指纹，
+                   by_chunk按数据块序号记录各数据块新增的指纹，用于撤销合并时从索引中精确移除
+        """
+        added = np.empty(0, dtype=np.uint64)
+        for chunk, df in pieces:
+            if len(df) > 0:
+                fingerprints = self.compute_row_fingerprints(df)
+                is_duplicate = sorted_contains(state["seen"], fingerprints) | sorted_contains(added, fingerprints)
+                if is_duplicate.any():
+                    state["duplicates"] += int(is_duplicate.sum())
+                    df = df[~is_duplicate]
+                    fingerprints = fingerprints[~is_duplicate]
+                # 保留下来的指纹都不在有序数组中，按二分查找的位置插入，保持有序
+                fingerprints = np.unique(fingerprints)
+                added = np.insert(added, np.searchsorted(added, fingerprints), fingerprints)
+                state.setdefault("by_chunk", {}).setdefault(chunk["seq"], []).append(fingerprints)
+            yield chunk, df
+        state["seen"] = np.union1d(state["seen"], added)
+
+    def get_aggregate_columns(self, spec):
+        """返回汇总配置涉及的全部列名（去重，保持配置顺序）"""
+        columns = []
+        for col in spec["group_by"] + spec.get("sum", []) + spec.get("count", []) + spec.get("mean", []):
+            if col not in columns:
+                columns.append(col)
+        return columns
+
+    def aggregate_pieces(self, sheet_name, pieces, spec):
+        """按分组列对所有数据段做向量化汇总，返回单个汇总数据段
+        
+        每段数据先各自groupby得到部分汇总结果（求和、计数，均值拆成求和与计数），
+        最后再对部分结果做一次groupby合并，内存占用只与分组数量有关。
+        分组按首次出现的顺序输出，按日期顺序合并时保持日期顺序。
+        """
+        group_by = spec["group_by"]
+        sum_cols = spec.get("sum", [])
+        count_cols = spec.get("count", [])
+        mean_cols = spec.get("mean", [])
+        required_columns = self.get_aggregate_columns(spec)
+
+        partials = []
+        sources = []
+        source_columns = None
+        for chunk, df in pieces:
+            sources.append((chunk, len(df)))
+            if len(df) == 0:
+                continue
+            missing = [col for col in required_columns if col not in df.columns]
+            if missing:
+                raise Exception(f"{sheet_name}副表文件{os.path.basename(chunk['file'])}中找不到汇总列：{', '.join(missing)}")
+            if source_columns is None:
+                source_columns = list(df.columns)
+
+            work = df[group_by].copy()
+            for col in set(sum_cols + mean_cols):
+                work[f"__sum__{col}"] = pd.to_numeric(df[col], errors='coerce')
+            for col in count_cols:
+                work[f"__count__{col}"] = df[col].notna()
+            for col in mean_cols:
+                work[f"__mean_count__{col}"] = work[f"__sum__{col}"].notna()
+            partials.append(work.groupby(group_by, dropna=False, sort=False).sum())
+
+        if not partials:
+            return
+
+        combined = pd.concat(partials).groupby(level=list(range(len(group_by))), dropna=False, sort=False).sum()
+        result = combined.index.to_frame(index=False)
+        result.columns = group_by
+        for col in sum_cols:
+            result[col] = combined[f"__sum__{col}"].to_numpy()
+        for col in count_cols:
+            result[col] = combined[f"__count__{col}"].to_numpy()
+        for col in mean_cols:
+            counts = combined[f"__mean_count__{col}"].to_numpy()
+            result[col] = np.where(counts > 0, combined[f"__sum__{col}"].to_numpy() / np.maximum(counts, 1), np.nan)
+
+        # 输出列保持副表中的原有顺序
+        result = result[[col for col in source_columns if col in required_columns]]
+        self.update_status(f"{sheet_name}工作表汇总完成：{sum(rows for _, rows in sources)}行原始数据汇总为{len(result)}行")
+
+        # 汇总数据段使用合成的数据块记录，并记录参与汇总的原始数据块
+        yield {"seq": next(_chunk_sequence), "file": f"汇总_{datetime.now():%Y%m%d%H%M%S}_{len(sources)}个文件",
+               "hash": None, "sources": sources}, result
+
+    def get_computed_columns(self, sheet_name):
+        """返回本次合并中写入计算值（不填充公式）的列字母，未启用或未配置时返回空列表"""
+        steps = self.transform_config.get(sheet_name)
+        if not steps or not self.write_computed_values.get():
+            return []
+        end_col = self.sheet_config[sheet_name]["formula_end_col"]
+        columns = []
+        for step in steps:
+            target = step.get("target")
+            if target is None:
+                continue
+            if not ("A" <= target <= end_col and len(target) == 1):
+                raise Exception(f"{sheet_name}派生列目标{target}超出A到{end_col}列的公式区域")
+            if target not in columns:
+                columns.append(target)
+        return sorted(columns)
+
+    def load_lookup_table(self, step):
+        """返回查找步骤使用的映射（键已规范化为字符串），主表映射工作表每次合并只读取一次"""
+        if "mapping" in step:
+            mapping = pd.Series(step["mapping"])
+        else:
+            cache_key = (step["sheet"], step["key"], step["value"])
+            if cache_key in self.lookup_cache:
+                return self.lookup_cache[cache_key]
+            table = pd.read_excel(self.main_file, sheet_name=step["sheet"], usecols=[step["key"], step["value"]])
+            # 键重复时以第一次出现的值为准
+            table = table.dropna(subset=[step["key"]]).drop_duplicates(subset=[step["key"]])
+            mapping = pd.Series(table[step["value"]].to_numpy(), index=table[step["key"]])
+        # 与副表的值使用相同的规范化方式比较，避免整数、浮点数和文本形式的键匹配失败
+        keys = self.normalize_for_compare(pd.DataFrame({"key": mapping.index})).iloc[:, 0]
+        mapping = pd.Series(mapping.to_numpy(), index=keys.to_numpy())
+        mapping = mapping[~mapping.index.duplicated()]
+        if "mapping" not in step:
+            self.lookup_cache[cache_key] = mapping
+        return mapping
+
+    def cast_series(self, series, dtype):
+        """按类型名转换单列数据"""
+        if dtype in ("float", "number"):
+            return pd.to_numeric(series, errors='coerce')
+        if dtype == "int":
+            return pd.to_numeric(series, errors='coerce').round().astype('Int64')
+        if dtype == "str":
+            return series.where(series.isna(), series.astype(str))
+        if dtype == "date":
+            return self.parse_date_series(series)
+        raise Exception(f"不支持的类型转换：{dtype}")
+
+    def apply_transforms(self, sheet_name, df, steps):
+        """按声明的步骤对一段数据向量化计算派生列
+        
+        返回(转换后的数据, 派生列)：转换后的数据保持原列名和列顺序，只包含类型转换的结果；
+        派生列以目标列字母为列名，与数据逐行对应。
+        """
+        work = df.copy(deep=False)
+        targets = []
+        for step in steps:
+            op = step["op"]
+            try:
+                if op == "rename":
+                    work = work.rename(columns=step["columns"])
+                    continue
+                if op == "cast":
+                    for col, dtype in step["columns"].items():
+                        work[col] = self.cast_series(work[col], dtype)
+                    continue
+                if op == "derive":
+                    value = work.eval(step["expr"])
+                elif op == "concat":
+                    value = work[step["columns"][0]].astype(str)
+                    for col in step["columns"][1:]:
+                        value = value.str.cat(work[col].astype(str), sep=step.get("sep", ""))
+                elif op == "date":
+                    value = self.parse_date_series(work[step["column"]]).dt.strftime(step.get("format", "%Y-%m-%d"))
+                elif op == "lookup":
+                    mapping = self.load_lookup_table(step)
+                    keys = self.normalize_for_compare(work[[step["column"]]]).iloc[:, 0]
+                    value = keys.map(mapping)
+                    if "default" in step:
+                        value = value.where(value.notna(), step["default"])
+                else:
+                    raise Exception(f"不支持的计算步骤：{op}")
+            except KeyError as e:
+                raise Exception(f"{sheet_name}派生列计算步骤{op}中找不到列：{e}")
+            work[step["target"]] = value
+            if step["target"] not in targets:
+                targets.append(step["target"])
+
+        derived = work[sorted(targets)] if targets else pd.DataFrame(index=df.index)
+        data = work.drop(columns=targets).iloc[:, :len(df.columns)]
+        data.columns = df.columns
+        # 可空整数和日期类型转换为Excel可写入的值，缺失值写为空单元格
+        return self.to_writable(data), self.to_writable(derived)
+
+    def to_writable(self, df):
+        """将可空类型和日期时间列转换为object列，缺失值替换为None"""
+        converted = {}
+        for col in df.columns:
+            series = df[col]
+            if isinstance(series.dtype, pd.api.extensions.ExtensionDtype) or pd.api.types.is_datetime64_any_dtype(series):
+                series = series.astype(object)
+                converted[col] = series.where(series.notna(), None)
+        if not converted:
+            return df
+        df = df.copy(deep=False)
+        for col, series in converted.items():
+            df[col] = series
+        return df
+
+    def new_write_stats(self):
+        """创建一个工作表的分块写入统计，块大小从配置的初始值开始自适应"""
+        return {"rows": 0, "seconds": 0.0, "calls": 0, "legacy_calls": 0, "retries": 0,
+                "chunk_rows": self.write_chunk_config["initial_rows"]}
+
+    def plan_sheet_writes(self, sheet, sheet_name, columns_count, derived_columns=()):
+        """规划追加区域的写入：A列到数据最后一列按来源分为公式列、日期列、派生列和数据列，相邻的列合并为一次二维写入
+        
+        公式列的模板取第2行（第2行为空时取第1行）的公式，按行调整后与fill_sheet_formula的填充结果一致；
+        引用外部工作簿的公式和非公式的模板不在此写入，仍由fill_sheet_formula按原有的批处理和回退策略填充。
+        
+        返回:
+            {"sources": {列号: (来源, 参数)}, "runs": [[起始列号, 结束列号], ...], "formula_columns": [已随数据写入公式的列字母]}
+        """
+        import re
+        config = self.sheet_config[sheet_name]
+        external_ref_pattern = re.compile(r'\[.*?\].*?!')
+        sources = {}
+        for col in range(1, column_index(config["formula_end_col"]) + 1):
+            letter = column_letter(col)
+            template = sheet.range(f"{letter}2").formula or sheet.range(f"{letter}1").formula
+            if isinstance(template, str) and template.startswith("=") and not external_ref_pattern.search(template):
+                sources[col] = ("formula", template)
+        for letter in derived_columns:
+            sources[column_index(letter)] = ("derived", letter)
+        if config["date_col"] is not None:
+            sources[column_index(config["date_col"])] = ("date", None)
+        start = column_index(config["start_col"])
+        for j in range(columns_count):
+            sources[start + j] = ("data", j)
+        # 按列号切分为连续的列区间，每个区间每块只需一次写入
+        runs = []
+        for col in sorted(sources):
+            if runs and runs[-1][1] == col - 1:
+                runs[-1][1] = col
+            else:
+                runs.append([col, col])
+        formula_columns = [column_letter(col) for col in sorted(sources) if sources[col][0] == "formula"]
+        # 逐列写入时每块的调用次数：数据、日期列各一次，派生列每段相邻列一次
+        derived_indexes = sorted(column_index(letter) for letter in derived_columns)
+        derived_runs = sum(1 for i, col in enumerate(derived_indexes) if i == 0 or col != derived_indexes[i - 1] + 1)
+        return {"sources": sources, "runs": runs, "formula_columns": formula_columns,
+                "legacy_calls_per_chunk": 1 + (config["date_col"] is not None) + derived_runs}
+
+    def build_run_block(self, plan, first, last, row, values, date_value, derived):
+        """按写入计划生成一个连续列区间的二维数据块（object数组），公式列按行号生成调整后的公式"""
+        block = np.empty((len(values), last - first + 1), dtype=object)
+        for col in range(first, last + 1):
+            kind, arg = plan["sources"][col]
+            if kind == "data":
+                block[:, col - first] = values[:, arg]
+            elif kind == "date":
+                block[:, col - first] = date_value
+            elif kind == "derived":
+                block[:, col - first] = derived[arg].to_numpy(dtype=object)
+            else:
+                block[:, col - first] = [self.adjust_formula_for_row(arg, 2, target_row) for target_row in range(row, row + len(values))]
+        return block
+
+    def write_data_block(self, sheet, start_row, data, plan, date_value=None, derived=None, stats=None):
+        """按写入计划分块写入数据，块大小根据每次写入的耗时自适应，超时时从最后写入成功的块继续
+        
+        每块只把本块的数据转换为object数组，不物化整个数据段的副本。日期列、派生列和公式列与数据列相邻时
+        合并为同一次二维写入，stats中记录实际写入次数和逐列写入所需的次数。
+        date_value可以是单个值，也可以是与数据逐行对应的数组（合并了不同文件的数据段时）。
+        """
+        config = self.write_chunk_config
+        if stats is None:
+            stats = self.new_write_stats()
+        total_rows = len(data)
+        # 逐列写入时公式列在合并后按每3000行一批填充
+        stats["legacy_calls"] += len(plan["formula_columns"]) * ((total_rows + 2999) // 3000)
+        offset = 0
+        retries = 0
+        while offset < total_rows:
+            chunk_rows = min(stats["chunk_rows"], total_rows - offset)
+            row = start_row + offset
+            started = time.perf_counter()
+            try:
+                values = data.iloc[offset:offset + chunk_rows].to_numpy(dtype=object)
+                derived_chunk = derived.iloc[offset:offset + chunk_rows] if derived is not None else None
+                date_chunk = date_value[offset:offset + chunk_rows] if isinstance(date_value, np.ndarray) else date_value
+                for first, last in plan["runs"]:
+                    block = self.build_run_block(plan, first, last, row, values, date_chunk, derived_chunk)
+                    sheet.range(f"{column_letter(first)}{row}").options(index=False, header=False).value = block
+            except Exception as e:
+                error_str = str(e).lower()
+                if not ("apple event timed out" in error_str or "oserror: -1712" in error_str) or retries >= config["max_retries"]:
+                    raise
+                # 超时：本块可能只写入了一部分，缩小块大小后从本块起始行重新写入（重复写入同一区域结果不变）
+                retries += 1
+                stats["retries"] += 1
+                stats["chunk_rows"] = max(config["min_rows"], stats["chunk_rows"] // 2)
+                self.update_status(f"警告：第{row}行起的{chunk_rows}行写入超时，块大小减小为{stats['chunk_rows']}行后重试（第{retries}次）", level='warning')
+                continue
+            elapsed = time.perf_counter() - started
+            retries = 0
+            offset += chunk_rows
+            stats["rows"] += chunk_rows
+            stats["seconds"] += elapsed
+            stats["calls"] += len(plan["runs"])
+            stats["legacy_calls"] += plan["legacy_calls_per_chunk"]
+            # 根据本次调用的耗时调整下一块的大小（只根据完整大小的块调整）
+            if chunk_rows == stats["chunk_rows"]:
+                if elapsed < config["target_seconds"] / 2:
+                    stats["chunk_rows"] = min(config["max_rows"], stats["chunk_rows"] * 2)
+                elif elapsed > config["target_seconds"]:
+                    scaled = int(stats["chunk_rows"] * config["target_seconds"] / elapsed)
+                    stats["chunk_rows"] = max(config["min_rows"], scaled)
+        return stats
+
+    def flush_write_buffer(self, buffer, write_plans, stats, verify_targets=None):
+        """把缓冲的连续数据段按列位置拼接为一个数据帧后写入目标工作表，并登记写入校验
+        
+        参数:
+            buffer: {"target", "sheet_name", "start_row", "columns_count", "derived_columns",
+                     "frames": [数据段], "derived": [派生列或None], "dates": [(日期值, 行数)], "rows": 总行数}，为None时不执行
+            write_plans: (工作簿路径, 工作表) -> 写入计划，每个目标工作表只规划一次
+        """
+        if buffer is None or not buffer["frames"]:
+            return
+        target = buffer["target"]
+        sheet_name = buffer["sheet_name"]
+        frames = buffer["frames"]
+        # 不同文件的列名可能不同，按列位置拼接
+        columns = frames[0].columns
+        data = frames[0] if len(frames) == 1 else pd.concat(
+            [frame.set_axis(columns, axis=1) for frame in frames], ignore_index=True)
+        derived = None
+        if buffer["derived"][0] is not None:
+            derived = buffer["derived"][0] if len(frames) == 1 else pd.concat(buffer["derived"], ignore_index=True)
+        # 各段日期值相同时按单个值写入，否则展开为逐行的日期数组
+        date_values = [date_value for date_value, _ in buffer["dates"]]
+        if all(date_value == date_values[0] for date_value in date_values):
+            date_value = date_values[0]
+        else:
+            date_value = np.concatenate([np.full(rows, date_value, dtype=object) for date_value, rows in buffer["dates"]])
+
+        plan_key = (target["path"], sheet_name)
+        if plan_key not in write_plans:
+            write_plans[plan_key] = self.plan_sheet_writes(target["sheet"], sheet_name, buffer["columns_count"],
+                                                           buffer["derived_columns"])
+        self.write_data_block(target["sheet"], buffer["start_row"], data, write_plans[plan_key], date_value, derived, stats)
+        if verify_targets is not None:
+            entry = verify_targets.setdefault(plan_key, {
+                "sheet": target["sheet"], "start_col": self.sheet_config[sheet_name]["start_col"],
+                "columns": data.shape[1], "rows": [], "hashes": []})
+            entry["rows"].append(np.arange(buffer["start_row"], buffer["start_row"] + len(data), dtype=np.int64))
+            entry["hashes"].append(self.compute_verify_hashes(data))
+
+    def report_write_stats(self, sheet_name, stats):
+        """在状态栏报告工作表的写入速度"""
+        if stats["rows"] == 0:
+            return
+        rate = stats["rows"] / stats["seconds"] if stats["seconds"] > 0 else float('inf')
+        message = f"{sheet_name}工作表写入{stats['rows']}行，共{stats['calls']}次写入，用时{stats['seconds']:.1f}秒（{rate:.0f}行/秒）"
+        saved_calls = stats["legacy_calls"] - stats["calls"]
+        if saved_calls > 0:
+            message += f"，按写入计划合并相邻列，比逐列写入减少{saved_calls}次调用"
+        if stats["retries"]:
+            message += f"，超时重试{stats['retries']}次"
+        self.update_status(message)
+
+    def write_derived_columns(self, sheet, row, derived):
+        """将派生列写入主表，相邻的目标列合并为一次写入"""
+        letters = list(derived.columns)
+        values = derived.to_numpy(dtype=object)
+        start = 0
+        for i in range(1, len(letters) + 1):
+            if i == len(letters) or ord(letters[i]) != ord(letters[i - 1]) + 1:
+                sheet.range(f"{letters[start]}{row}").options(index=False, header=False).value = values[:, start:i]
+                start = i
+
+    def find_append_row(self, sheet, start_col):
+        """返回起始列最后一个非空单元格的下一行
+        
+        从工作表最后一行向上定位（相当于Ctrl+↑），只需一次调用，不读取整列数据，代价与主表行数无关。
+        """
+        if hasattr(sheet, "last_value_row"):
+            # zip追加写入引擎：本次已追加过新行时接在其后，否则扫描工作表XML中起始列的单元格
+            if sheet.last_row > sheet.original_last_row:
+                return sheet.next_append_row
+            append_row = sheet.last_value_row(column_index(start_col)) + 1
+            if append_row <= sheet.original_last_row:
+                raise Exception(f"{sheet.name}工作表{start_col}列最后的数据在第{append_row - 1}行，但其下方直到第{sheet.original_last_row}行"
+                                f"还有其他内容（如预先填充的公式或格式），zip追加写入引擎只能在最后一行之后追加，"
+                                f"请选择openpyxl或xlwings写入引擎")
+            return append_row
+        return sheet.range(f"{start_col}{EXCEL_MAX_ROWS}").end('up').row + 1
+
+    def probe_header(self, sheet, start_col):
+        """读取起始列开始的表头（第1行向右到第一个空单元格），用于检查列数"""
+        values = sheet.range(f"{start_col}1").expand('right').value
+        if not isinstance(values, list):
+            values = [values]
+        # 起始单元格为空时expand只返回该单元格；各写入引擎都在第一个空单元格处截止，与Excel的Ctrl+→一致
+        header = []
+        for value in values:
+            if value is None or (isinstance(value, str) and not value.strip()):
+                break
+            header.append(value)
+        return header
+
+    def load_shard_map(self):
+        """加载主表旁的分片记录：工作表 -> 按创建顺序排列的分片列表"""
+        import json
+        shard_path = self.get_sidecar_path("shards.json")
+        if not os.path.exists(shard_path):
+            return {}
+        with open(shard_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def save_shard_map(self, shard_map):
+        """保存分片记录，先写入临时文件再替换"""
+        import json
+        shard_path = self.get_sidecar_path("shards.json")
+        temp_path = shard_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(shard_map, file, ensure_ascii=False, indent=1)
+        os.replace(temp_path, shard_path)
+
+    def stage_workbook(self, book, path, sheet_names=()):
+        """把工作簿保存到目标文件同目录下的暂存文件并关闭，校验通过后返回暂存文件路径
+        
+        暂存文件与目标文件在同一目录（同一文件系统），之后由commit_staged_workbook原子替换目标文件；
+        保存或校验失败时删除暂存文件，目标文件保持不变。
+        """
+        stem, ext = os.path.splitext(os.path.basename(path))
+        staged_path = os.path.join(os.path.dirname(os.path.abspath(path)), f".{stem}.saving-{os.getpid()}{ext}")
+        try:
+            book.save(staged_path)
+            # zip追加写入引擎原样复制未改动部件的压缩数据，只校验其重新生成的部件
+            parts = getattr(book, "rewritten_parts", None)
+            book.close()
+            self.verify_staged_workbook(staged_path, sheet_names, parts)
+        except Exception:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+            raise
+        return staged_path
+
+    def verify_staged_workbook(self, path, sheet_names=(), parts=None):
+        """校验暂存的工作簿：zip包中的部件CRC正确，并且包含本次写入的工作表
+        
+        parts为None时校验全部部件，否则只解压校验parts中的部件。
+        """
+        import zipfile
+        import xml.etree.ElementTree as ET
+        if os.path.getsize(path) == 0:
+            raise Exception(f"暂存文件{os.path.basename(path)}为空")
+        if not zipfile.is_zipfile(path):
+            return  # .xls等非zip格式只检查文件非空
+        with zipfile.ZipFile(path) as archive:
+            if parts is None:
+                broken = archive.testzip()
+            else:
+                broken = None
+                for name in parts:
+                    try:
+                        with archive.open(name) as stream:
+                            while stream.read(4 * 1024 * 1024):
+                                pass
+                    except zipfile.BadZipFile:
+                        broken = name
+                        break
+            if broken is not None:
+                raise Exception(f"暂存文件{os.path.basename(path)}中的{broken}已损坏")
+            root = ET.fromstring(archive.read("xl/workbook.xml"))
+        names = {sheet.get("name") for sheet in root.iter(f"{{{SPREADSHEET_NS}}}sheet")}
+        missing = [name for name in sheet_names if name not in names]
+        if missing:
+            raise Exception(f"暂存文件{os.path.basename(path)}中缺少工作表：{', '.join(missing)}")
+
+    def commit_staged_workbook(self, staged_path, path):
+        """用校验过的暂存文件原子替换目标文件，替换前把目标文件的当前版本保留在辅助数据目录中
+        
+        上一版本优先以硬链接保留（不复制数据），文件系统不支持硬链接时复制。替换失败时暂存文件保留，由调用方处理。
+        """
+        import shutil
+        if os.path.exists(path):
+            previous_path = self.get_sidecar_path(f"previous_{os.path.basename(path)}")
+            temp_path = previous_path + ".tmp"
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            try:
+                os.link(path, temp_path)
+            except OSError:
+                shutil.copy2(path, temp_path)
+            os.replace(temp_path, previous_path)
+        os.replace(staged_path, path)
+
+    def list_sidecar_state_files(self):
+        """返回辅助数据目录中随主表一起快照和恢复的文件名"""
+        import re
+        sidecar_dir = os.path.dirname(self.get_sidecar_path("manifest.json"))
+        pattern = re.compile(r'^(manifest\.json|lineage\.json|shards\.json|columnar\.json|keys_.+\.json|(lineage_)?fingerprints_.+\.npy)$')
+        return sorted(name for name in os.listdir(sidecar_dir) if pattern.match(name))
+
+    def create_snapshot(self, reason="合并前"):
+        """为主表和辅助数据创建快照，返回(快照目录, 克隆方式)，并按保留数量删除最早的快照
+        
+        快照先写入.pending_目录，全部文件克隆完成后再重命名，不会留下不完整的快照。
+        """
+        import json
+        snapshot_root = self.get_sidecar_path("snapshots")
+        name = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        pending_dir = os.path.join(snapshot_root, f".pending_{name}")
+        os.makedirs(pending_dir)
+        method = clone_file(self.main_file, os.path.join(pending_dir, os.path.basename(self.main_file)))
+        for file_name in self.list_sidecar_state_files():
+            clone_file(self.get_sidecar_path(file_name), os.path.join(pending_dir, file_name))
+        with open(os.path.join(pending_dir, "snapshot.json"), 'w', encoding='utf-8') as file:
+            json.dump({"file": os.path.basename(self.main_file), "size": os.path.getsize(self.main_file), "method": method,
+                       "reason": reason, "created_at": datetime.now().isoformat(timespec='seconds')},
+                      file, ensure_ascii=False, indent=1)
+        snapshot_dir = os.path.join(snapshot_root, name)
+        os.replace(pending_dir, snapshot_dir)
+        self.prune_snapshots()
+        return snapshot_dir, method
+
+    def list_snapshots(self):
+        """返回主表的快照列表（最新的在前），每项为快照信息，快照目录保存在path键中"""
+        import json
+        snapshot_root = self.get_sidecar_path("snapshots")
+        if not os.path.isdir(snapshot_root):
+            return []
+        snapshots = []
+        for name in sorted(os.listdir(snapshot_root), reverse=True):
+            info_path = os.path.join(snapshot_root, name, "snapshot.json")
+            if name.startswith(".pending_") or not os.path.exists(info_path):
+                continue
+            with open(info_path, 'r', encoding='utf-8') as file:
+                snapshots.append(dict(json.load(file), path=os.path.join(snapshot_root, name)))
+        return snapshots
+
+    def prune_snapshots(self):
+        """只保留最新的keep个快照，并清理中断遗留的.pending_目录"""
+        import shutil
+        snapshot_root = self.get_sidecar_path("snapshots")
+        for name in os.listdir(snapshot_root):
+            if name.startswith(".pending_"):
+                shutil.rmtree(os.path.join(snapshot_root, name), ignore_errors=True)
+        for snapshot in self.list_snapshots()[self.snapshot_config["keep"]:]:
+            shutil.rmtree(snapshot["path"], ignore_errors=True)
+
+    def restore_snapshot(self, snapshot_dir):
+        """一步恢复快照：主表经同目录暂存文件原子替换（当前版本保留为previous_），辅助数据恢复为快照时的状态
+        
+        快照之后导出到列式数据集的分区文件一并删除；分片工作簿不在快照中，保持当前状态。
+        """
+        stem, ext = os.path.splitext(os.path.basename(self.main_file))
+        staged_path = os.path.join(os.path.dirname(os.path.abspath(self.main_file)), f".{stem}.restoring-{os.getpid()}{ext}")
+        clone_file(os.path.join(snapshot_dir, os.path.basename(self.main_file)), staged_path)
+        try:
+            self.verify_staged_workbook(staged_path)
+            self.commit_staged_workbook(staged_path, self.main_file)
+        finally:
+            if os.path.exists(staged_path):
+                os.remove(staged_path)
+        # 快照之后移入列式数据集的分区文件删除，使数据集与恢复后的主表一致
+        removed_parts = self.discard_columnar_files_after(snapshot_dir)
+        if removed_parts:
+            self.update_status(f"已从列式数据集中删除快照之后导出的{removed_parts}个分区文件")
+        # 快照之后才生成的辅助数据文件删除，快照中的文件先克隆到临时文件再替换
+        snapshot_files = set(os.listdir(snapshot_dir))
+        for file_name in self.list_sidecar_state_files():
+            if file_name not in snapshot_files:
+                os.remove(self.get_sidecar_path(file_name))
+        for file_name in snapshot_files:
+            if file_name in ("snapshot.json", os.path.basename(self.main_file)):
+                continue
+            target_path = self.get_sidecar_path(file_name)
+            clone_file(os.path.join(snapshot_dir, file_name), target_path + ".tmp")
+            os.replace(target_path + ".tmp", target_path)
+
+    def create_shard_workbook(self, app, shard_path):
+        """以主表为模板创建分片工作簿：保留表头、第2行的公式模板和其他工作表，清空各数据工作表的数据行"""
+        import shutil
+        shutil.copy2(self.main_file, shard_path)
+        shard_wb = app.books.open(shard_path)
+        sheet_names = [sheet.name for sheet in shard_wb.sheets]
+        for sheet_name, config in self.sheet_config.items():
+            if sheet_name not in sheet_names:
+                continue
+            sheet = shard_wb.sheets[sheet_name]
+            last_row = sheet.used_range.last_cell.row
+            if last_row >= 3:
+                sheet.range(f"3:{last_row}").delete(shift='up')
+            # 第2行只清空数据列和日期列，A列到公式结束列的公式作为模板保留
+            columns_count = sheet.range(f"{config['start_col']}1").expand('right').columns.count
+            sheet.range(f"{config['start_col']}2").resize(1, columns_count).clear_contents()
+            if config["date_col"] is not None:
+                sheet.range(f"{config['date_col']}2").clear_contents()
+        return shard_wb
+
+    def open_shard_target(self, app, sheet_name, shard_map, month, opened_shards):
+        """返回下一个可写入的分片（工作簿、工作表、追加起始行），当前分片已满时创建新分片
+        
+        参数:
+            shard_map: 分片记录，新建的分片原地追加
+            month: 按月分片时的月份（YYYY-MM），按大小分片时为None
+            opened_shards: 本次合并已打开的分片 {路径: 工作簿}，保存主表后统一填充公式并保存
+        """
+        max_rows = self.shard_config["max_rows"]
+        start_col = self.sheet_config[sheet_name]["start_col"]
+        shards = [shard for shard in shard_map.setdefault(sheet_name, []) if shard.get("month") == month]
+        if shards:
+            shard_path = shards[-1]["path"]
+            if shard_path not in opened_shards:
+                opened_shards[shard_path] = app.books.open(shard_path)
+            sheet = opened_shards[shard_path].sheets[sheet_name]
+            append_row = self.find_append_row(sheet, start_col)
+            if append_row <= max_rows:
+                return {"path": shard_path, "sheet": sheet, "row": append_row, "month": month}
+
+        # 当前分片已满或尚无分片，创建新分片
+        stem, ext = os.path.splitext(os.path.basename(self.main_file))
+        if month is None:
+            name = f"{stem}_{sheet_name}_分片{len(shard_map[sheet_name]) + 2}{ext}"
+        else:
+            name = f"{stem}_{sheet_name}_{month}{'_' + str(len(shards) + 1) if shards else ''}{ext}"
+        shard_path = os.path.join(os.path.dirname(os.path.abspath(self.main_file)), name)
+        self.update_status(f"{sheet_name}工作表行数达到分片阈值，正在创建分片工作簿：{name}")
+        opened_shards[shard_path] = self.create_shard_workbook(app, shard_path)
+        shard_map[sheet_name].append({"path": shard_path, "month": month,
+                                      "created_at": datetime.now().isoformat(timespec='seconds')})
+        return {"path": shard_path, "sheet": opened_shards[shard_path].sheets[sheet_name], "row": 2, "month": month}
+
+    def discard_new_shards(self, opened_shards, existing_shards, staged_shards):
+        """合并中止时关闭本次打开的分片工作簿，删除暂存的分片文件和本次新建的分片文件"""
+        for shard_path, shard_wb in opened_shards.items():
+            try:
+                shard_wb.close()
+            except Exception:
+                pass  # 已保存到暂存文件的分片已关闭
+            staged = staged_shards.get(shard_path)
+            if staged and os.path.exists(staged):
+                os.remove(staged)
+            if shard_path not in existing_shards and os.path.exists(shard_path):
+                os.remove(shard_path)
+
+    def commit_staged_shards(self, staged_shards):
+        """逐个用暂存文件替换分片工作簿，返回替换失败的分片列表[(分片路径, 暂存文件, 错误)]，失败的暂存文件保留"""
+        failed = []
+        for shard_path, staged in staged_shards.items():
+            try:
+                self.commit_staged_workbook(staged, shard_path)
+            except Exception as e:
+                self.update_status(f"错误：保存分片工作簿{os.path.basename(shard_path)}失败: {str(e)}，新数据保留在{staged}",
+                                   level='error')
+                failed.append((shard_path, staged, str(e)))
+        return failed
+
+    def report_verification(self, verify_targets):
+        """逐个工作表校验写入结果，在状态栏报告不一致、缺失和错位的行"""
+        verify_start = time.time()
+        problems = []
+        total_checked = 0
+        for (workbook_path, sheet_name), entry in verify_targets.items():
+            result = self.verify_written_rows(entry["sheet"], entry["start_col"], entry["columns"],
+                                              np.concatenate(entry["rows"]), np.concatenate(entry["hashes"]))
+            total_checked += result["checked"]
+            location = sheet_name if workbook_path == self.main_file else f"{os.path.basename(workbook_path)}/{sheet_name}"
+            for category, label in (("mismatched", "内容不一致"), ("missing", "缺失"), ("shifted", "错位")):
+                rows = result[category]
+                if rows:
+                    sample = ", ".join(str(row) for row in rows[:10])
+                    problems.append(f"{location}：{len(rows)}行{label}（第{sample}{'等' if len(rows) > 10 else ''}行）")
+
+        elapsed = time.time() - verify_start
+        if problems:
+            for problem in problems:
+                self.update_status(f"警告：写入校验发现问题 - {problem}", level='warning')
+            self.dialogs.showwarning("写入校验", "以下行的写入结果与副表数据不一致：\n" + "\n".join(problems))
+        else:
+            self.update_status(f"写入校验通过：{total_checked}行全部一致，耗时{elapsed:.2f}秒")
+
+    def load_lineage(self):
+        """加载主表旁的行来源记录：每个追加数据块的来源文件、工作表和起止行号"""
+        import json
+        lineage_path = self.get_sidecar_path("lineage.json")
+        if not os.path.exists(lineage_path):
+            return []
+        with open(lineage_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def save_lineage(self, lineage):
+        """保存行来源记录，先写入临时文件再替换"""
+        import json
+        lineage_path = self.get_sidecar_path("lineage.json")
+        temp_path = lineage_path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(lineage, file, ensure_ascii=False, indent=1)
+        os.replace(temp_path, lineage_path)
+
+    def write_updated_rows(self, sheet, start_col, target_rows, values, date_col=None, date_value=None, derived=None):
+        """将按键更新的行写回主表原位置，行号连续的部分合并为一次写入"""
+        order = np.argsort(target_rows, kind='stable')
+        sorted_rows = target_rows[order]
+        sorted_values = values[order]
+        # 在行号不连续的位置切分，每段连续行只需一次写入
+        breaks = np.flatnonzero(np.diff(sorted_rows) != 1) + 1
+        run_starts = np.concatenate([[0], breaks])
+        for run_start, run_rows, run_values in zip(run_starts, np.split(sorted_rows, breaks), np.split(sorted_values, breaks)):
+            first_row = int(run_rows[0])
+            last_row = int(run_rows[-1])
+            sheet.range(f"{start_col}{first_row}").options(index=False, header=False).value = run_values
+            if date_col is not None:
+                sheet.range(f"{date_col}{first_row}:{date_col}{last_row}").value = [[date_value] for _ in range(len(run_rows))]
+            if derived is not None and len(derived.columns) > 0:
+                run_order = order[run_start:run_start + len(run_rows)]
+                self.write_derived_columns(sheet, first_row, derived.iloc[run_order])
+
+    def load_fingerprint_index(self, sheet_name, columns_count):
+        """加载主表工作表已合并行的指纹索引（升序去重的uint64数组，每行仅占8字节）
+        
+        索引文件不存在时，根据加载主表时读取的现有数据一次性建立索引。
+        """
+        index_path = self.get_sidecar_path(f"fingerprints_{sheet_name}.npy")
+        if os.path.exists(index_path):
+            return np.load(index_path)
+
+        existing = self.main_data.get(sheet_name)
+        if existing is None or existing.empty:
+            return np.empty(0, dtype=np.uint64)
+
+        # 主表数据从配置的起始列开始，只取与副表相同数量的数据列
+        start_col_offset = ord(self.sheet_config[sheet_name]["start_col"]) - ord('A')
+        existing = existing.iloc[:, start_col_offset:start_col_offset + columns_count].dropna(how='all')
+        self.update_status(f"正在为{sheet_name}工作表建立已合并行指纹索引（{len(existing)}行）...", level='debug')
+        return np.unique(self.compute_row_fingerprints(existing))
+
+    def save_fingerprint_index(self, sheet_name, fingerprints):
+        """保存指纹索引，先写入临时文件再替换，避免中断时损坏索引"""
+        index_path = self.get_sidecar_path(f"fingerprints_{sheet_name}.npy")
+        temp_path = index_path + ".tmp"
+        with open(temp_path, 'wb') as file:
+            np.save(file, fingerprints)
+        os.replace(temp_path, index_path)
+
+    def get_block_fingerprint_path(self, sheet_name, file_id):
+        """返回某个来源文件本次加入指纹索引的指纹文件路径"""
+        import hashlib
+        digest = hashlib.sha1(f"{sheet_name}\x1f{file_id}".encode('utf-8')).hexdigest()[:16]
+        return self.get_sidecar_path(f"lineage_fingerprints_{digest}.npy")
+
+    def save_block_fingerprints(self, sheet_name, file_id, fingerprints):
+        """保存来源文件加入指纹索引的指纹（与已有记录合并），先写入临时文件再替换"""
+        index_path = self.get_block_fingerprint_path(sheet_name, file_id)
+        if os.path.exists(index_path):
+            fingerprints = np.union1d(np.load(index_path), fingerprints)
+        temp_path = index_path + ".tmp"
+        with open(temp_path, 'wb') as file:
+            np.save(file, fingerprints)
+        os.replace(temp_path, index_path)
+
+    def get_columnar_export_dir(self):
+        """返回列式数据集的根目录"""
+        if self.columnar_export_dir:
+            return self.columnar_export_dir
+        stem = os.path.splitext(os.path.basename(self.main_file))[0]
+        return os.path.join(os.path.dirname(os.path.abspath(self.main_file)), f"{stem}_columnar")
+
+    def infer_columnar_schema(self, sheet_name, df):
+        """根据第一段导出数据确定工作表的列式数据集结构：数值列为double，日期时间列为timestamp，其余列为string
+        
+        列名和类型在首次导出时固定，保存在数据集的工作表目录中（_schema.json），之后每次导出都转换为该结构，
+        同一工作表的所有分区文件结构一致。
+        """
+        columns = []
+        for position in range(df.shape[1]):
+            series = df.iloc[:, position]
+            if pd.api.types.is_bool_dtype(series):
+                dtype = "string"
+            elif pd.api.types.is_numeric_dtype(series):
+                dtype = "double"
+            elif pd.api.types.is_datetime64_any_dtype(series):
+                dtype = "timestamp"
+            else:
+                dtype = "string"
+            columns.append([str(df.columns[position]), dtype])
+        columns += [["_source_file", "string"], ["_source_id", "string"], ["_merged_at", "string"]]
+        if self.sheet_config[sheet_name]["date_col"] is not None:
+            columns.append(["_file_date", "int64"])
+        return columns
+
+    def load_columnar_schema(self, sheet_name):
+        """读取数据集中已固定的工作表结构，尚未导出过时返回None"""
+        import json
+        schema_path = os.path.join(self.get_columnar_export_dir(), sheet_name, "_schema.json")
+        if not os.path.exists(schema_path):
+            return None
+        with open(schema_path, 'r', encoding='utf-8') as file:
+            return json.load(file)["columns"]
+
+    def cast_columnar_piece(self, sheet_name, df, schema):
+        """按固定结构转换一段导出数据（数据列按位置对应），返回(pyarrow表, 无法转换而置空的值数量)"""
+        import pyarrow as pa
+        data_columns = [column for column in schema if not column[0].startswith("_")]
+        if len(data_columns) != df.shape[1]:
+            raise Exception(f"{sheet_name}列式数据集有{len(data_columns)}个数据列，本次写入的数据有{df.shape[1]}列，"
+                            f"请为新的列结构使用新的数据集目录")
+        arrays = {}
+        lost = 0
+        for position, (name, dtype) in enumerate(data_columns):
+            series = df.iloc[:, position].reset_index(drop=True)
+            if dtype == "double":
+                converted = pd.to_numeric(series, errors='coerce').astype('float64')
+            elif dtype == "timestamp":
+                converted = self.parse_date_series(series)
+            else:
+                converted = series.astype(object).where(series.isna(), series.astype(str))
+                converted = converted.where(converted.notna(), None)
+            lost += int((series.notna() & converted.isna()).sum())
+            arrays[name] = converted
+        table = pd.DataFrame(arrays)
+        for name, _ in schema:
+            if name.startswith("_"):
+                table[name] = df.attrs.get(name)
+        pa_types = {"double": pa.float64(), "timestamp": pa.timestamp("ns"), "string": pa.string(), "int64": pa.int64()}
+        pa_schema = pa.schema([(name, pa_types[dtype]) for name, dtype in schema])
+        return pa.Table.from_pandas(table, schema=pa_schema, preserve_index=False), lost
+
+    def export_columnar_piece(self, export_state, sheet_name, df, file_path, date_value=None, source_id=None):
+        """将一段写入主表的数据转换为工作表的固定结构，按月分区追加到暂存目录中的分区文件，主表保存成功后再移入数据集
         
-        # 使用预编译的正则表达式替换所有单元格引用
-        adjusted_formula = self._cell_ref_pattern.sub(adjust_cell_ref, formula)
+        每次合并每个分区只生成一个文件，各数据段作为该文件的行组依次写入，不在内存中累积。
+        月份优先取文件名日期（日期列来自文件名的工作表），其次取按日期顺序合并配置的日期列，
+        都没有时使用本次合并的月份。
+        """
+        import pyarrow.parquet as pq
+        if len(df) == 0:
+            return
+        if sheet_name not in export_state["schemas"]:
+            schema = self.load_columnar_schema(sheet_name)
+            export_state["schemas"][sheet_name] = (schema or self.infer_columnar_schema(sheet_name, df), schema is None)
+        schema = export_state["schemas"][sheet_name][0]
+
+        work = df.copy(deep=False)
+        work.attrs = {"_source_file": os.path.basename(file_path), "_source_id": source_id or os.path.basename(file_path),
+                      "_merged_at": export_state["merged_at"],
+                      "_file_date": date_value if isinstance(date_value, int) else None}
+        order_col = self.order_columns.get(sheet_name)
+        if isinstance(date_value, int):
+            months = pd.Series(f"{str(date_value)[:4]}-{str(date_value)[4:6]}", index=df.index)
+        elif order_col and order_col in df.columns:
+            months = self.parse_date_series(df[order_col]).dt.strftime("%Y-%m").fillna("unknown")
+        else:
+            months = pd.Series(export_state["merged_at"][:7], index=df.index)
+
+        if export_state["pending_dir"] is None:
+            import tempfile
+            root_dir = self.get_columnar_export_dir()
+            os.makedirs(root_dir, exist_ok=True)
+            # 暂存目录与数据集位于同一磁盘，移入时只需重命名
+            export_state["pending_dir"] = tempfile.mkdtemp(prefix=".pending_", dir=root_dir)
+
+        for month, positions in pd.Series(np.arange(len(work))).groupby(months.to_numpy(), sort=False):
+            part = work.iloc[positions.to_numpy()]
+            part.attrs = work.attrs
+            table, lost = self.cast_columnar_piece(sheet_name, part, schema)
+            if lost:
+                self.update_status(f"警告：{os.path.basename(file_path)}中有{lost}个值与{sheet_name}列式数据集的列类型不符，已导出为空值",
+                                   level='warning')
+            writer_key = (sheet_name, month)
+            if writer_key not in export_state["writers"]:
+                relative_path = os.path.join(sheet_name, f"month={month}",
+                                             f"part-{export_state['merged_at'].replace(':', '')}-{export_state['token']}.parquet")
+                pending_path = os.path.join(export_state["pending_dir"], relative_path)
+                os.makedirs(os.path.dirname(pending_path), exist_ok=True)
+                export_state["writers"][writer_key] = pq.ParquetWriter(pending_path, table.schema, compression="zstd")
+                export_state["files"].append(relative_path)
+            export_state["writers"][writer_key].write_table(table)
+
+    def start_columnar_export(self):
+        """开始一次列式数据集导出，清理上次中断遗留的暂存目录"""
+        import shutil
+        root_dir = self.get_columnar_export_dir()
+        if os.path.isdir(root_dir):
+            for name in os.listdir(root_dir):
+                if name.startswith(".pending_"):
+                    shutil.rmtree(os.path.join(root_dir, name), ignore_errors=True)
+        import uuid
+        # 文件名中的随机标识避免同一秒内的两次合并生成同名分区文件
+        return {"pending_dir": None, "merged_at": datetime.now().isoformat(timespec='seconds'), "token": uuid.uuid4().hex[:8],
+                "files": [], "writers": {}, "schemas": {}}
+
+    def close_columnar_writers(self, export_state):
+        """关闭本次导出打开的全部分区文件"""
+        writers, export_state["writers"] = export_state["writers"], {}
+        for writer in writers.values():
+            writer.close()
+
+    def commit_columnar_export(self, export_state):
+        """将暂存的分区文件移入数据集目录（已有的分区文件不会被改写），并在辅助数据目录的导出记录中登记"""
+        import json
+        import shutil
+        self.close_columnar_writers(export_state)
+        if export_state["pending_dir"] is None:
+            return
+        root_dir = self.get_columnar_export_dir()
+        # 首次导出的工作表保存固定的列结构
+        for sheet_name, (schema, is_new) in export_state["schemas"].items():
+            if is_new:
+                schema_path = os.path.join(root_dir, sheet_name, "_schema.json")
+                os.makedirs(os.path.dirname(schema_path), exist_ok=True)
+                with open(schema_path + ".tmp", 'w', encoding='utf-8') as file:
+                    json.dump({"columns": schema}, file, ensure_ascii=False, indent=1)
+                os.replace(schema_path + ".tmp", schema_path)
+        for relative_path in export_state["files"]:
+            final_path = os.path.join(root_dir, relative_path)
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.replace(os.path.join(export_state["pending_dir"], relative_path), final_path)
+        shutil.rmtree(export_state["pending_dir"], ignore_errors=True)
+        if export_state["files"]:
+            log = self.load_columnar_log()
+            log.append({"root": root_dir, "merged_at": export_state["merged_at"], "files": export_state["files"]})
+            self.save_columnar_log(log)
+            self.update_status(f"已向列式数据集追加{len(export_state['files'])}个分区文件：{root_dir}")
+
+    def discard_columnar_export(self, export_state):
+        """合并失败时丢弃暂存的分区文件"""
+        import shutil
+        if not export_state:
+            return
+        try:
+            self.close_columnar_writers(export_state)
+        except Exception:
+            pass  # 暂存目录随后整体删除
+        if export_state["pending_dir"]:
+            shutil.rmtree(export_state["pending_dir"], ignore_errors=True)
+
+    def load_columnar_log(self):
+        """加载辅助数据目录中的列式数据集导出记录：每次合并移入数据集的分区文件"""
+        import json
+        log_path = self.get_sidecar_path("columnar.json")
+        if not os.path.exists(log_path):
+            return []
+        with open(log_path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    def save_columnar_log(self, log):
+        """保存列式数据集导出记录，先写入临时文件再替换"""
+        import json
+        log_path = self.get_sidecar_path("columnar.json")
+        with open(log_path + ".tmp", 'w', encoding='utf-8') as file:
+            json.dump(log, file, ensure_ascii=False, indent=1)
+        os.replace(log_path + ".tmp", log_path)
+
+    def remove_columnar_rows(self, sheet_names, source_id):
+        """撤销合并时从列式数据集中删除某个来源文件导出的行，返回删除的行数
         
-        return adjusted_formula
+        只读取各分区文件的_source_id列判断是否包含该文件的行，包含时过滤后经临时文件替换，行全部删除时删除该分区文件。
+        """
+        import glob
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+        root_dir = self.get_columnar_export_dir()
+        removed_rows = 0
+        legacy_files = 0
+        for sheet_name in sheet_names:
+            for path in glob.glob(os.path.join(root_dir, glob.escape(sheet_name), "month=*", "*.parquet")):
+                if "_source_id" not in pq.read_schema(path).names:
+                    legacy_files += 1
+                    continue
+                matches = pc.equal(pq.read_table(path, columns=["_source_id"])["_source_id"], source_id)
+                count = pc.sum(matches).as_py() or 0
+                if count == 0:
+                    continue
+                table = pq.read_table(path)
+                kept = table.filter(pc.invert(pc.fill_null(matches, False)))
+                if kept.num_rows == 0:
+                    os.remove(path)
+                else:
+                    pq.write_table(kept, path + ".tmp", compression="zstd")
+                    os.replace(path + ".tmp", path)
+                removed_rows += count
+        if legacy_files:
+            self.update_status(f"警告：列式数据集中有{legacy_files}个早期导出的分区文件没有来源标识，其中的行需要手动删除", level='warning')
+        return removed_rows
+
+    def discard_columnar_files_after(self, snapshot_dir):
+        """恢复快照时删除快照之后移入列式数据集的分区文件，返回删除的文件数"""
+        import json
+        snapshot_log_path = os.path.join(snapshot_dir, "columnar.json")
+        kept = []
+        if os.path.exists(snapshot_log_path):
+            with open(snapshot_log_path, 'r', encoding='utf-8') as file:
+                kept = json.load(file)
+        kept_files = {os.path.join(entry["root"], path) for entry in kept for path in entry["files"]}
+        removed = 0
+        for entry in self.load_columnar_log():
+            for relative_path in entry["files"]:
+                path = os.path.join(entry["root"], relative_path)
+                if path not in kept_files and os.path.exists(path):
+                    os.remove(path)
+                    removed += 1
+        return removed
 
     def detect_encoding(self, file_path):
         """检测文件编码"""
@@ -101,12 +3402,16 @@ class ExcelMerger:
             return df
         except Exception as e:
             try:
-                # 如果失败，尝试使用xlwings读取
-                app = xw.App(visible=False)
-                wb = app.books.open(file_path)
-                df = wb.sheets[0].used_range.options(pd.DataFrame, index=False).value
-                wb.close()
-                app.quit()
+                # 如果失败，尝试使用xlwings读取（实例从池中租借，批量加载时只启动一次Excel）
+                app = self.create_excel_app()
+                try:
+                    wb = app.books.open(file_path)
+                    df = wb.sheets[0].used_range.options(pd.DataFrame, index=False).value
+                    wb.close()
+                except Exception:
+                    self.release_excel_app(app, failed=True)
+                    raise
+                self.release_excel_app(app)
                 return df
             except Exception as e2:
                 # 尝试使用其他引擎读取
@@ -139,13 +3444,13 @@ class ExcelMerger:
                 import urllib.parse
                 file_path = urllib.parse.unquote(file_path)
         except Exception as e:
-            messagebox.showerror("错误", f"处理文件路径时出错：\n{str(e)}\n\n原始路径：{event.data}")
+            self.dialogs.showerror("错误", f"处理文件路径时出错：\n{str(e)}\n\n原始路径：{event.data}")
             return
             
         if os.path.isfile(file_path) and file_path.lower().endswith(('.xlsx', '.xls', '.xlsm', '.et', '.ett')):
             self.load_main_file(file_path)  # 直接传递文件路径
         else:
-            messagebox.showerror("错误", "请拖放有效的Excel文件！")
+            self.dialogs.showerror("错误", "请拖放有效的Excel文件！")
 
     def on_drop_sub(self, event, sheet_name):
         """处理副表文件的拖放事件"""
@@ -160,7 +3465,7 @@ class ExcelMerger:
                 import urllib.parse
                 file_path = urllib.parse.unquote(file_path)
         except Exception as e:
-            messagebox.showerror("错误", f"处理文件路径时出错：\n{str(e)}\n\n原始路径：{event.data}")
+            self.dialogs.showerror("错误", f"处理文件路径时出错：\n{str(e)}\n\n原始路径：{event.data}")
             return
             
         if os.path.isfile(file_path):
@@ -169,9 +3474,15 @@ class ExcelMerger:
 
                 # 初始化或重置该工作表的副表数据
                 if sheet_name not in self.sub_data:
-                    self.sub_data[sheet_name] = pd.DataFrame()
+                    self.sub_data[sheet_name] = self.create_sub_store(sheet_name)
                     self.sub_files[sheet_name] = []
 
+                # 解析前检查该文件是否已合并或已加载
+                file_hash, skip_reason = self.check_sub_file(file_path, self.load_merge_manifest())
+                if skip_reason:
+                    self.update_status(f"已跳过{os.path.basename(file_path)}：{skip_reason}", level='warning')
+                    return
+
                 # 加载拖放的文件
                 if file_path.lower().endswith('.csv'):
                     try:
@@ -182,18 +3493,20 @@ class ExcelMerger:
                 else:
                     df = self.load_excel_file(file_path)
 
-                # 将当前文件的数据添加到该工作表的副表数据中
-                self.sub_data[sheet_name] = pd.concat([self.sub_data[sheet_name], df], ignore_index=True)
+                # 将当前文件的数据作为新数据块追加，不复制已加载的数据
+                self.sub_data[sheet_name].append(df, file_path, file_hash)
                 self.sub_files[sheet_name].append(file_path)
+                del df
+                self.enforce_memory_budget()
 
                 total_rows = len(self.sub_data[sheet_name])
                 loaded_files = "\n".join([os.path.basename(f) for f in self.sub_files[sheet_name]])
                 self.update_status(f"{sheet_name}副表文件加载成功\n已加载的文件：\n{loaded_files}\n总行数：{total_rows}")
 
             except Exception as e:
-                messagebox.showerror("错误", f"加载文件 {os.path.basename(file_path)} 时出错：\n{str(e)}")
+                self.dialogs.showerror("错误", f"加载文件 {os.path.basename(file_path)} 时出错：\n{str(e)}")
         else:
-            messagebox.showerror("错误", "请拖放有效的Excel或CSV文件！")
+            self.dialogs.showerror("错误", "请拖放有效的Excel或CSV文件！")
 
     def update_status(self, message, level='info'):
         """更新状态信息
@@ -214,6 +3527,10 @@ class ExcelMerger:
         if self.debug_mode.get() or level != 'debug':
             print(f"[{level.upper()}] {message}")
         
+        # 命令行模式下只输出到控制台
+        if self.status_text is None:
+            return
+
         # 在GUI中显示消息
         # 启用文本框编辑
         self.status_text.configure(state='normal')
@@ -239,7 +3556,12 @@ class ExcelMerger:
         self.main_file = None
         self.sub_files = {}
         self.main_data = {}
+        # 暂存库中尚未合并的文件一并删除
+        for store in self.sub_data.values():
+            if isinstance(store, DuckDBStagingStore):
+                store.discard_pending()
         self.sub_data = {}
+        self.cleanup_spill_dir()
         print("已清理所有已加载的文件数据")
         self.update_status("已清理所有文件，请重新选择文件")
         
@@ -258,7 +3580,10 @@ class ExcelMerger:
         
         if not file_paths:  # 如果用户取消选择，直接返回
             return
+        self.load_sub_file_paths(file_paths)
 
+    def load_sub_file_paths(self, file_paths):
+        """按文件名中的关键词识别副表类型并加载，批量导入和命令行模式共用"""
         try:
             self.update_status("正在批量加载副表文件...")
             
@@ -268,6 +3593,10 @@ class ExcelMerger:
             recognized_files = 0
             unrecognized_files = []
             
+            # 合并清单用于在解析前跳过已合并过的文件
+            manifest = self.load_merge_manifest()
+            skipped_files = []
+            
             # 第一步：根据文件名分类文件
             categorized_files = {sheet: [] for sheet in self.file_keywords.keys()}
             
@@ -296,17 +3625,23 @@ class ExcelMerger:
                 
                 # 初始化或重置该工作表的副表数据
                 if sheet_name not in self.sub_data:
-                    self.sub_data[sheet_name] = pd.DataFrame()
+                    self.sub_data[sheet_name] = self.create_sub_store(sheet_name)
                     self.sub_files[sheet_name] = []
                 
-                # 批量处理文件，减少DataFrame合并次数
-                batch_dfs = []
+                # 每个文件作为一个数据块追加，不再合并DataFrame
+                loaded_count = 0
                 error_count = 0
                 
                 for file_path in files:
                     try:
                         self.update_status(f"正在加载文件: {os.path.basename(file_path)}", level='debug')
                         
+                        # 解析前检查该文件是否已合并或已加载
+                        file_hash, skip_reason = self.check_sub_file(file_path, manifest)
+                        if skip_reason:
+                            skipped_files.append(f"{os.path.basename(file_path)}：{skip_reason}")
+                            continue
+                        
                         if file_path.lower().endswith('.csv'):
                             try:
                                 # 首先尝试使用系统默认编码读取
@@ -319,30 +3654,30 @@ class ExcelMerger:
                             # 尝试使用通用Excel加载函数
                             df = self.load_excel_file(file_path)
 
-                        # 将DataFrame添加到批处理列表中
-                        batch_dfs.append(df)
+                        # 将DataFrame作为数据块追加到累加器中
+                        self.sub_data[sheet_name].append(df, file_path, file_hash)
                         self.sub_files[sheet_name].append(file_path)
+                        loaded_count += 1
+                        del df
+                        self.enforce_memory_budget()
                         
                     except Exception as e:
                         error_count += 1
                         error_msg = f"加载文件 {os.path.basename(file_path)} 时出错：\n{str(e)}"
                         self.update_status(error_msg, level='error')
                         if error_count <= 3:  # 只显示前3个错误
-                            messagebox.showerror("错误", error_msg)
+                            self.dialogs.showerror("错误", error_msg)
                         continue
                 
-                # 一次性合并所有DataFrame
-                if batch_dfs:
-                    if sheet_name in self.sub_data and not self.sub_data[sheet_name].empty:
-                        # 如果已有数据，添加到现有数据
-                        all_dfs = [self.sub_data[sheet_name]] + batch_dfs
-                        self.sub_data[sheet_name] = pd.concat(all_dfs, ignore_index=True)
-                    else:
-                        # 如果是首次加载，直接合并所有批次
-                        self.sub_data[sheet_name] = pd.concat(batch_dfs, ignore_index=True)
-                    
+                # 汇总该类别的加载结果
+                if loaded_count > 0:
                     total_rows = len(self.sub_data[sheet_name])
-                    self.update_status(f"{sheet_name}副表加载完成，共{len(files)-error_count}个文件，{total_rows}行数据")
+                    self.update_status(f"{sheet_name}副表加载完成，共{loaded_count}个文件，{total_rows}行数据")
+            
+            # 显示已跳过的文件
+            if skipped_files:
+                self.update_status(f"警告：已跳过{len(skipped_files)}个已合并或已加载的文件：\n" + "\n".join(skipped_files[:5]) +
+                                   (f"\n...等共{len(skipped_files)}个文件" if len(skipped_files) > 5 else ""), level='warning')
             
             # 显示未识别的文件
             if unrecognized_files:
@@ -362,10 +3697,22 @@ class ExcelMerger:
                 self.update_status("批量导入完成，但未能识别任何文件类型。请检查文件名是否包含正确的关键词。")
                 
         except Exception as e:
-            messagebox.showerror("错误", f"批量加载副表文件时出错：\n{str(e)}\n\n请确保：\n1. 文件未被其他程序占用\n2. 文件格式正确\n3. 文件未损坏\n4. CSV文件编码格式正确")
+            self.dialogs.showerror("错误", f"批量加载副表文件时出错：\n{str(e)}\n\n请确保：\n1. 文件未被其他程序占用\n2. 文件格式正确\n3. 文件未损坏\n4. CSV文件编码格式正确")
+
+    def setup_headless(self):
+        """命令行模式：选项使用默认值，状态信息输出到控制台，对话框消息输出到控制台"""
+        self.root = None
+        self.status_text = None
+        self.dialogs = ConsoleDialogs()
+        for name, value in self.option_defaults.items():
+            setattr(self, name, OptionValue(value))
+        self.workbook_backend = OptionValue(self.default_backend)
 
     def setup_gui(self):
         """设置GUI界面"""
+        # 拖放支持只有界面模式需要，命令行模式不导入
+        from tkinterdnd2 import TkinterDnD
+        self.dialogs = messagebox
         self.root = TkinterDnD.Tk()
         self.root.title("Excel文件合并工具 v1.4")
         self.root.geometry("500x800")
@@ -373,7 +3720,7 @@ class ExcelMerger:
         
         # 初始化debug_mode变量
         if self.debug_mode is None:
-            self.debug_mode = tk.BooleanVar(value=False)
+            self.debug_mode = tk.BooleanVar(value=self.option_defaults["debug_mode"])
         
         # 创建主框架
         main_frame = ttk.Frame(self.root, padding=10)
@@ -417,10 +3764,10 @@ class ExcelMerger:
         sub_files_frame.pack(fill=tk.X, pady=10)
 
         # 初始化复选框变量
-        self.merge_marketing = tk.BooleanVar(value=True)
-        self.merge_internal = tk.BooleanVar(value=True)
-        self.merge_external = tk.BooleanVar(value=True)
-        self.merge_shop = tk.BooleanVar(value=True)
+        self.merge_marketing = tk.BooleanVar(value=self.option_defaults["merge_marketing"])
+        self.merge_internal = tk.BooleanVar(value=self.option_defaults["merge_internal"])
+        self.merge_external = tk.BooleanVar(value=self.option_defaults["merge_external"])
+        self.merge_shop = tk.BooleanVar(value=self.option_defaults["merge_shop"])
 
         # 创建副表选择的函数
         def create_sub_file_frame(parent, text, var, sheet_name):
@@ -469,6 +3816,55 @@ class ExcelMerger:
         clear_button = ttk.Button(buttons_container, text="清理所有文件", width=15, command=self.clear_all_files)
         clear_button.pack(side=tk.RIGHT, padx=10, expand=True)
 
+        # 第二行按钮
+        buttons_container2 = ttk.Frame(button_frame)
+        buttons_container2.pack(pady=5, fill=tk.X)
+
+        # 撤销文件合并按钮
+        rollback_button = ttk.Button(buttons_container2, text="撤销文件合并", width=15, command=self.show_rollback_dialog)
+        rollback_button.pack(side=tk.LEFT, padx=10, expand=True)
+
+        # 恢复合并前快照按钮
+        snapshot_button = ttk.Button(buttons_container2, text="恢复快照", width=15, command=self.show_snapshot_dialog)
+        snapshot_button.pack(side=tk.RIGHT, padx=10, expand=True)
+
+        # 合并选项区域
+        options_frame = ttk.LabelFrame(main_frame, text="合并选项", padding=10)
+        options_frame.pack(fill=tk.X, pady=10)
+
+        # 跳过已合并过的重复行（基于主表旁持久化的行指纹索引）
+        self.skip_duplicates = tk.BooleanVar(value=self.option_defaults["skip_duplicates"])
+        ttk.Checkbutton(options_frame, text="跳过已合并过的重复行", variable=self.skip_duplicates).grid(row=0, column=0, sticky=tk.W, padx=10, pady=2)
+
+        # 按文件名日期（及配置的日期列）顺序合并
+        self.ordered_merge = tk.BooleanVar(value=self.option_defaults["ordered_merge"])
+        ttk.Checkbutton(options_frame, text="按日期顺序合并", variable=self.ordered_merge).grid(row=0, column=1, sticky=tk.W, padx=10, pady=2)
+
+        # 按汇总配置在写入前聚合副表数据
+        self.aggregate_before_merge = tk.BooleanVar(value=self.option_defaults["aggregate_before_merge"])
+        ttk.Checkbutton(options_frame, text="合并前按配置汇总", variable=self.aggregate_before_merge).grid(row=1, column=0, sticky=tk.W, padx=10, pady=2)
+
+        # 按派生列配置直接写入计算值，代替逐行填充公式
+        self.write_computed_values = tk.BooleanVar(value=self.option_defaults["write_computed_values"])
+        ttk.Checkbutton(options_frame, text="派生列写入计算值", variable=self.write_computed_values).grid(row=1, column=1, sticky=tk.W, padx=10, pady=2)
+
+        # 合并后在主表旁追加按月分区的列式数据集，供下游分析直接读取
+        self.export_columnar = tk.BooleanVar(value=self.option_defaults["export_columnar"])
+        ttk.Checkbutton(options_frame, text="导出列式数据集", variable=self.export_columnar).grid(row=2, column=0, sticky=tk.W, padx=10, pady=2)
+
+        # 保存前读回写入区域，按行哈希校验写入结果（需要额外读回全部新行，默认关闭）
+        self.verify_after_merge = tk.BooleanVar(value=self.option_defaults["verify_after_merge"])
+        ttk.Checkbutton(options_frame, text="合并后校验写入结果", variable=self.verify_after_merge).grid(row=2, column=1, sticky=tk.W, padx=10, pady=2)
+
+        # 写入引擎选择
+        backend_row = ttk.Frame(options_frame)
+        backend_row.grid(row=3, column=0, columnspan=2, sticky=tk.W, padx=10, pady=2)
+        ttk.Label(backend_row, text="写入引擎：").pack(side=tk.LEFT)
+        self.workbook_backend = tk.StringVar(value=self.default_backend)
+        backend_values = (["xlwings"] if xw is not None else []) + ["openpyxl", "zip"]
+        ttk.Combobox(backend_row, textvariable=self.workbook_backend, values=backend_values,
+                     state="readonly", width=10).pack(side=tk.LEFT)
+
         # 状态信息区域
         status_frame = ttk.LabelFrame(main_frame, text="状态信息", padding=10)
         status_frame.pack(fill=tk.BOTH, expand=True, pady=10)
@@ -501,6 +3897,9 @@ class ExcelMerger:
         # 设置为只读模式
         self.status_text.configure(state='disabled')
 
+        # 恢复暂存库中尚未合并的副表文件
+        self.restore_staged_files()
+
         self.root.mainloop()
 
     def load_main_file(self, file_path=None):
@@ -534,7 +3933,7 @@ class ExcelMerger:
                 
                 missing_sheets = [sheet for sheet in required_sheets if sheet not in excel_file.sheet_names]
                 if missing_sheets:
-                    messagebox.showerror("错误", f"主表文件中未找到以下工作表：\n{', '.join(missing_sheets)}\n请确保文件包含正确的工作表。")
+                    self.dialogs.showerror("错误", f"主表文件中未找到以下工作表：\n{', '.join(missing_sheets)}\n请确保文件包含正确的工作表。")
                     return
 
                 # 读取选中的工作表
@@ -544,7 +3943,7 @@ class ExcelMerger:
             except Exception as e:
                 # 如果pandas读取失败，尝试使用xlwings读取
                 try:
-                    app = xw.App(visible=False)
+                    app = self.create_excel_app()
                     wb = app.books.open(file_path)
                     sheet_names = [sheet.name for sheet in wb.sheets]
                     
@@ -561,8 +3960,8 @@ class ExcelMerger:
                     missing_sheets = [sheet for sheet in required_sheets if sheet not in sheet_names]
                     if missing_sheets:
                         wb.close()
-                        app.quit()
-                        messagebox.showerror("错误", f"主表文件中未找到以下工作表：\n{', '.join(missing_sheets)}\n请确保文件包含正确的工作表。")
+                        self.release_excel_app(app)
+                        self.dialogs.showerror("错误", f"主表文件中未找到以下工作表：\n{', '.join(missing_sheets)}\n请确保文件包含正确的工作表。")
                         return
 
                     # 读取选中的工作表
@@ -570,17 +3969,22 @@ class ExcelMerger:
                         self.main_data[sheet_name] = wb.sheets[sheet_name].used_range.options(pd.DataFrame, index=False).value
 
                     wb.close()
-                    app.quit()
+                    self.release_excel_app(app)
 
                 except Exception as e2:
-                    messagebox.showerror("错误", f"无法读取主表文件，请确保文件格式正确。\n错误详情：\n{str(e)}\n{str(e2)}")
+                    # 打开或读取失败的实例不放回池中
+                    try:
+                        self.release_excel_app(app, failed=True)
+                    except Exception:
+                        pass
+                    self.dialogs.showerror("错误", f"无法读取主表文件，请确保文件格式正确。\n错误详情：\n{str(e)}\n{str(e2)}")
                     return
 
             self.main_file = file_path
             sheet_info = "\n".join([f"{sheet}：{len(data)}行" for sheet, data in self.main_data.items()])
             self.update_status(f"主表文件加载成功\n文件路径：{file_path}\n{sheet_info}")
         except Exception as e:
-            messagebox.showerror("错误", f"加载主表文件时出错：\n{str(e)}\n\n请确保：\n1. 文件未被其他程序占用\n2. 文件格式正确\n3. 文件未损坏")
+            self.dialogs.showerror("错误", f"加载主表文件时出错：\n{str(e)}\n\n请确保：\n1. 文件未被其他程序占用\n2. 文件格式正确\n3. 文件未损坏")
 
     def load_sub_file(self, sheet_name):
         """加载指定工作表的副表文件"""
@@ -603,22 +4007,31 @@ class ExcelMerger:
             
             # 初始化或重置该工作表的副表数据
             if sheet_name not in self.sub_data:
-                self.sub_data[sheet_name] = pd.DataFrame()
+                self.sub_data[sheet_name] = self.create_sub_store(sheet_name)
                 self.sub_files[sheet_name] = []
 
-            # 批量处理文件，减少DataFrame合并次数
-            batch_dfs = []
+            # 每个文件作为一个数据块追加，避免重复复制已加载的数据
             file_count = len(file_paths)
             loaded_count = 0
             error_count = 0
             total_rows = 0
             
+            # 合并清单用于在解析前跳过已合并过的文件
+            manifest = self.load_merge_manifest()
+            skipped_files = []
+            
             # 循环处理每个选中的文件
             for i, file_path in enumerate(file_paths):
                 try:
                     # 只在调试模式下显示每个文件的加载信息
                     self.update_status(f"正在加载文件({i+1}/{file_count}): {os.path.basename(file_path)}", level='debug')
                     
+                    # 解析前检查该文件是否已合并或已加载
+                    file_hash, skip_reason = self.check_sub_file(file_path, manifest)
+                    if skip_reason:
+                        skipped_files.append(f"{os.path.basename(file_path)}：{skip_reason}")
+                        continue
+                    
                     if file_path.lower().endswith('.csv'):
                         try:
                             # 首先尝试使用系统默认编码读取
@@ -631,11 +4044,13 @@ class ExcelMerger:
                         # 尝试使用通用Excel加载函数
                         df = self.load_excel_file(file_path)
 
-                    # 将DataFrame添加到批处理列表中，而不是每次都合并
-                    batch_dfs.append(df)
+                    # 将DataFrame作为数据块追加到累加器中，而不是每次都合并
+                    self.sub_data[sheet_name].append(df, file_path, file_hash)
                     self.sub_files[sheet_name].append(file_path)
                     loaded_count += 1
                     total_rows += len(df)
+                    del df
+                    self.enforce_memory_budget()
 
                 except Exception as e:
                     error_count += 1
@@ -643,19 +4058,9 @@ class ExcelMerger:
                     self.update_status(error_msg, level='error')
                     # 只在错误较少时显示错误对话框，避免大量文件时弹出过多对话框
                     if error_count <= 3:
-                        messagebox.showerror("错误", error_msg)
+                        self.dialogs.showerror("错误", error_msg)
                     continue
 
-            # 一次性合并所有DataFrame，提高效率
-            if batch_dfs:
-                if sheet_name in self.sub_data and not self.sub_data[sheet_name].empty:
-                    # 如果已有数据，添加到现有数据
-                    all_dfs = [self.sub_data[sheet_name]] + batch_dfs
-                    self.sub_data[sheet_name] = pd.concat(all_dfs, ignore_index=True)
-                else:
-                    # 如果是首次加载，直接合并所有批次
-                    self.sub_data[sheet_name] = pd.concat(batch_dfs, ignore_index=True)
-            
             # 汇总加载结果
             if loaded_count > 0:
                 # 只显示前5个文件名，如果超过5个则显示省略号
@@ -669,12 +4074,17 @@ class ExcelMerger:
                                   (f"\n已加载的文件：\n{displayed_files}" if self.debug_mode.get() else ""), 
                                   level='info')
             
+            # 显示已跳过的文件
+            if skipped_files:
+                self.update_status(f"警告：已跳过{len(skipped_files)}个已合并或已加载的文件：\n" + "\n".join(skipped_files[:5]) +
+                                   (f"\n...等共{len(skipped_files)}个文件" if len(skipped_files) > 5 else ""), level='warning')
+            
             # 如果有错误，显示汇总信息
             if error_count > 0:
                 self.update_status(f"警告：{error_count}个文件加载失败，已跳过这些文件", level='warning')
 
         except Exception as e:
-            messagebox.showerror("错误", f"加载副表文件时出错：\n{str(e)}\n\n请确保：\n1. 文件未被其他程序占用\n2. 文件格式正确\n3. 文件未损坏\n4. CSV文件编码格式正确")
+            self.dialogs.showerror("错误", f"加载副表文件时出错：\n{str(e)}\n\n请确保：\n1. 文件未被其他程序占用\n2. 文件格式正确\n3. 文件未损坏\n4. CSV文件编码格式正确")
 
     def safe_apply_formula(self, sheet, range_str, formulas, retry_on_error=True, max_retries=3):
         """安全地应用公式，处理可能的外部引用错误"""
@@ -724,7 +4134,7 @@ class ExcelMerger:
         
         return False, "达到最大重试次数"
     
-    def fill_sheet_formula(self, wb, target_sheet_name, end_column='F'):
+    def fill_sheet_formula(self, wb, target_sheet_name, end_column='F', skip_columns=(), planned_columns=()):
         """在指定工作表的A到指定结束列填充公式 - 通用版
         
         此函数实现了Excel工作表的"前置填充"功能，可以自动将模板行(通常是第2行)的公式复制并应用到后续所有数据行。
@@ -743,6 +4153,8 @@ class ExcelMerger:
             target_sheet_name: 目标工作表名称，支持模糊匹配
             end_column: 结束列，默认为'F'，可以根据工作表类型设置为'E'或其他列
                        例如：'E'表示处理A到E列的公式
+            skip_columns: 不填充公式的列，这些列已在合并时写入计算值
+            planned_columns: 公式已按写入计划随数据一起写入新行的列，不再填充
         
         返回:
             无直接返回值，处理结果通过update_status方法反馈给用户界面
@@ -801,9 +4213,20 @@ class ExcelMerger:
             used_range = sheet.used_range
             last_row = used_range.last_cell.row
             self.update_status(f"工作表最后一行为第{last_row}行")
+            # zip追加写入引擎中已有行的公式保持不变，只为新追加的行生成公式
+            first_fill_row = max(3, getattr(sheet, "original_last_row", 2) + 1)
             
             # 定义需要处理的列，从A列到指定的结束列
             columns = [chr(ord('A') + i) for i in range(ord(end_column) - ord('A') + 1)]
+            if skip_columns:
+                columns = [col for col in columns if col not in skip_columns]
+                self.update_status(f"{', '.join(skip_columns)}列已写入计算值，跳过公式填充")
+            if planned_columns:
+                columns = [col for col in columns if col not in planned_columns]
+                self.update_status(f"{', '.join(planned_columns)}列的公式已随数据写入，跳过公式填充")
+            if not columns:
+                self.update_status(f"{target_sheet_name}工作表没有需要填充公式的列")
+                return
             
             # 从第3行开始填充到最后一行
             if last_row > 2:  # 确保有数据行需要填充
@@ -812,134 +4235,91 @@ class ExcelMerger:
                 # 预编译正则表达式以提高性能
                 external_ref_pattern = re.compile(r'\[.*?\].*?!')
                 
-                # 创建一个缓存字典，用于存储已经计算过的公式调整结果
-                formula_cache = {}
+                total_rows = last_row - first_fill_row + 1
+                max_retries = 3  # 添加重试次数限制，避免无限循环
+                results = []
                 
-                # 定义一个函数来处理单列的公式填充
-                def process_column(col):
-                    col_start_time = time.time()
-                    
-                    # 获取第2行的公式（作为模板）
-                    template_cell = sheet.range(f'{col}2')
-                    template_formula = template_cell.formula
-                    
-                    # 如果当前列没有公式，尝试检查第1行
+                # 所有工作表操作由当前线程（打开工作簿的线程）作为唯一执行者依次执行，
+                # 工作线程只生成公式文本并提交写入命令，行范围相同的相邻列合并为一次写入
+                actor = WorkbookActor(sheet)
+                
+                # 读取各列第2行的公式（作为模板），当前列没有公式时检查第1行
+                templates = {}
+                for col in columns:
+                    template_formula = sheet.range(f'{col}2').formula
                     if not template_formula:
                         template_formula = sheet.range(f'{col}1').formula
-                        if not template_formula:
-                            return f"{col}列没有可用的公式模板，已跳过"
-                    
-                    # 检查是否包含外部工作簿引用
-                    has_external_ref = external_ref_pattern.search(template_formula) is not None
-                    
-                    # 根据是否包含外部引用调整批处理大小
-                    # 增加批处理大小，但对外部引用保持较小的批量以确保稳定性
-                    batch_size = 400 if has_external_ref else 3000  # 外部引用使用较小的批处理大小
-                    total_rows = last_row - 2
+                    if not template_formula:
+                        results.append(f"{col}列没有可用的公式模板，已跳过")
+                        continue
+                    templates[col] = template_formula
+                
+                # 各列的处理结果：成功行数、失败行数和出错信息
+                column_stats = {col: {"success": 0, "fail": 0, "error": None,
+                                      "external": external_ref_pattern.search(template) is not None}
+                                for col, template in templates.items()}
+                
+                def apply_external_batch(col, start_idx, end_idx, formulas):
+                    """写入一批包含外部引用的公式（由执行者线程调用），批量失败时逐行回退"""
+                    stats = column_stats[col]
+                    range_str = f"{col}{start_idx}:{col}{end_idx}"
+                    success, error_msg = self.safe_apply_formula(sheet, range_str, formulas, True, max_retries)
+                    if success:
+                        stats["success"] += end_idx - start_idx + 1
+                        return
+                    # 如果批量应用失败，尝试使用较小的批次或单行应用
+                    self.update_status(f"警告：{col}列批量设置公式时出错({error_msg})，尝试单行处理...", level='warning')
                     
-                    # 添加重试次数限制，避免无限循环
-                    max_retries = 3
+                    # 增加更新频率，大幅减少UI更新次数
+                    update_frequency = 100
                     
-                    if has_external_ref:
-                        # 对于包含外部引用的公式，需要为每行生成调整后的公式
-                        batches = (total_rows + batch_size - 1) // batch_size  # 向上取整
-                        
-                        # 提取外部工作簿路径，用于错误处理
-                        external_workbook_match = re.search(r'\[([^\]]+)\]', template_formula)
-                        external_workbook_name = external_workbook_match.group(1) if external_workbook_match else "未知外部工作簿"
-                        
-                        # 记录成功和失败的行数
-                        success_count = 0
-                        fail_count = 0
-                        
+                    # 逐行设置公式，即使部分失败也继续处理
+                    for i, row in enumerate(range(start_idx, end_idx + 1)):
                         try:
-                            for batch in range(batches):
-                                start_idx = 3 + batch * batch_size
-                                end_idx = min(start_idx + batch_size - 1, last_row)
-                                
-                                # 使用列表推导式优化公式生成
-                                formulas = []
-                                for row in range(start_idx, end_idx + 1):
-                                    # 使用缓存减少重复计算
-                                    cache_key = (template_formula, 2, row)
-                                    if cache_key not in formula_cache:
-                                        formula_cache[cache_key] = self.adjust_formula_for_row(template_formula, 2, row)
-                                    formulas.append([formula_cache[cache_key]])
-                                
-                                # 使用安全应用公式函数
-                                range_str = f"{col}{start_idx}:{col}{end_idx}"
-                                success, error_msg = self.safe_apply_formula(sheet, range_str, formulas, True, max_retries)
-                                
-                                if success:
-                                    success_count += (end_idx - start_idx + 1)
-                                else:
-                                    # 如果批量应用失败，尝试使用较小的批次或单行应用
-                                    self.update_status(f"警告：{col}列批量设置公式时出错({error_msg})，尝试单行处理...", level='warning')
-                                    
-                                    # 增加更新频率，大幅减少UI更新次数
-                                    update_frequency = 100
-                                    
-                                    # 逐行设置公式，即使部分失败也继续处理
-                                    for i, row in enumerate(range(start_idx, end_idx + 1)):
-                                        try:
-                                            # 单行设置公式
-                                            formula = formulas[i][0]
-                                            single_range = f"{col}{row}"
-                                            single_success, _ = self.safe_apply_formula(sheet, single_range, [formula], False, 1)
-                                            
-                                            if single_success:
-                                                success_count += 1
-                                            else:
-                                                fail_count += 1
-                                                
-                                            # 大幅减少状态更新频率，只在调试模式下更新
-                                            if i % update_frequency == 0 and i > 0:
-                                                # 每处理一定数量的行就更新一下状态
-                                                self.update_status(f"正在处理{col}列，已成功{success_count}行，失败{fail_count}行...", level='debug')
-                                        except Exception:
-                                            # 如果单行设置也失败，记录错误但继续处理
-                                            fail_count += 1
-                                
-                                # 主动清理内存
-                                if len(formula_cache) > 5000:  # 降低缓存阈值，更频繁地清理内存
-                                    formula_cache.clear()
-                                    gc.collect()
-                                    
-                            # 批次处理完成后，报告结果
-                            if fail_count > 0:
-                                self.update_status(f"{col}列公式填充完成，成功{success_count}行，失败{fail_count}行")
-                                if external_workbook_match:
-                                    self.update_status(f"提示：失败可能是因为找不到外部工作簿 '{external_workbook_name}'，请确保该文件存在且可访问")
-                            
-                        except Exception as outer_exc:
-                            # 处理整个批处理过程中的异常
-                            return f"{col}列公式填充过程中出错: {str(outer_exc)[:150]}，已尽可能填充部分数据(成功{success_count}行，失败{fail_count}行)"
-                    else:
-                        # 对于不包含外部引用的普通公式，也需要为每行生成调整后的公式
-                        # 使用批处理方式提高效率
+                            single_success, _ = self.safe_apply_formula(sheet, f"{col}{row}", [formulas[i][0]], False, 1)
+                            if single_success:
+                                stats["success"] += 1
+                            else:
+                                stats["fail"] += 1
+                            # 大幅减少状态更新频率，只在调试模式下更新
+                            if i % update_frequency == 0 and i > 0:
+                                self.update_status(f"正在处理{col}列，已成功{stats['success']}行，失败{stats['fail']}行...", level='debug')
+                        except Exception:
+                            # 如果单行设置也失败，记录错误但继续处理
+                            stats["fail"] += 1
+                
+                # 定义一个函数来生成单列的公式（在工作线程中运行，不访问工作表）
+                def generate_column(col):
+                    try:
+                        template_formula = templates[col]
+                        has_external_ref = column_stats[col]["external"]
+                        
+                        # 根据是否包含外部引用调整批处理大小
+                        # 增加批处理大小，但对外部引用保持较小的批量以确保稳定性
+                        batch_size = 400 if has_external_ref else 3000  # 外部引用使用较小的批处理大小
                         batches = (total_rows + batch_size - 1) // batch_size  # 向上取整
                         
                         for batch in range(batches):
-                            start_idx = 3 + batch * batch_size
+                            start_idx = first_fill_row + batch * batch_size
                             end_idx = min(start_idx + batch_size - 1, last_row)
                             
-                            # 使用列表推导式优化公式生成
-                            formulas = []
-                            for row in range(start_idx, end_idx + 1):
-                                # 使用缓存减少重复计算
-                                cache_key = (template_formula, 2, row)
-                                if cache_key not in formula_cache:
-                                    formula_cache[cache_key] = self.adjust_formula_for_row(template_formula, 2, row)
-                                formulas.append([formula_cache[cache_key]])
+                            # 每行的公式只生成一次，不需要缓存
+                            formulas = [self.adjust_formula_for_row(template_formula, 2, row) for row in range(start_idx, end_idx + 1)]
                             
-                            # 应用公式
-                            range_str = f"{col}{start_idx}:{col}{end_idx}"
-                            sheet.range(range_str).formula = formulas
-                    
-                    col_end_time = time.time()
-                    return f"已成功在{target_sheet_name}工作表{col}列填充公式，共处理{last_row-2}行，耗时{col_end_time-col_start_time:.2f}秒"
+                            if has_external_ref:
+                                # 外部引用的公式保留原有的安全写入和单行回退策略
+                                actor.submit(("call", partial(apply_external_batch, col, start_idx, end_idx, [[f] for f in formulas])))
+                            else:
+                                actor.submit(("formula", column_index(col), start_idx, end_idx, formulas))
+                    finally:
+                        # 通知执行者本列的命令已全部提交
+                        actor.submit(None)
+                
+                def on_write_error(cols, error):
+                    for col in cols:
+                        column_stats[column_letter(col)]["error"] = error
                 
-                # 动态线程管理 - 根据系统资源状态自动调整线程数量
+                # 动态线程管理 - 根据系统资源状态自动调整生成公式的线程数量
                 def get_optimal_thread_count():
                     # 获取CPU核心数
                     cpu_count = multiprocessing.cpu_count()
@@ -962,52 +4342,49 @@ class ExcelMerger:
                         thread_count = max(4, min(cpu_count, 8))
                     
                     # 确保线程数不超过列数
-                    thread_count = min(thread_count, len(columns))
+                    thread_count = max(1, min(thread_count, len(templates)))
                     
                     # 记录系统状态和线程决策（仅调试模式）
                     self.update_status(f"系统状态: CPU使用率={cpu_usage}%, 内存使用率={memory_usage}%, 选择线程数={thread_count}", level='debug')
                     
                     return thread_count
                 
-                # 使用线程池并行处理多列
-                results = []
-                self.update_status(f"开始并行处理{len(columns)}列公式填充...", level='info')
-                
-                # 动态确定最佳线程数
+                # 工作线程并行生成公式，当前线程依次执行写入命令
                 thread_count = get_optimal_thread_count()
-                self.update_status(f"使用{thread_count}个线程并行处理{len(columns)}列公式填充...", level='info')
+                self.update_status(f"使用{thread_count}个线程生成{len(templates)}列公式，由单一执行者写入工作表...", level='info')
                 with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:
-                    # 提交所有列的处理任务
-                    future_to_col = {executor.submit(process_column, col): col for col in columns}
-                    
-                    # 收集结果
-                    for future in concurrent.futures.as_completed(future_to_col):
-                        col = future_to_col[future]
+                    future_to_col = {executor.submit(generate_column, col): col for col in templates}
+                    actor.run(len(future_to_col), on_write_error)
+                    for future, col in future_to_col.items():
                         try:
-                            # 增加超时处理，防止某一列长时间阻塞
-                            result = future.result(timeout=300)  # 设置5分钟超时
-                            results.append(result)
-                            # 只在调试模式下输出每列完成的详细信息
-                            self.update_status(f"已完成{col}列公式填充", level='debug')
-                        except concurrent.futures.TimeoutError:
-                            # 处理超时情况
-                            results.append(f"{col}列处理超时，可能是外部引用导致，已跳过该列")
-                            self.update_status(f"警告：{col}列处理时间过长，已跳过。请检查外部引用是否可访问。", level='warning')
+                            future.result()
                         except Exception as exc:
-                            # 处理其他异常
-                            error_str = str(exc).lower()
-                            if "apple event timed out" in error_str or "oserror: -1712" in error_str:
-                                results.append(f"{col}列处理时出错: Apple event超时，可能是外部工作簿引用问题")
-                                self.update_status(f"警告：{col}列处理时出现Apple event超时，已跳过该列。请确保外部引用的工作簿可访问。", level='warning')
-                            elif "找不到" in error_str or "not found" in error_str or "cannot find" in error_str:
-                                results.append(f"{col}列处理时出错: 找不到引用的外部工作簿")
-                                self.update_status(f"警告：{col}列处理时找不到引用的外部工作簿，已跳过该列。", level='warning')
-                            else:
-                                results.append(f"{col}列处理时出错: {exc}")
-                                self.update_status(f"处理{col}列时出错: {exc}", level='error')
+                            column_stats[col]["error"] = exc
+                
+                # 汇总各列的结果
+                for col, stats in column_stats.items():
+                    exc = stats["error"]
+                    if exc is not None:
+                        error_str = str(exc).lower()
+                        if "apple event timed out" in error_str or "oserror: -1712" in error_str:
+                            results.append(f"{col}列处理时出错: Apple event超时，可能是外部工作簿引用问题")
+                            self.update_status(f"警告：{col}列处理时出现Apple event超时，已跳过该列。请确保外部引用的工作簿可访问。", level='warning')
+                        elif "找不到" in error_str or "not found" in error_str or "cannot find" in error_str:
+                            results.append(f"{col}列处理时出错: 找不到引用的外部工作簿")
+                            self.update_status(f"警告：{col}列处理时找不到引用的外部工作簿，已跳过该列。", level='warning')
+                        else:
+                            results.append(f"{col}列处理时出错: {exc}")
+                            self.update_status(f"处理{col}列时出错: {exc}", level='error')
+                        continue
+                    if stats["fail"] > 0:
+                        self.update_status(f"{col}列公式填充完成，成功{stats['success']}行，失败{stats['fail']}行")
+                        external_workbook_match = re.search(r'\[([^\]]+)\]', templates[col])
+                        if external_workbook_match:
+                            self.update_status(f"提示：失败可能是因为找不到外部工作簿 '{external_workbook_match.group(1)}'，请确保该文件存在且可访问")
+                    results.append(f"已成功在{target_sheet_name}工作表{col}列填充公式，共处理{total_rows}行")
+                self.update_status(f"公式写入共{actor.calls}次调用，合并了{actor.submitted}个批次", level='debug')
                 
-                # 清理缓存和内存
-                formula_cache.clear()
+                # 清理内存
                 gc.collect()
                 
                 total_end_time = time.time()
@@ -1053,6 +4430,25 @@ class ExcelMerger:
             if not self.debug_mode.get():
                 self.update_status(f"如需查看详细错误信息，请启用调试模式。", level='info')
 
+    def check_zip_backend_support(self):
+        """选择zip写入引擎时，检查本次合并是否用到该引擎不支持的按键更新和分片，返回不支持的项目列表"""
+        if self.workbook_backend.get() != "zip":
+            return []
+        selected = {"全站营销": self.merge_marketing.get(), "站内数据源": self.merge_internal.get(),
+                    "站外数据源": self.merge_external.get(), "店铺成交数据源": self.merge_shop.get()}
+        shard_map = self.load_shard_map()
+        unsupported = []
+        for sheet_name, sub_store in self.sub_data.items():
+            if not selected.get(sheet_name) or sheet_name not in self.main_data:
+                continue
+            if self.upsert_keys.get(sheet_name):
+                unsupported.append(f"{sheet_name}：按键更新（已配置键列{', '.join(self.upsert_keys[sheet_name])}）")
+            if shard_map.get(sheet_name):
+                unsupported.append(f"{sheet_name}：写入已有的分片工作簿")
+            elif len(self.main_data[sheet_name]) + 1 + len(sub_store) > self.shard_config["max_rows"]:
+                unsupported.append(f"{sheet_name}：追加后超过{self.shard_config['max_rows']}行，需要创建分片工作簿")
+        return unsupported
+
     def merge_files(self):
         """工作表更新功能 - 将副表数据合并填充到主表
         
@@ -1071,25 +4467,70 @@ class ExcelMerger:
         - 店铺成交数据源：数据从H列开始，G列填充日期，公式填充A-F列
         """
         if not self.main_data or not self.sub_data:
-            messagebox.showerror("错误", "请先加载主表和副表文件！")
+            self.dialogs.showerror("错误", "请先加载主表和副表文件！")
             return
 
         if not any([self.merge_marketing.get(), self.merge_internal.get(), self.merge_external.get(), self.merge_shop.get()]):
-            messagebox.showerror("错误", "请至少选择一个要合并的工作表！")
+            self.dialogs.showerror("错误", "请至少选择一个要合并的工作表！")
+            return
+
+        unsupported = self.check_zip_backend_support()
+        if unsupported:
+            self.dialogs.showerror("错误", "zip追加写入引擎只支持在末尾追加新行，本次合并需要：\n" + "\n".join(unsupported)
+                                   + "\n\n请在写入引擎中选择openpyxl或xlwings")
             return
 
+        # 出错时需要清理的对象在try之前初始化
+        app = None
+        wb = None
+        bulk_session = None
+        columnar_export = None
+        opened_shards = {}
+        existing_shards = set()
+        staged_shards = {}
         try:
             self.update_status("正在处理数据...")
             start_time = time.time()
 
             # 使用xlwings打开主表文件以保持公式和格式
             # 注意：这是工作表更新功能的关键步骤，使用xlwings而非pandas是为了保留Excel公式
-            app = xw.App(visible=False)
+            app = self.create_excel_app()
             wb = app.books.open(self.main_file)
+            # 批量写入期间暂停重算、屏幕刷新和事件，保存前只重算写入过的工作表
+            bulk_session = self.begin_bulk_session(app)
 
             # 工作表更新功能的核心循环：遍历所有副表数据并合并到对应的主表工作表
             selected_sheets = []
-            for sheet_name, sub_data in self.sub_data.items():
+            pending_fingerprints = {}
+            pending_block_fingerprints = {}
+            pending_key_indexes = {}
+            # 本次追加的数据块来源记录，保存成功后写入行来源记录
+            lineage_blocks = []
+            # 合并清单：跳过已合并过的文件，并在保存成功后记录本次合并的文件
+            manifest = self.load_merge_manifest()
+            merged_sources = {}
+            self.lookup_cache = {}
+            # 暂存保存：主表先保存到同目录的暂存文件，校验后再替换原文件
+            staged_path = None
+            master_staging = False
+            master_committed = False
+            # 分片记录和本次打开的分片工作簿
+            shard_map = self.load_shard_map()
+            # 合并前已存在的分片，合并中止时只删除本次新建的分片
+            existing_shards = {shard["path"] for shards in shard_map.values() for shard in shards}
+            shard_map_changed = False
+            # 写入计划：(工作簿路径, 工作表) -> 计划，已随数据写入公式的列不再由fill_sheet_formula填充
+            write_plans = {}
+            # 写入校验：(工作簿路径, 工作表) -> {"sheet", "start_col", "columns", "rows": [...], "hashes": [...]}
+            verify_targets = {} if self.verify_after_merge.get() else None
+            if verify_targets is not None and isinstance(app, ZipAppendApp):
+                # zip追加写入引擎读回的是自身缓冲的新行，校验无法发现写入问题，保存后的文件由暂存校验检查
+                self.update_status("警告：zip追加写入引擎不支持写入校验，本次跳过校验", level='warning')
+                verify_targets = None
+            # 列式数据集导出：写入主表的数据段先按月分区写入暂存目录，保存成功后再移入数据集
+            if self.export_columnar.get():
+                columnar_export = self.start_columnar_export()
+            for sheet_name, sub_store in self.sub_data.items():
                 # 检查工作表是否被用户选中进行合并
                 # 工作表更新功能支持选择性合并，用户可以决定哪些工作表需要更新
                 if sheet_name == "全站营销" and not self.merge_marketing.get():
@@ -1107,151 +4548,250 @@ class ExcelMerger:
                 
                 selected_sheets.append(sheet_name)
 
-                # 获取当前工作表对象和使用范围
+                # 获取当前工作表对象，只探测表头，不读取已有数据（代价与主表大小无关）
                 self.update_status(f"开始处理 {sheet_name} 工作表...", level='info')
                 main_sheet = wb.sheets[sheet_name]
-                main_range = main_sheet.used_range
                 
-                # 【工作表更新功能】根据配置字典确定数据起始列偏移
+                # 【工作表更新功能】根据配置字典确定数据起始列
                 # 不同类型的工作表有不同的数据结构，前面的列通常包含公式或标识信息
                 start_col = self.sheet_config[sheet_name]["start_col"]
-                # 将列字母转换为偏移量（A=0, B=1, ...）
-                start_col_offset = ord(start_col) - ord('A')
-                    
-                # 从指定列偏移开始提取主表现有数据
-                raw_data = main_range.offset(0, start_col_offset).options(pd.DataFrame, index=False, expand='table').value
-                main_data_from_g = pd.DataFrame(raw_data)
-                original_columns_count = len(main_data_from_g.columns)  # 记录原始列数，用于后续列数匹配检查
-
-                # 【工作表更新功能-特殊处理】检查是否需要从文件名中提取日期并填充到指定列
-                # 这是工作表更新功能的一个特殊处理逻辑，针对需要日期信息提取的工作表
-                date_col = self.sheet_config[sheet_name]["date_col"]
-                if date_col is not None:
-                    # 获取主表当前数据的行数和副表的行数，用于确定填充位置
-                    main_data_rows = len(main_data_from_g)
-                    sub_data_rows = len(sub_data)
-                    # 计算G列需要填充的起始行和结束行
-                    # 从主表数据后的下一行开始，保留一行空行作为分隔
-                    start_row = main_data_rows + 2
-                    
-                    # 从每个文件名中提取日期信息并填充对应的行
-                    # 日期格式预期为文件名中的8位数字，如：_20230101_
-                    import re
-                    g_col_data = []
-                    current_row = 0
-                    
-                    # 【工作表更新功能-日期提取】遍历每个副表文件，提取日期信息
-                    for file_path in self.sub_files[sheet_name]:
-                        # 读取当前文件的数据，支持CSV和Excel格式
-                        if file_path.lower().endswith('.csv'):
-                            try:
-                                # 首先尝试使用默认编码读取CSV
-                                df = pd.read_csv(file_path)
-                            except UnicodeDecodeError:
-                                # 如果出现编码错误，自动检测编码并重试
-                                encoding = self.detect_encoding(file_path)
-                                df = pd.read_csv(file_path, encoding=encoding)
-                        else:
-                            # 使用通用Excel加载函数处理各种Excel格式
-                            df = self.load_excel_file(file_path)
-                        
-                        # 【工作表更新功能-智能日期提取】从文件名中提取日期
-                        # 预期格式：文件名中包含_YYYYMMDD_格式的日期
-                        file_name = os.path.basename(file_path)
-                        date_match = re.search(r'_([0-9]{8})_', file_name)
-                        if date_match:
-                            # 成功提取到日期，转换为整数格式
-                            date_value = int(date_match.group(1))
-                        else:
-                            print(f"警告：未能从文件名中提取到日期信息: {file_name}，使用固定值'error'")
-                            self.update_status(f"警告：未能从文件名中提取到日期信息: {file_name}，使用固定值'error'")
-                            date_value = "error"
-                        
-                        # 为当前文件的每一行数据添加对应的日期
-                        file_rows = len(df)
-                        g_col_data.extend([[date_value] for _ in range(file_rows)])
-                        current_row += file_rows
-                    
-                    # 填充日期列数据
-                    end_row = start_row + len(g_col_data) - 1
-                    main_sheet.range(f"{date_col}{start_row}:{date_col}{end_row}").value = g_col_data
-
-                # 【工作表更新功能-数据清理】优化列名处理
-                # 处理可能存在的空列名，确保所有列都有有效名称
-                if main_data_from_g.columns.isnull().any():
-                    main_data_from_g.columns = [f"Column_{i+1}" if pd.isnull(col) else col 
-                                               for i, col in enumerate(main_data_from_g.columns)]
-
-                # 【工作表更新功能-数据清理】优化空列处理
-                # 确保只有当整列（包括表头）都为空时才删除，避免误删有用数据
-                empty_columns = main_data_from_g.isna().all() & main_data_from_g.columns.isna()
-                if empty_columns.any():
-                    # 记录非空列的索引，用于筛选保留的列
-                    valid_columns = ~empty_columns
-                    # 确保至少保留一列数据，防止数据结构丢失
-                    if valid_columns.any():
-                        main_data_from_g = main_data_from_g.loc[:, valid_columns]
-                    else:
-                        # 如果所有列都是空的，保持原样并发出警告
-                        print(f"警告：{sheet_name}工作表所有列都是空的，保持原始数据结构")
-                        self.update_status(f"警告：{sheet_name}工作表所有列都是空的，保持原始数据结构")
-
-                # 优化空行处理，只处理连续的空行
-                empty_rows = main_data_from_g.isna().all(axis=1)
-                if empty_rows.any():
-                    # 找到第一个完全空行的索引
-                    first_empty_row_idx = empty_rows.idxmax()
-                    # 检查是否所有后续行都是空行
-                    if empty_rows[first_empty_row_idx:].all():
-                        main_data_from_g = main_data_from_g.iloc[:first_empty_row_idx]
-                        print(f"信息：从第{first_empty_row_idx}行开始检测到连续空行，已截断数据")
-                        self.update_status(f"信息：从第{first_empty_row_idx}行开始检测到连续空行，已截断数据")
+                header = self.probe_header(main_sheet, start_col)
+                original_columns_count = len(header)  # 记录原始列数，用于后续列数匹配检查
 
                 # 检查数据有效性
-                if main_data_from_g.shape[1] == 0:
-                    wb.close()
-                    app.quit()
-                    messagebox.showerror("错误", f"{sheet_name}工作表从G列开始没有有效的数据列，请检查数据格式！")
+                if original_columns_count == 0:
+                    self.abort_merge(app, wb, bulk_session, columnar_export, opened_shards, existing_shards, staged_shards)
+                    self.dialogs.showerror("错误", f"{sheet_name}工作表从{start_col}列开始没有有效的数据列，请检查数据格式！")
                     return
 
 
-                # 检查列数匹配，使用原始列数进行比较
-                if original_columns_count != len(sub_data.columns):
-                    wb.close()
-                    app.quit()
-                    messagebox.showerror("错误", f"{sheet_name}工作表列数不匹配: 主表={original_columns_count}, 副表={len(sub_data.columns)}")
-                    return
-
-                # 重命名副表列名
-                sub_data.columns = main_data_from_g.columns
+                # 合并前汇总：主表列数应与汇总输出的列数一致
+                aggregate_spec = self.aggregate_config.get(sheet_name) if self.aggregate_before_merge.get() else None
+                if aggregate_spec and self.sheet_config[sheet_name]["date_col"] is not None:
+                    self.update_status(f"警告：{sheet_name}工作表的日期列来自文件名，不支持合并前汇总，将写入原始行", level='warning')
+                    aggregate_spec = None
+                if aggregate_spec:
+                    aggregate_columns_count = len(self.get_aggregate_columns(aggregate_spec))
+                    if original_columns_count != aggregate_columns_count:
+                        self.abort_merge(app, wb, bulk_session, columnar_export, opened_shards, existing_shards, staged_shards)
+                        self.dialogs.showerror("错误", f"{sheet_name}工作表列数不匹配: 主表={original_columns_count}, 汇总输出={aggregate_columns_count}")
+                        return
+                else:
+                    # 检查列数匹配，使用原始列数逐块比较（数据块可能已溢出到磁盘，不整体物化）
+                    for file_path, columns_count in sub_store.file_column_counts():
+                        if original_columns_count != columns_count:
+                            self.abort_merge(app, wb, bulk_session, columnar_export, opened_shards, existing_shards, staged_shards)
+                            self.dialogs.showerror("错误", f"{sheet_name}工作表列数不匹配: 主表={original_columns_count}, 副表={columns_count}\n文件：{os.path.basename(file_path)}")
+                            return
 
-                # 直接合并数据，不进行重复性检查
+                # 按键更新模式：加载键索引，键已存在的行在原位置覆盖
+                key_cols = self.upsert_keys.get(sheet_name)
+                if key_cols:
+                    first_columns = sub_store.chunks[0]["columns"] if sub_store.chunks else []
+                    missing_keys = [col for col in key_cols if col not in first_columns]
+                    if missing_keys:
+                        self.abort_merge(app, wb, bulk_session, columnar_export, opened_shards, existing_shards, staged_shards)
+                        self.dialogs.showerror("错误", f"{sheet_name}工作表的副表中找不到键列：{', '.join(missing_keys)}")
+                        return
+                    key_positions = [first_columns.index(col) for col in key_cols]
+                    key_index = self.load_key_index(sheet_name, key_positions)
+                    updated_count = 0
 
-                # 合并数据
-                merged_data_from_g = pd.concat([main_data_from_g, sub_data], 
-                                             axis=0, copy=False).reset_index(drop=True)
+                # 加载已合并行的指纹索引，用于过滤与历史数据重复的行
+                skip_duplicates = self.skip_duplicates.get()
+                if skip_duplicates:
+                    dedupe_state = {"seen": self.load_fingerprint_index(sheet_name, original_columns_count), "duplicates": 0,
+                                    "by_chunk": {}}
+                    # 来源文件 -> 其行所在的原始数据块序号（汇总数据块为参与汇总的全部数据块）
+                    fingerprint_owners = {}
 
-                # 找到指定列最后一个非空单元格的位置
+                # 找到指定列最后一个非空单元格的位置，在其后追加新数据
                 # 使用配置字典获取起始列
                 start_col = self.sheet_config[sheet_name]["start_col"]
-                
-                # 获取指定列的所有值
-                col_values = main_sheet.range(f"{start_col}1").expand('down').value
-                
-                # 找到最后一个非空单元格的位置
-                last_non_empty_row = 1  # 默认从第一行开始
-                for i, value in enumerate(col_values, 1):
-                    if value is not None and str(value).strip() != "":
-                        last_non_empty_row = i
-                
-                # 在最后一个非空单元格后追加新数据
-                append_start_row = last_non_empty_row + 1
+                append_start_row = self.find_append_row(main_sheet, start_col)
+
+                # 写入目标：默认写入主表；该工作表已分片时直接写入当前分片
+                shard_max_rows = self.shard_config["max_rows"]
+                if key_cols and shard_map.get(sheet_name):
+                    raise Exception(f"{sheet_name}工作表已分片，不支持按键更新")
+                target = {"path": self.main_file, "sheet": main_sheet, "row": append_start_row, "month": None}
+                if shard_max_rows and shard_map.get(sheet_name):
+                    target = None
 
-                # 根据配置字典决定数据写入的起始列
+                # 根据配置字典决定数据写入的起始列和日期列
                 start_col = self.sheet_config[sheet_name]["start_col"]
-                main_sheet.range(f"{start_col}{append_start_row}").options(index=False, header=False).value = sub_data.values
+                date_col = self.sheet_config[sheet_name]["date_col"]
+                write_stats = self.new_write_stats()
+
+                # 逐段流式写入副表数据，已溢出到磁盘的数据块按需读回，峰值内存只取决于单个数据块
+                # 按日期顺序合并时，各段已按日期排好序
+                current_row = append_start_row
+                date_values = {}
+                write_buffer = None
+                merge_chunks = self.select_merge_chunks(sub_store, manifest)
+                if aggregate_spec and isinstance(sub_store, DuckDBStagingStore) and not skip_duplicates:
+                    # 使用暂存库且无需按原始行去重时，汇总直接在库内以SQL完成
+                    pieces = sub_store.iter_aggregated_pieces(sheet_name, merge_chunks, aggregate_spec,
+                                                              self.get_aggregate_columns(aggregate_spec))
+                else:
+                    pieces = self.iter_merge_pieces(sheet_name, sub_store, merge_chunks)
+                    # 过滤已合并过的重复行（在汇总之前按原始行过滤）
+                    if skip_duplicates:
+                        pieces = self.filter_duplicate_pieces(pieces, dedupe_state)
+                    # 合并前汇总，所有数据段汇总为一个数据段
+                    if aggregate_spec:
+                        pieces = self.aggregate_pieces(sheet_name, pieces, aggregate_spec)
+                # 派生列写入计算值：每段数据在写入前按配置的步骤计算A列到公式结束列的值
+                transform_steps = self.transform_config.get(sheet_name) if self.get_computed_columns(sheet_name) else None
+                for chunk, chunk_df in pieces:
+                    file_path = chunk["file"]
+
+                    # 【工作表更新功能-特殊处理】从文件名中提取日期，用于填充日期列（每个文件只提取一次）
+                    if date_col is not None and chunk["seq"] not in date_values:
+                        date_values[chunk["seq"]] = self.extract_file_date(file_path)
+                    date_value = date_values.get(chunk["seq"])
+
+                    derived_df = None
+                    if transform_steps and len(chunk_df) > 0:
+                        chunk_df, derived_df = self.apply_transforms(sheet_name, chunk_df, transform_steps)
+
+                    # 按键更新的行同样追加到列式数据集，下游按键取_merged_at最新的行即可
+                    if columnar_export is not None:
+                        self.export_columnar_piece(columnar_export, sheet_name, chunk_df, file_path, date_value,
+                                                   source_id=chunk["hash"] or os.path.basename(file_path))
+
+                    # 按键更新：键已存在的行覆盖原位置，其余行继续追加
+                    written_rows = 0
+                    if key_cols and len(chunk_df) > 0:
+                        keys = self.compute_row_keys(chunk_df, key_positions)
+                        # 同一文件内重复的键以最后一行为准
+                        is_last = ~keys.duplicated(keep='last').to_numpy()
+                        chunk_df = chunk_df[is_last]
+                        keys = keys[is_last]
+                        if derived_df is not None:
+                            derived_df = derived_df[is_last]
+                        # 逐键查字典，代价只与本数据块行数有关，与索引大小无关
+                        target_rows = np.fromiter((key_index.get(key, -1) for key in keys.tolist()), dtype=np.int64, count=len(keys))
+                        is_update = target_rows >= 0
+                        if is_update.any():
+                            # 缓冲区中待写入的新行可能正是本次要更新的行，先写入缓冲区
+                            self.flush_write_buffer(write_buffer, write_plans, write_stats, verify_targets)
+                            write_buffer = None
+                            self.write_updated_rows(main_sheet, start_col, target_rows[is_update],
+                                                    chunk_df[is_update].values, date_col, date_value,
+                                                    derived_df[is_update] if derived_df is not None else None)
+                            if verify_targets is not None:
+                                entry = verify_targets.setdefault((self.main_file, sheet_name), {
+                                    "sheet": main_sheet, "start_col": start_col, "columns": chunk_df.shape[1], "rows": [], "hashes": []})
+                                entry["rows"].append(target_rows[is_update])
+                                entry["hashes"].append(self.compute_verify_hashes(chunk_df[is_update]))
+                            updated_count += int(is_update.sum())
+                            written_rows += int(is_update.sum())
+                            chunk_df = chunk_df[~is_update]
+                            keys = keys[~is_update]
+                            if derived_df is not None:
+                                derived_df = derived_df[~is_update]
+                        # 追加的新键记录其主表行号
+                        key_index.update(zip(keys.tolist(), range(current_row, current_row + len(keys))))
+
+                    chunk_rows = len(chunk_df)
+                    written_rows += chunk_rows
+                    if "sources" in chunk:
+                        # 汇总数据段：合并清单记录参与汇总的每个原始文件及其原始行数
+                        for source_chunk, source_rows in chunk["sources"]:
+                            merged_sources[source_chunk["seq"]] = (sheet_name, source_chunk, source_rows)
+                    else:
+                        previous_rows = merged_sources.get(chunk["seq"], (None, None, 0))[2]
+                        merged_sources[chunk["seq"]] = (sheet_name, chunk, previous_rows + written_rows)
+                    if chunk_rows == 0:
+                        continue
+
+                    # 按月分片时，数据段的月份取自文件名日期，没有日期时取本次合并的月份
+                    piece_month = None
+                    if shard_max_rows and self.shard_config["mode"] == "month":
+                        piece_month = (f"{str(date_value)[:4]}-{str(date_value)[4:6]}" if isinstance(date_value, int)
+                                       else f"{datetime.now():%Y-%m}")
+
+                    # 写入前检查行数上限，超过分片阈值的部分滚动写入下一个分片
+                    offset = 0
+                    while offset < chunk_rows:
+                        if shard_max_rows:
+                            if target is None or target["row"] > shard_max_rows or (
+                                    target["path"] != self.main_file and target["month"] != piece_month):
+                                if key_cols:
+                                    raise Exception(f"{sheet_name}工作表行数将超过分片阈值{shard_max_rows}行，按键更新的工作表不支持分片")
+                                # 先写出缓冲区，open_shard_target按工作表中实际的最后一行判断当前分片是否已满
+                                if write_buffer is not None:
+                                    self.flush_write_buffer(write_buffer, write_plans, write_stats, verify_targets)
+                                    write_buffer = None
+                                target = self.open_shard_target(app, sheet_name, shard_map, piece_month, opened_shards)
+                                shard_map_changed = True
+                            segment_rows = min(chunk_rows - offset, shard_max_rows - target["row"] + 1)
+                        else:
+                            if target["row"] + chunk_rows - 1 > EXCEL_MAX_ROWS:
+                                raise Exception(f"{sheet_name}工作表追加后将超过Excel的{EXCEL_MAX_ROWS}行上限，请配置主表分片")
+                            segment_rows = chunk_rows
+                        segment_df = chunk_df.iloc[offset:offset + segment_rows]
+                        segment_start = target["row"]
+                        segment_end = segment_start + segment_rows - 1
+
+                        # 写入同一目标的连续数据段先放入缓冲区，多路归并切出的小段合并后一次写入
+                        if write_buffer is not None and write_buffer["target"] is not target:
+                            self.flush_write_buffer(write_buffer, write_plans, write_stats, verify_targets)
+                            write_buffer = None
+                        if write_buffer is None:
+                            write_buffer = {"target": target, "sheet_name": sheet_name, "start_row": segment_start,
+                                            "columns_count": original_columns_count,
+                                            "derived_columns": self.get_computed_columns(sheet_name) if transform_steps else (),
+                                            "frames": [], "derived": [], "dates": [], "rows": 0}
+                        write_buffer["frames"].append(segment_df)
+                        write_buffer["derived"].append(derived_df.iloc[offset:offset + segment_rows] if derived_df is not None else None)
+                        write_buffer["dates"].append((date_value, segment_rows))
+                        write_buffer["rows"] += segment_rows
+                        if write_buffer["rows"] >= write_stats["chunk_rows"]:
+                            self.flush_write_buffer(write_buffer, write_plans, write_stats, verify_targets)
+                            write_buffer = None
+                        file_id = chunk["hash"] or os.path.basename(file_path)
+                        if skip_duplicates:
+                            fingerprint_owners.setdefault(file_id, set()).update(
+                                [source_chunk["seq"] for source_chunk, _ in chunk["sources"]] if "sources" in chunk else [chunk["seq"]])
+                        workbook = None if target["path"] == self.main_file else target["path"]
+                        last_block = lineage_blocks[-1] if lineage_blocks else None
+                        if (last_block and last_block["file_id"] == file_id and last_block["sheet"] == sheet_name
+                                and last_block.get("workbook") == workbook and last_block["end_row"] + 1 == segment_start):
+                            # 同一文件的相邻段合并为一个数据块记录
+                            last_block["end_row"] = segment_end
+                        else:
+                            lineage_blocks.append({"file_id": file_id, "file": os.path.basename(file_path), "sheet": sheet_name,
+                                                   "start_row": segment_start, "end_row": segment_end})
+                            if workbook:
+                                lineage_blocks[-1]["workbook"] = workbook
+                            if "sources" in chunk:
+                                # 汇总数据块记录参与汇总的文件，撤销时一并从合并清单中移除
+                                lineage_blocks[-1]["sources"] = [source_chunk["hash"] for source_chunk, _ in chunk["sources"]
+                                                                 if source_chunk["hash"]]
+                        target["row"] += segment_rows
+                        offset += segment_rows
+                    current_row += chunk_rows
+                    del chunk_df
+                self.flush_write_buffer(write_buffer, write_plans, write_stats, verify_targets)
+
+                # 键索引和指纹索引在文件保存成功后再持久化
+                if key_cols:
+                    pending_key_indexes[sheet_name] = key_index
+                    self.update_status(f"{sheet_name}工作表按键更新{updated_count}行，新增{current_row - append_start_row}行")
+                if skip_duplicates:
+                    pending_fingerprints[sheet_name] = dedupe_state["seen"]
+                    # 按来源文件记录本次加入索引的指纹，撤销合并时精确移除（汇总后写入的行与原始行的指纹不同）
+                    for file_id, seqs in fingerprint_owners.items():
+                        arrays = [array for seq in seqs for array in dedupe_state["by_chunk"].get(seq, [])]
+                        if arrays:
+                            pending_block_fingerprints[(sheet_name, file_id)] = np.unique(np.concatenate(arrays))
+                    if dedupe_state["duplicates"] > 0:
+                        self.update_status(f"{sheet_name}工作表跳过{dedupe_state['duplicates']}行已合并过的重复数据")
 
                 # 更新进度条
+                self.report_write_stats(sheet_name, write_stats)
                 self.update_status(f"已完成{sheet_name}工作表的数据合并")
 
             try:
@@ -1260,7 +4800,8 @@ class ExcelMerger:
                 if self.merge_marketing.get() and "全站营销" in self.sub_files and self.sub_files["全站营销"]:
                     formula_end_col = self.sheet_config["全站营销"]["formula_end_col"]
                     self.update_status(f"准备填充全站营销工作表的A到{formula_end_col}列公式...")
-                    self.fill_sheet_formula(wb, "全站营销", formula_end_col)
+                    self.fill_sheet_formula(wb, "全站营销", formula_end_col, self.get_computed_columns("全站营销"),
+                                            write_plans.get((self.main_file, "全站营销"), {}).get("formula_columns", ()))
                     self.update_status(f"全站营销工作表A到{formula_end_col}列公式填充处理完成")
                 else:
                     if not self.merge_marketing.get():
@@ -1272,7 +4813,8 @@ class ExcelMerger:
                 if self.merge_internal.get() and "站内数据源" in self.sub_files and self.sub_files["站内数据源"]:
                     formula_end_col = self.sheet_config["站内数据源"]["formula_end_col"]
                     self.update_status(f"准备填充站内数据源工作表的A到{formula_end_col}列公式...")
-                    self.fill_sheet_formula(wb, "站内数据源", formula_end_col)
+                    self.fill_sheet_formula(wb, "站内数据源", formula_end_col, self.get_computed_columns("站内数据源"),
+                                            write_plans.get((self.main_file, "站内数据源"), {}).get("formula_columns", ()))
                     self.update_status(f"站内数据源工作表A到{formula_end_col}列公式填充处理完成")
                 else:
                     if not self.merge_internal.get():
@@ -1284,7 +4826,8 @@ class ExcelMerger:
                 if self.merge_external.get() and "站外数据源" in self.sub_files and self.sub_files["站外数据源"]:
                     formula_end_col = self.sheet_config["站外数据源"]["formula_end_col"]
                     self.update_status(f"准备填充站外数据源工作表的A到{formula_end_col}列公式...")
-                    self.fill_sheet_formula(wb, "站外数据源", formula_end_col)
+                    self.fill_sheet_formula(wb, "站外数据源", formula_end_col, self.get_computed_columns("站外数据源"),
+                                            write_plans.get((self.main_file, "站外数据源"), {}).get("formula_columns", ()))
                     self.update_status(f"站外数据源工作表A到{formula_end_col}列公式填充处理完成")
                 else:
                     if not self.merge_external.get():
@@ -1296,7 +4839,8 @@ class ExcelMerger:
                 if self.merge_shop.get() and "店铺成交数据源" in self.sub_files and self.sub_files["店铺成交数据源"]:
                     formula_end_col = self.sheet_config["店铺成交数据源"]["formula_end_col"]
                     self.update_status(f"准备填充店铺成交数据源工作表的A到{formula_end_col}列公式...")
-                    self.fill_sheet_formula(wb, "店铺成交数据源", formula_end_col)
+                    self.fill_sheet_formula(wb, "店铺成交数据源", formula_end_col, self.get_computed_columns("店铺成交数据源"),
+                                            write_plans.get((self.main_file, "店铺成交数据源"), {}).get("formula_columns", ()))
                     self.update_status(f"店铺成交数据源工作表A到{formula_end_col}列公式填充处理完成")
                 else:
                     if not self.merge_shop.get():
@@ -1304,79 +4848,514 @@ class ExcelMerger:
                     else:
                         self.update_status("店铺成交数据源工作表未导入副表，跳过公式填充")
 
-                # 保存文件
+                # 保存前读回写入区域，按行哈希校验写入结果
+                if verify_targets:
+                    self.report_verification(verify_targets)
+
+                # 保存前结束批量写入会话：重算写入过的工作表并恢复计算模式，手动计算模式不随文件保存
+                self.end_bulk_session(app, bulk_session, [wb.sheets[sheet_name] for sheet_name in selected_sheets])
+
+                # 分片工作簿在替换主表之前填充公式并保存到暂存文件，任何一个失败都中止合并，主表保持不变
+                for shard_path, shard_wb in opened_shards.items():
+                    shard_sheet = next(sheet_name for sheet_name, shards in shard_map.items()
+                                       if any(shard["path"] == shard_path for shard in shards))
+                    self.fill_sheet_formula(shard_wb, shard_sheet, self.sheet_config[shard_sheet]["formula_end_col"],
+                                            self.get_computed_columns(shard_sheet),
+                                            write_plans.get((shard_path, shard_sheet), {}).get("formula_columns", ()))
+                    staged_shards[shard_path] = self.stage_workbook(shard_wb, shard_path, [shard_sheet])
+
+                # 保存文件：先保存到同目录的暂存文件并校验，再原子替换主表，上一版本保留在辅助数据目录中
                 self.update_status("正在保存文件...")
-                wb.save()
-                wb.close()
-                app.quit()
+                master_staging = True
+                staged_path = self.stage_workbook(wb, self.main_file, selected_sheets)
+
+                # 合并前快照：校验和写入都已在内存及暂存文件中完成，替换主表之前才创建，校验失败的合并不会留下快照
+                # 支持写时复制的文件系统上只克隆元数据，不再需要手动备份主表
+                if self.snapshot_config["keep"] > 0:
+                    try:
+                        snapshot_dir, method = self.create_snapshot()
+                        self.update_status(f"已创建合并前快照（{'写时复制' if method == 'reflink' else '完整复制'}）：{os.path.basename(snapshot_dir)}")
+                    except Exception as snapshot_error:
+                        self.update_status(f"警告：创建合并前快照失败: {str(snapshot_error)}", level='warning')
+
+                self.commit_staged_workbook(staged_path, self.main_file)
+                master_committed = True
+                self.release_excel_app(app)
+
+                # 主表替换后立即更新辅助数据，使键索引、指纹索引、合并清单和行来源记录与主表一致
+                if shard_map_changed:
+                    self.save_shard_map(shard_map)
+
+                # 保存成功后更新键索引和已合并行指纹索引
+                for sheet_name, key_index in pending_key_indexes.items():
+                    self.save_key_index(sheet_name, key_index)
+                for sheet_name, fingerprints in pending_fingerprints.items():
+                    self.save_fingerprint_index(sheet_name, fingerprints)
+                for (sheet_name, file_id), fingerprints in pending_block_fingerprints.items():
+                    self.save_block_fingerprints(sheet_name, file_id, fingerprints)
+
+                # 保存成功后在合并清单中记录本次合并的文件
+                merged_at = datetime.now().isoformat(timespec='seconds')
+                for sheet_name, chunk, rows in merged_sources.values():
+                    if chunk["hash"]:
+                        manifest[chunk["hash"]] = {"file": os.path.basename(chunk["file"]), "sheet": sheet_name,
+                                                   "rows": rows, "merged_at": merged_at}
+                self.save_merge_manifest(manifest)
+
+                # 保存成功后将暂存库中的文件标记为已合并
+                for sheet_name, store in self.sub_data.items():
+                    if isinstance(store, DuckDBStagingStore):
+                        store.mark_merged([chunk for merged_sheet, chunk, _ in merged_sources.values()
+                                           if merged_sheet == sheet_name and "table" in chunk])
+
+                # 保存成功后追加行来源记录，用于按文件撤销合并
+                if lineage_blocks:
+                    for block in lineage_blocks:
+                        block["merged_at"] = merged_at
+                    self.save_lineage(self.load_lineage() + lineage_blocks)
+
+                # 保存成功后将本次的分区文件移入列式数据集
+                if columnar_export is not None:
+                    self.commit_columnar_export(columnar_export)
+
+                # 最后逐个替换分片工作簿：某个分片替换失败时其新数据保留在暂存文件中，不影响主表和其他分片
+                failed_shards = self.commit_staged_shards(staged_shards)
 
                 total_time = time.time() - start_time
                 self.update_status(f"合并完成！\n数据已保存至原始文件：{self.main_file}\n处理耗时：{total_time:.2f}秒")
-                messagebox.showinfo("成功", "数据已成功合并并保存至原始文件")
+                if failed_shards:
+                    self.dialogs.showwarning("警告", "主表已保存，但以下分片工作簿保存失败：\n" + "\n".join(
+                        f"{os.path.basename(shard_path)}：{error}\n  新数据保留在{staged}，关闭占用该分片的程序后将其重命名为分片文件名即可"
+                        for shard_path, staged, error in failed_shards))
+                else:
+                    self.dialogs.showinfo("成功", "数据已成功合并并保存至原始文件")
 
             except Exception as save_error:
                 print(f"错误：保存原文件失败: {str(save_error)}")
                 self.update_status(f"错误：保存原文件失败: {str(save_error)}")
-                wb.close()
-                app.quit()
-                
-                # 如果保存失败，创建新文件
+                if master_committed:
+                    # 主表已替换成功，出错的是之后更新辅助数据的步骤，不再生成新文件
+                    self.dialogs.showerror("错误", f"主表已保存，但保存后更新合并记录时出错：\n{str(save_error)}\n\n"
+                                                f"暂存的分片工作簿未替换：{', '.join(staged_shards.values()) or '无'}")
+                    return
+                # 原文件未更新，本次的分区文件不移入数据集，新建的分片删除
+                self.discard_columnar_export(columnar_export)
+                self.end_bulk_session(app, bulk_session)
+
+                # 如果保存失败，创建新文件：新文件只能来自本次合并流程的结果（已执行跳过、去重、按键更新、汇总、
+                # 派生列和日期顺序等全部步骤），不从副表重新生成
                 save_path = os.path.join(os.path.dirname(self.main_file), 
                                         f"合并结果_{os.path.basename(self.main_file)}")
-                
-                # 复制并保存新文件
-                import shutil
-                shutil.copy2(self.main_file, save_path)
-                new_app = xw.App(visible=False)
-                new_wb = new_app.books.open(save_path)
-
-                for sheet_name, sub_data in self.sub_data.items():
-                    if sheet_name not in self.main_data:
-                        continue
-
-                    new_sheet = new_wb.sheets[sheet_name]
-                    last_row = new_sheet.used_range.rows.count
-                    if last_row > 1:
-                        # 根据配置字典决定起始列
-                        start_col = self.sheet_config[sheet_name]["start_col"]
-                        new_sheet.range(f"{start_col}2:XFD{last_row}").clear()
-
-                    # 根据工作表名称决定数据读取的起始列
-                    if sheet_name == "站外数据源":
-                        start_col = "F"
-                    elif sheet_name == "店铺成交数据源":
-                        start_col = "H"
-                    else:
-                        start_col = "G"
-                    main_data_from_g = pd.DataFrame(new_sheet.range(f"{start_col}1").expand().value)
-                    merged_data_from_g = pd.concat([main_data_from_g, sub_data], 
-                                                 axis=0, copy=False).reset_index(drop=True)
-                    # 根据工作表名称决定数据写入的起始列
-                    if sheet_name == "站外数据源":
-                        start_col = "F"
-                    elif sheet_name == "店铺成交数据源":
-                        start_col = "H"
-                    else:
-                        start_col = "G"
-                    new_sheet.range(f"{start_col}2").options(index=False, header=False).value = merged_data_from_g.values
+                fallback_error = None
+                if staged_path is not None and os.path.exists(staged_path):
+                    # 合并结果已完整保存到暂存文件并通过校验，只是无法替换原文件：直接作为新文件保留
+                    pass
+                elif opened_shards:
+                    fallback_error = "本次合并有数据写入分片工作簿，只另存主表得不到完整的结果"
+                elif master_staging:
+                    fallback_error = "保存或校验暂存文件时出错，内存中的合并结果不可靠"
+                else:
+                    # 保存前的步骤出错，工作簿中仍是完整的合并结果，另存为新文件
+                    try:
+                        wb.save(save_path)
+                    except Exception as fallback_save_error:
+                        fallback_error = f"另存为新文件时也出错：{str(fallback_save_error)}"
+                        if os.path.exists(save_path):
+                            os.remove(save_path)
+                try:
+                    wb.close()
+                except Exception:
+                    pass  # 已保存到暂存文件的工作簿已关闭
+                self.discard_new_shards(opened_shards, existing_shards, staged_shards)
+                self.release_excel_app(app, failed=True)
 
-                new_wb.save()
-                new_wb.close()
-                new_app.quit()
+                if fallback_error is not None:
+                    self.update_status(f"错误：未生成新文件：{fallback_error}", level='error')
+                    self.dialogs.showerror("错误", f"保存合并结果失败：\n{str(save_error)}\n\n{fallback_error}，未生成新文件。\n"
+                                                f"主表、合并记录和列式数据集均未改动，请解决上述问题后重新合并。")
+                    return
+                if staged_path is not None and os.path.exists(staged_path):
+                    os.replace(staged_path, save_path)
 
                 total_time = time.time() - start_time
                 self.update_status(f"由于原文件可能被锁定，已将结果保存到新文件：\n{save_path}\n处理耗时：{total_time:.2f}秒")
-                messagebox.showinfo("成功", f"数据已成功合并并保存至新文件：\n{save_path}")
+                self.dialogs.showinfo("成功", f"数据已成功合并并保存至新文件：\n{save_path}")
 
         except Exception as e:
             print(f"错误：合并文件时出错: {str(e)}")
             self.update_status(f"错误：合并文件时出错: {str(e)}")
-            try:
+            self.abort_merge(app, wb, bulk_session, columnar_export, opened_shards, existing_shards, staged_shards, failed=True)
+            self.dialogs.showerror("错误", f"合并文件时出错：\n{str(e)}\n\n请确保：\n1. 文件未被其他程序占用\n2. 有足够的磁盘空间\n3. 有写入权限")
+
+    def abort_merge(self, app, wb, bulk_session, columnar_export, opened_shards, existing_shards, staged_shards, failed=False):
+        """合并中止时的清理：丢弃尚未提交的列式导出分区，结束批量写入会话，不保存关闭主表，
+        关闭并删除本次新建的分片工作簿（分片记录尚未保存），最后释放Excel应用"""
+        self.discard_columnar_export(columnar_export)
+        if app is None:
+            return
+        try:
+            self.end_bulk_session(app, bulk_session)
+            if wb is not None:
                 wb.close()
-                app.quit()
-            except:
-                pass
-            messagebox.showerror("错误", f"合并文件时出错：\n{str(e)}\n\n请确保：\n1. 文件未被其他程序占用\n2. 有足够的磁盘空间\n3. 有写入权限")
+        except Exception:
+            pass
+        self.discard_new_shards(opened_shards, existing_shards, staged_shards)
+        try:
+            self.release_excel_app(app, failed=failed)
+        except Exception:
+            pass
+
+    def show_rollback_dialog(self):
+        """显示已合并文件列表，选择一个文件撤销其合并的行"""
+        if not self.main_file:
+            self.dialogs.showerror("错误", "请先加载主表文件！")
+            return
+
+        lineage = self.load_lineage()
+        if not lineage:
+            self.dialogs.showinfo("提示", "主表没有可撤销的合并记录")
+            return
+
+        # 按来源文件汇总数据块，最近合并的文件排在最前
+        files = {}
+        for block in lineage:
+            summary = files.setdefault(block["file_id"], {"file": block["file"], "sheet": block["sheet"],
+                                                          "rows": 0, "merged_at": block["merged_at"]})
+            summary["rows"] += block["end_row"] - block["start_row"] + 1
+        file_ids = list(files.keys())[::-1]
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("撤销文件合并")
+        dialog.geometry("480x320")
+        dialog.transient(self.root)
+
+        ttk.Label(dialog, text="选择要从主表中移除的已合并文件：").pack(padx=10, pady=(10, 5), anchor=tk.W)
+        listbox = tk.Listbox(dialog, font=("Arial", 9), activestyle='none')
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        for file_id in file_ids:
+            summary = files[file_id]
+            listbox.insert(tk.END, f"{summary['file']} | {summary['sheet']} | {summary['rows']}行 | {summary['merged_at']}")
+
+        def on_confirm():
+            selection = listbox.curselection()
+            if not selection:
+                return
+            file_id = file_ids[selection[0]]
+            summary = files[file_id]
+            if not self.dialogs.askyesno("确认", f"确定从主表中移除{summary['file']}合并的{summary['rows']}行吗？", parent=dialog):
+                return
+            dialog.destroy()
+            self.rollback_file(file_id)
+
+        button_row = ttk.Frame(dialog)
+        button_row.pack(pady=10)
+        ttk.Button(button_row, text="撤销所选", width=12, command=on_confirm).pack(side=tk.LEFT, padx=10)
+        ttk.Button(button_row, text="取消", width=12, command=dialog.destroy).pack(side=tk.LEFT, padx=10)
+
+    def show_snapshot_dialog(self):
+        """显示主表的合并前快照，选择一个快照恢复主表和辅助数据"""
+        if not self.main_file:
+            self.dialogs.showerror("错误", "请先加载主表文件！")
+            return
+
+        snapshots = self.list_snapshots()
+        if not snapshots:
+            self.dialogs.showinfo("提示", "主表没有可恢复的快照")
+            return
+
+        dialog = tk.Toplevel(self.root)
+        dialog.title("恢复快照")
+        dialog.geometry("480x320")
+        dialog.transient(self.root)
+
+        ttk.Label(dialog, text="选择要恢复的快照（主表和合并记录将恢复到快照时的状态）：").pack(padx=10, pady=(10, 5), anchor=tk.W)
+        listbox = tk.Listbox(dialog, font=("Arial", 9), activestyle='none')
+        listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=5)
+        for snapshot in snapshots:
+            method = "写时复制" if snapshot["method"] == "reflink" else "完整复制"
+            listbox.insert(tk.END, f"{snapshot['created_at']} | {snapshot['reason']} | {snapshot['size'] / 1024 / 1024:.1f}MB | {method}")
+
+        def on_confirm():
+            selection = listbox.curselection()
+            if not selection:
+                return
+            snapshot = snapshots[selection[0]]
+            message = f"确定将主表恢复到{snapshot['created_at']}的快照吗？\n当前版本将保留在辅助数据目录中。"
+            if self.load_columnar_log():
+                message += "\n\n快照之后导出到列式数据集的分区文件将被删除。"
+            if any(self.load_shard_map().values()):
+                message += "\n\n注意：分片工作簿不在快照中，不会恢复。快照之后写入分片的行仍保留在分片中，快照之后新建的分片也不会删除，请手动处理。"
+            if not self.dialogs.askyesno("确认", message, parent=dialog):
+                return
+            dialog.destroy()
+            try:
+                self.restore_snapshot(snapshot["path"])
+            except Exception as e:
+                self.update_status(f"错误：恢复快照时出错: {str(e)}")
+                self.dialogs.showerror("错误", f"恢复快照时出错：\n{str(e)}\n\n请确保主表文件未被其他程序占用")
+                return
+            self.update_status(f"已将主表恢复到{snapshot['created_at']}的快照")
+            # 重新读取恢复后的主表
+            self.load_main_file(self.main_file)
+
+        button_row = ttk.Frame(dialog)
+        button_row.pack(pady=10)
+        ttk.Button(button_row, text="恢复所选", width=12, command=on_confirm).pack(side=tk.LEFT, padx=10)
+        ttk.Button(button_row, text="取消", width=12, command=dialog.destroy).pack(side=tk.LEFT, padx=10)
+
+    def delete_row_blocks(self, sheet, blocks):
+        """删除工作表中的多个整行区域（删除前的行号）
+        
+        openpyxl写入引擎一次删除全部区域，公式只修正一次；Excel从下往上逐块删除，公式引用由Excel调整。
+        """
+        if hasattr(sheet, "delete_row_blocks"):
+            sheet.delete_row_blocks(blocks)
+            return
+        for first_row, last_row in sorted(blocks, reverse=True):
+            sheet.range(f"{first_row}:{last_row}").delete(shift='up')
+
+    def rollback_file(self, file_id):
+        """从主表中移除某个来源文件追加的所有行
+        
+        根据行来源记录，对该文件在每个工作表中的数据块执行整行块删除（从下往上，避免行号错位），
+        然后同步修正其余数据块的行号、键索引、指纹索引和合并清单，无需重新执行整个合并。
+        与合并相同，删除后的工作簿先保存到暂存文件并校验，创建快照后再原子替换，辅助数据在主表替换后立即写入。
+        按键更新时在原位置覆盖的行不在追加数据块中，无法通过撤销恢复。
+        """
+        lineage = self.load_lineage()
+        target_blocks = [block for block in lineage if block["file_id"] == file_id]
+        if not target_blocks:
+            return
+        if self.workbook_backend.get() == "zip":
+            self.dialogs.showerror("错误", "zip追加写入引擎不能删除已有的行，撤销合并请在写入引擎中选择openpyxl或xlwings")
+            return
+
+        app = None
+        workbooks = {}
+        staged = {}  # 工作簿路径 -> 暂存文件
+        master_committed = False
+        try:
+            self.update_status(f"正在撤销{target_blocks[0]['file']}的合并...")
+            start_time = time.time()
+
+            app = self.create_excel_app()
+            # 写入分片的数据块在对应的分片工作簿中删除，只打开有数据块的工作簿
+            for block in target_blocks:
+                book_path = block.get("workbook") or self.main_file
+                if book_path not in workbooks:
+                    workbooks[book_path] = app.books.open(book_path)
+
+            removed_fingerprints = {}
+            sheet_deletions = {}
+            for block in target_blocks:
+                sheet = workbooks[block.get("workbook") or self.main_file].sheets[block["sheet"]]
+                start_col = self.sheet_config[block["sheet"]]["start_col"]
+                row_count = block["end_row"] - block["start_row"] + 1
+
+                # 没有按来源文件记录指纹的早期合并，删除前读取这些行，用于从指纹索引中移除对应指纹
+                # （汇总数据块读回的是汇总后的行，与索引中的原始行指纹不同，无法这样移除）
+                if not os.path.exists(self.get_block_fingerprint_path(block["sheet"], file_id)) and "sources" not in block:
+                    columns_count = sheet.range(f"{start_col}1").expand('right').columns.count
+                    block_values = sheet.range(f"{start_col}{block['start_row']}").resize(row_count, columns_count).options(ndim=2).value
+                    removed_fingerprints.setdefault(block["sheet"], []).append(
+                        self.compute_row_fingerprints(pd.DataFrame(block_values)))
+                sheet_deletions.setdefault((block.get("workbook"), block["sheet"]), (sheet, []))[1].append(
+                    (block["start_row"], block["end_row"]))
+
+            # 每个工作表的全部数据块一次删除
+            for sheet, blocks in sheet_deletions.values():
+                self.delete_row_blocks(sheet, blocks)
+
+            # 辅助数据的新内容先在内存中算好，主表替换后立即写入，缩短两者不一致的时间
+            # 修正其余数据块的行号：位于同一工作簿同一工作表中被删除块下方的行整体上移
+            remaining = [block for block in lineage if block["file_id"] != file_id]
+            for block in remaining:
+                shift = sum(removed["end_row"] - removed["start_row"] + 1 for removed in target_blocks
+                            if removed["sheet"] == block["sheet"] and removed.get("workbook") == block.get("workbook")
+                            and removed["end_row"] < block["start_row"])
+                block["start_row"] -= shift
+                block["end_row"] -= shift
+
+            # 键索引只记录主表中的行，分片中的数据块不参与行号修正
+            master_blocks = [block for block in target_blocks if not block.get("workbook")]
+            key_indexes = {}
+            fingerprint_indexes = {}
+            block_fingerprint_paths = []
+            for sheet_name in {block["sheet"] for block in target_blocks}:
+                sheet_blocks = [block for block in master_blocks if block["sheet"] == sheet_name]
+
+                # 修正键索引：删除被移除行的键，下方的行号上移
+                if os.path.exists(self.get_sidecar_path(f"keys_{sheet_name}.json")):
+                    key_index = self.load_key_index(sheet_name, [])
+                    updated_index = {}
+                    for key, row in key_index.items():
+                        if any(block["start_row"] <= row <= block["end_row"] for block in sheet_blocks):
+                            continue
+                        updated_index[key] = row - sum(block["end_row"] - block["start_row"] + 1
+                                                       for block in sheet_blocks if block["end_row"] < row)
+                    key_indexes[sheet_name] = updated_index
+
+                # 从指纹索引中移除该文件合并时加入的指纹，使这些行可以重新合并
+                fingerprint_path = self.get_sidecar_path(f"fingerprints_{sheet_name}.npy")
+                block_fingerprint_path = self.get_block_fingerprint_path(sheet_name, file_id)
+                if os.path.exists(fingerprint_path):
+                    if os.path.exists(block_fingerprint_path):
+                        removed = np.load(block_fingerprint_path)
+                    elif sheet_name in removed_fingerprints:
+                        removed = np.concatenate(removed_fingerprints[sheet_name])
+                    else:
+                        removed = None
+                        self.update_status(f"警告：{target_blocks[0]['file']}合并时没有记录指纹，指纹索引中仍保留其原始行，"
+                                           f"重新合并前请取消勾选\"跳过已合并过的重复行\"", level='warning')
+                    if removed is not None:
+                        fingerprints = np.load(fingerprint_path)
+                        fingerprint_indexes[sheet_name] = fingerprints[~sorted_contains(np.sort(removed), fingerprints)]
+                if os.path.exists(block_fingerprint_path):
+                    block_fingerprint_paths.append(block_fingerprint_path)
+
+            # 从合并清单中移除该文件（汇总数据块则为参与汇总的所有文件），允许重新合并
+            manifest = self.load_merge_manifest()
+            source_ids = {file_id}
+            for block in target_blocks:
+                source_ids.update(block.get("sources", []))
+            manifest_changed = bool(source_ids & set(manifest))
+            for source_id in source_ids:
+                manifest.pop(source_id, None)
+
+            # 删除后的工作簿先保存到同目录的暂存文件并校验，任何一个失败都中止撤销，主表、分片和辅助数据保持不变
+            self.update_status("正在保存文件...")
+            for book_path, book in list(workbooks.items()):
+                sheet_names = sorted({block["sheet"] for block in target_blocks if (block.get("workbook") or self.main_file) == book_path})
+                staged[book_path] = self.stage_workbook(book, book_path, sheet_names)
+                del workbooks[book_path]
+            self.release_excel_app(app)
+            app = None
+
+            # 撤销前快照：替换主表之前创建，撤销有误时可以一步恢复
+            if self.snapshot_config["keep"] > 0:
+                try:
+                    snapshot_dir, method = self.create_snapshot(reason="撤销合并前")
+                    self.update_status(f"已创建撤销前快照（{'写时复制' if method == 'reflink' else '完整复制'}）：{os.path.basename(snapshot_dir)}")
+                except Exception as snapshot_error:
+                    self.update_status(f"警告：创建撤销前快照失败: {str(snapshot_error)}", level='warning')
+
+            if self.main_file in staged:
+                self.commit_staged_workbook(staged.pop(self.main_file), self.main_file)
+            master_committed = True
+
+            # 主表替换后立即写入辅助数据
+            self.save_lineage(remaining)
+            for sheet_name, key_index in key_indexes.items():
+                self.save_key_index(sheet_name, key_index)
+            for sheet_name, fingerprints in fingerprint_indexes.items():
+                self.save_fingerprint_index(sheet_name, fingerprints)
+            for block_fingerprint_path in block_fingerprint_paths:
+                os.remove(block_fingerprint_path)
+            if manifest_changed:
+                self.save_merge_manifest(manifest)
+
+            # 加载主表时读取的已有数据同步删除这些行（主表第i+2行对应第i行数据），之后建立索引和检查行数时使用
+            for sheet_name in {block["sheet"] for block in master_blocks}:
+                existing = self.main_data.get(sheet_name)
+                if existing is None:
+                    continue
+                positions = [row - 2 for block in master_blocks if block["sheet"] == sheet_name
+                             for row in range(block["start_row"], block["end_row"] + 1) if row - 2 < len(existing)]
+                self.main_data[sheet_name] = existing.drop(index=existing.index[positions]).reset_index(drop=True)
+
+            # 从列式数据集中删除该文件导出的行
+            if os.path.isdir(self.get_columnar_export_dir()):
+                removed_exported = self.remove_columnar_rows({block["sheet"] for block in target_blocks}, file_id)
+                if removed_exported:
+                    self.update_status(f"已从列式数据集中删除{removed_exported}行")
+
+            # 最后逐个替换分片工作簿：某个分片替换失败时其删除结果保留在暂存文件中
+            failed_shards = self.commit_staged_shards(staged)
+            staged = {}
+
+            removed_rows = sum(block["end_row"] - block["start_row"] + 1 for block in target_blocks)
+            total_time = time.time() - start_time
+            self.update_status(f"已撤销{target_blocks[0]['file']}的合并，共移除{removed_rows}行\n处理耗时：{total_time:.2f}秒")
+            if failed_shards:
+                self.dialogs.showwarning("警告", "主表已更新，但以下分片工作簿保存失败：\n" + "\n".join(
+                    f"{os.path.basename(shard_path)}：{error}\n  撤销结果保留在{staged_shard}，关闭占用该分片的程序后将其重命名为分片文件名即可"
+                    for shard_path, staged_shard, error in failed_shards))
+            else:
+                self.dialogs.showinfo("成功", f"已从主表中移除{target_blocks[0]['file']}合并的{removed_rows}行")
+
+        except Exception as e:
+            print(f"错误：撤销合并时出错: {str(e)}")
+            self.update_status(f"错误：撤销合并时出错: {str(e)}")
+            for book in workbooks.values():
+                try:
+                    book.close()
+                except Exception:
+                    pass
+            if app is not None:
+                try:
+                    self.release_excel_app(app, failed=True)
+                except Exception:
+                    pass
+            if master_committed:
+                self.dialogs.showerror("错误", f"主表已更新，但之后更新撤销记录时出错：\n{str(e)}\n\n"
+                                            f"暂存的分片工作簿未替换：{', '.join(staged.values()) or '无'}")
+                return
+            # 主表未替换：删除暂存文件，主表、分片和辅助数据保持撤销前的状态
+            for staged_path in staged.values():
+                if os.path.exists(staged_path):
+                    os.remove(staged_path)
+            self.dialogs.showerror("错误", f"撤销合并时出错，主表未改动：\n{str(e)}\n\n请确保：\n1. 文件未被其他程序占用\n2. 有写入权限")
+
+def main(argv=None):
+    """命令行模式：不打开界面，将副表文件合并到主表，出错时返回非零退出码
+    
+    不带参数运行时打开界面。副表类型按文件名中的关键词识别，与界面中的批量导入相同。
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="将副表文件合并到主表（不带参数运行时打开界面）")
+    parser.add_argument("master", help="主表文件")
+    parser.add_argument("subs", nargs="+", help="副表文件，按文件名中的关键词识别对应的工作表")
+    parser.add_argument("--backend", choices=["xlwings", "openpyxl", "zip"], help="写入引擎，默认与界面相同")
+    parser.add_argument("--sheets", help="只合并这些工作表，以逗号分隔，默认全部")
+    parser.add_argument("--skip-duplicates", action="store_true", help="跳过已合并过的重复行")
+    parser.add_argument("--ordered", action="store_true", help="按日期顺序合并")
+    parser.add_argument("--aggregate", action="store_true", help="合并前按配置汇总")
+    parser.add_argument("--computed-values", action="store_true", help="派生列写入计算值")
+    parser.add_argument("--export-columnar", action="store_true", help="导出列式数据集")
+    parser.add_argument("--verify", action="store_true", help="合并后校验写入结果")
+    parser.add_argument("--debug", action="store_true", help="输出调试信息")
+    args = parser.parse_args(argv)
+
+    merger = ExcelMerger(headless=True)
+    if args.backend:
+        merger.workbook_backend.set(args.backend)
+    if args.sheets:
+        selected = {name.strip() for name in args.sheets.split(",")}
+        unknown = selected - set(merger.sheet_config)
+        if unknown:
+            parser.error(f"未知的工作表：{', '.join(sorted(unknown))}")
+        for sheet_name, option in (("全站营销", "merge_marketing"), ("站内数据源", "merge_internal"),
+                                   ("站外数据源", "merge_external"), ("店铺成交数据源", "merge_shop")):
+            getattr(merger, option).set(sheet_name in selected)
+    for option, value in (("skip_duplicates", args.skip_duplicates), ("ordered_merge", args.ordered),
+                          ("aggregate_before_merge", args.aggregate), ("write_computed_values", args.computed_values),
+                          ("export_columnar", args.export_columnar), ("verify_after_merge", args.verify),
+                          ("debug_mode", args.debug)):
+        getattr(merger, option).set(value)
+
+    merger.load_main_file(args.master)
+    if merger.main_file is None:
+        return 1
+    merger.load_sub_file_paths(args.subs)
+    if merger.dialogs.error_count == 0:
+        merger.merge_files()
+    merger.cleanup_spill_dir()
+    return 1 if merger.dialogs.error_count else 0
 
 if __name__ == "__main__":
+    # zip追加写入引擎使用多进程生成工作表XML，打包为可执行文件时需要
+    import multiprocessing
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1:
+        sys.exit(main())
     ExcelMerger()
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""测试共用的夹具
+
+excel_merger_v1.6.py的文件名含有点，不能直接import，这里按文件路径加载并登记到sys.modules
+（zip追加写入引擎在工作进程中生成XML，需要按模块名找到函数）；
+合并工具以命令行模式创建（不需要图形界面），写入引擎固定为openpyxl，不需要安装Excel。
+"""
+import importlib.util
+import os
+import sys
+
+import openpyxl
+import pandas as pd
+import pytest
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "excel_merger_v1.6.py")
+
+# 主表数据工作表的表头：A到F列为公式列，数据从G列开始
+MASTER_HEADER = ["A", "B", "C", "D", "E", "F", "日期", "计划", "花费"]
+
+
+@pytest.fixture(scope="session")
+def em():
+    spec = importlib.util.spec_from_file_location("excel_merger", MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def merger(em, monkeypatch):
+    monkeypatch.setenv("EXCEL_MERGER_BACKEND", "openpyxl")
+    monkeypatch.setenv("EXCEL_MERGER_APP_POOL_SIZE", "0")
+    monkeypatch.delenv("EXCEL_MERGER_STAGING_DB", raising=False)
+    monkeypatch.delenv("EXCEL_MERGER_COLUMNAR_DIR", raising=False)
+    merger = em.ExcelMerger(headless=True)
+    yield merger
+    merger.cleanup_spill_dir()
+
+
+@pytest.fixture
+def master_file(tmp_path):
+    """创建只含站内数据源工作表的主表：第2行起A列为引用H列的公式，G到I列为已有数据"""
+    path = str(tmp_path / "主表.xlsx")
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "站内数据源"
+    ws.append(MASTER_HEADER)
+    for i in range(3):
+        row = i + 2
+        ws.append([f'=H{row}&"x"', None, None, None, None, None, f"2024-01-0{i + 1}", f"p{i}", i])
+    wb.save(path)
+    return path
+
+
+@pytest.fixture
+def prepare_merge(merger):
+    """返回一个函数：加载主表，并把(文件名, 内容哈希, DataFrame)列表作为指定工作表的副表数据"""
+    def prepare(master_path, files, sheet_name="站内数据源"):
+        merger.main_file = master_path
+        merger.main_data[sheet_name] = pd.read_excel(master_path, sheet_name=sheet_name)
+        store = merger.create_sub_store(sheet_name)
+        for file_name, file_hash, df in files:
+            store.append(df, os.path.join(os.path.dirname(master_path), file_name), file_hash)
+        merger.sub_data[sheet_name] = store
+        merger.sub_files[sheet_name] = [chunk["file"] for chunk in store.chunks]
+        return merger
+    return prepare
+
+
+def add_shop_sheet(path, rows=1):
+    """在主表中加入店铺成交数据源工作表：A到F列为公式列，G列为文件名中的日期，数据从H列开始"""
+    wb = openpyxl.load_workbook(path)
+    ws = wb.create_sheet("店铺成交数据源")
+    ws.append(["A", "B", "C", "D", "E", "F", "日期", "店铺", "成交"])
+    for i in range(rows):
+        ws.append([f"=H{i + 2}", None, None, None, None, None, 20240101, f"店铺{i}", i])
+    wb.save(path)
+
+
+def read_sheet_rows(path, sheet_name="站内数据源", min_row=2):
+    """读取工作表的数据行，每行为单元格值列表"""
+    ws = openpyxl.load_workbook(path)[sheet_name]
+    return [[cell.value for cell in row] for row in ws.iter_rows(min_row=min_row)]
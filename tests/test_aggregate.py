@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def chunk(seq):
+    return {"seq": seq, "file": f"file_{seq}.xlsx"}
+
+
+def aggregate(merger, frames, spec):
+    pieces = [(chunk(seq), df) for seq, df in enumerate(frames)]
+    return list(merger.aggregate_pieces("站内数据源", pieces, spec))
+
+
+def test_partial_groups_combine_across_pieces(merger):
+    first = pd.DataFrame({"计划": ["b", "a", "b"], "日期": ["d2", "d1", "d2"], "花费": [1, 2, 3], "点击": [1, None, 5]})
+    second = pd.DataFrame({"计划": ["a", "c"], "日期": ["d1", "d3"], "花费": [4, "x"], "点击": [7, 9]})
+    spec = {"group_by": ["日期", "计划"], "sum": ["花费"], "count": ["点击"], "mean": ["点击"]}
+
+    [(record, result)] = aggregate(merger, [first, second], spec)
+
+    # 分组按首次出现的顺序输出，列顺序与副表一致
+    assert list(result.columns) == ["计划", "日期", "花费", "点击"]
+    assert result["计划"].tolist() == ["b", "a", "c"]
+    assert result["花费"].tolist() == [4, 6, 0]
+    # 点击同时配置了计数和均值，均值覆盖计数输出
+    assert result["点击"].tolist() == [3, 7, 9]
+    assert record["hash"] is None
+    assert record["file"].startswith("汇总_")
+    assert [(source["seq"], rows) for source, rows in record["sources"]] == [(0, 3), (1, 2)]
+
+
+def test_count_and_mean_skip_missing_values(merger):
+    df = pd.DataFrame({"计划": ["a", "a", "b"], "点击": [2, None, None], "展现": [1, 2, None]})
+
+    [(_, result)] = aggregate(merger, [df], {"group_by": ["计划"], "count": ["展现"], "mean": ["点击"]})
+
+    assert result["展现"].tolist() == [2, 0]
+    assert result["点击"].iloc[0] == 2
+    assert np.isnan(result["点击"].iloc[1])
+
+
+def test_missing_group_keys_form_their_own_group(merger):
+    df = pd.DataFrame({"计划": ["a", None, None], "花费": [1, 2, 3]})
+
+    [(_, result)] = aggregate(merger, [df], {"group_by": ["计划"], "sum": ["花费"]})
+
+    assert result["计划"].iloc[0] == "a"
+    assert pd.isna(result["计划"].iloc[1])
+    assert result["花费"].tolist() == [1, 5]
+
+
+def test_empty_input_yields_nothing_and_missing_column_raises(merger):
+    spec = {"group_by": ["计划"], "sum": ["花费"]}
+    assert aggregate(merger, [pd.DataFrame({"计划": [], "花费": []})], spec) == []
+
+    with pytest.raises(Exception, match="找不到汇总列：花费"):
+        aggregate(merger, [pd.DataFrame({"计划": ["a"]})], spec)
@@ -0,0 +1,121 @@
+import itertools
+import types
+
+import pytest
+
+
+class FakeBook:
+    def __init__(self, app):
+        self.app = app
+
+    def close(self):
+        self.app.books.remove(self)
+
+
+class FakeApp:
+    """代替xlwings.App：按启动顺序分配进程号，退出时从已运行的实例中移除"""
+    pids = itertools.count(100)
+
+    def __init__(self, running):
+        self.pid = next(FakeApp.pids)
+        self.running = running
+        self.books = []
+        running[self.pid] = self
+
+    def quit(self):
+        self.running.pop(self.pid, None)
+
+
+@pytest.fixture
+def running(em, monkeypatch):
+    running = {}
+    monkeypatch.setattr(em, "xw", types.SimpleNamespace(App=FakeApp, apps=running))
+    return running
+
+
+def make_pool(em, running, size=1, max_uses=20):
+    pool = em.ExcelAppPool(size=size, max_uses=max_uses)
+    pool.launches = 0
+
+    def launch():
+        pool.launches += 1
+        return FakeApp(running)
+    pool.launch = launch
+    return pool
+
+
+def wait_until_warm(pool):
+    with pool.condition:
+        while pool.pending:
+            pool.condition.wait(timeout=5)
+
+
+def test_warm_instance_is_reused_and_its_books_closed(em, running):
+    pool = make_pool(em, running)
+    pool.warm_up()
+    wait_until_warm(pool)
+
+    app = pool.acquire()
+    app.books.append(FakeBook(app))
+    pool.release(app)
+    # 重复归还被忽略
+    pool.release(app)
+
+    assert app.books == []
+    assert pool.acquire() is app
+    assert pool.launches == 1 and pool.uses == {app.pid: 2}
+
+
+def test_instance_is_recycled_after_max_uses_or_failure(em, running):
+    pool = make_pool(em, running, max_uses=2)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    pool.release(first)
+
+    # 达到使用次数上限的实例退出，后台启动新实例补充
+    wait_until_warm(pool)
+    assert first.pid not in running
+    second = pool.acquire()
+    assert second is not first and pool.launches == 2
+
+    pool.release(second, failed=True)
+    wait_until_warm(pool)
+    assert second.pid not in running and len(pool.idle) == 1
+
+
+def test_closed_idle_instance_is_replaced_on_acquire(em, running):
+    pool = make_pool(em, running)
+    app = pool.acquire()
+    pool.release(app)
+    app.quit()  # 例如用户手动关闭了Excel
+
+    replacement = pool.acquire()
+
+    assert replacement is not app
+    assert app.pid not in pool.uses
+
+
+def test_shutdown_quits_idle_instances_and_stops_reuse(em, running):
+    pool = make_pool(em, running, size=2)
+    leased = pool.acquire()
+    idle = pool.acquire()
+    pool.release(idle)
+
+    pool.shutdown()
+    pool.release(leased)
+
+    assert running == {}
+    pool.warm_up()
+    assert pool.pending == 0
+
+
+def test_merger_leases_from_pool_for_xlwings_backend(em, merger, running):
+    merger.excel_pool = make_pool(em, running)
+    merger.workbook_backend.set("xlwings")
+
+    app = merger.create_excel_app()
+    merger.release_excel_app(app)
+
+    assert merger.excel_pool.idle == [app.pid]
+    assert merger.create_excel_app() is app
@@ -0,0 +1,77 @@
+import openpyxl
+import pandas as pd
+import pytest
+
+from conftest import read_sheet_rows
+
+
+def open_sheet(em, backend, path, sheet_name="站内数据源"):
+    app = em.OpenpyxlApp(visible=False) if backend == "openpyxl" else em.ZipAppendApp(visible=False)
+    return app.books.open(path).sheets[sheet_name]
+
+
+def edit_master(path, edit):
+    wb = openpyxl.load_workbook(path)
+    edit(wb["站内数据源"])
+    wb.save(path)
+
+
+@pytest.mark.parametrize("backend", ["openpyxl", "zip"])
+def test_append_row_follows_last_start_column_value(em, merger, master_file, backend):
+    # 起始列中间的空单元格不影响追加位置
+    def edit(ws):
+        ws["G3"].value = None
+    edit_master(master_file, edit)
+
+    assert merger.find_append_row(open_sheet(em, backend, master_file), "G") == 5
+
+
+def test_prefilled_formula_rows_do_not_move_append_row(em, merger, master_file):
+    # A列预先填充到第8行的公式不属于数据，追加位置仍由G列决定
+    edit_master(master_file, lambda ws: [ws.cell(row=row, column=1, value=f'=H{row}&"x"') for row in range(5, 9)])
+
+    assert merger.find_append_row(open_sheet(em, "openpyxl", master_file), "G") == 5
+
+
+def test_merge_writes_directly_below_existing_data(prepare_merge, master_file):
+    edit_master(master_file, lambda ws: [ws.cell(row=row, column=1, value=f'=H{row}&"x"') for row in range(5, 9)])
+    merger = prepare_merge(master_file, [("a.xlsx", "hash_a", pd.DataFrame({"日期": ["2024-02-01"], "计划": ["新"], "花费": [1]}))])
+
+    merger.merge_files()
+
+    rows = read_sheet_rows(master_file)
+    assert [row[7] for row in rows[:4]] == ["p0", "p1", "p2", "新"]
+    assert rows[3][0] == '=H5&"x"'
+
+
+@pytest.mark.parametrize("backend", ["openpyxl", "zip"])
+@pytest.mark.parametrize("gap", [None, "  "])
+def test_probe_header_stops_at_first_blank_cell(em, merger, master_file, backend, gap):
+    def edit(ws):
+        ws["J1"].value = gap
+        ws["K1"].value = "备注"
+    edit_master(master_file, edit)
+
+    assert merger.probe_header(open_sheet(em, backend, master_file), "G") == ["日期", "计划", "花费"]
+
+
+@pytest.mark.parametrize("backend", ["openpyxl", "zip"])
+def test_probe_header_is_empty_when_start_cell_is_blank(em, merger, master_file, backend):
+    def edit(ws):
+        ws["G1"].value = None
+    edit_master(master_file, edit)
+
+    assert merger.probe_header(open_sheet(em, backend, master_file), "G") == []
+
+
+def test_missing_header_names_the_start_column(prepare_merge, master_file):
+    def edit(ws):
+        ws["G1"].value = None
+    edit_master(master_file, edit)
+    merger = prepare_merge(master_file, [("a.xlsx", "hash_a", pd.DataFrame({"日期": ["2024-02-01"]}))])
+    messages = []
+    merger.dialogs.showerror = lambda title, message: messages.append(message)
+
+    merger.merge_files()
+
+    assert messages == ["站内数据源工作表从G列开始没有有效的数据列，请检查数据格式！"]
@@ -0,0 +1,78 @@
+import types
+
+import pytest
+
+
+class FakeApp:
+    """代替xlwings.App：记录设置的改动，fail_restore中的设置在第二次改动（恢复）时出错"""
+
+    def __init__(self, fail_restore=()):
+        self.__dict__.update(calculation="automatic", screen_updating=True, enable_events=True,
+                             fail_restore=set(fail_restore), changes=[])
+
+    def __setattr__(self, name, value):
+        if name in self.fail_restore and any(changed == name for changed, _ in self.changes):
+            raise OSError(f"无法设置{name}")
+        self.changes.append((name, value))
+        super().__setattr__(name, value)
+
+    @property
+    def settings(self):
+        return {name: getattr(self, name) for name in ("calculation", "screen_updating", "enable_events")}
+
+
+class FakeSheet:
+    def __init__(self, fail=False):
+        self.calculated = 0
+        self.fail = fail
+        self.api = types.SimpleNamespace(Calculate=self.calculate, calculate=self.calculate)
+
+    def calculate(self):
+        if self.fail:
+            raise OSError("重算失败")
+        self.calculated += 1
+
+
+@pytest.fixture
+def fake_xlwings(em, monkeypatch):
+    monkeypatch.setattr(em, "xw", types.SimpleNamespace(App=FakeApp))
+
+
+def test_session_defers_calculation_and_recalculates_written_sheets(merger, fake_xlwings):
+    app = FakeApp()
+    session = merger.begin_bulk_session(app)
+
+    assert app.settings == {"calculation": "manual", "screen_updating": False, "enable_events": False}
+    written, untouched = FakeSheet(), FakeSheet()
+    merger.end_bulk_session(app, session, [written])
+    assert written.calculated == 1 and untouched.calculated == 0
+    assert app.settings == {"calculation": "automatic", "screen_updating": True, "enable_events": True}
+
+    # 重复结束（例如出错后的清理路径）不再重算，也不再改动设置
+    changes = len(app.changes)
+    merger.end_bulk_session(app, session, [written])
+    assert written.calculated == 1 and len(app.changes) == changes
+
+
+def test_session_restores_settings_when_recalculation_fails(merger, fake_xlwings):
+    app = FakeApp()
+    app.calculation = "semiautomatic"
+    session = merger.begin_bulk_session(app)
+
+    merger.end_bulk_session(app, session, [FakeSheet(fail=True)])
+
+    assert app.settings == {"calculation": "semiautomatic", "screen_updating": True, "enable_events": True}
+
+
+def test_failed_restore_of_one_setting_still_restores_the_others(merger, fake_xlwings):
+    app = FakeApp(fail_restore=["calculation"])
+    session = merger.begin_bulk_session(app)
+
+    merger.end_bulk_session(app, session)
+
+    assert app.settings == {"calculation": "manual", "screen_updating": True, "enable_events": True}
+
+
+def test_file_level_backends_have_no_session(em, merger):
+    assert merger.begin_bulk_session(em.OpenpyxlApp(visible=False)) is None
+    merger.end_bulk_session(None, None)
@@ -0,0 +1,99 @@
+import pandas as pd
+import pytest
+
+from conftest import read_sheet_rows
+
+DATA = pd.DataFrame({"日期": [f"2024-02-{i + 1:02d}" for i in range(10)], "计划": [f"a{i}" for i in range(10)],
+                     "花费": list(range(10))})
+
+
+class FlakySheet:
+    """包装工作表，在第几次写入调用（从1开始，含失败的调用）时抛出异常，记录成功写入的起始单元格和行数"""
+
+    def __init__(self, sheet, fail_calls, error="Apple event timed out. (-1712)"):
+        self.sheet = sheet
+        self.fail_calls = set(fail_calls)
+        self.error = error
+        self.attempts = 0
+        self.writes = []
+
+    def range(self, address):
+        return FlakyRange(self, self.sheet.range(address), address)
+
+
+class FlakyRange:
+    def __init__(self, owner, target, address):
+        self.owner = owner
+        self.target = target
+        self.address = address
+
+    def options(self, **kwargs):
+        return self
+
+    @property
+    def value(self):
+        return self.target.value
+
+    @value.setter
+    def value(self, block):
+        owner = self.owner
+        owner.attempts += 1
+        if owner.attempts in owner.fail_calls:
+            raise OSError(owner.error)
+        owner.writes.append((self.address, len(block)))
+        self.target.options(index=False, header=False).value = block
+
+
+def setup_writer(em, merger, master_file, fail_calls=(), **kwargs):
+    merger.main_file = master_file
+    merger.write_chunk_config.update({"initial_rows": 4, "min_rows": 1, "max_rows": 8, "target_seconds": 60.0})
+    book = em.OpenpyxlApp(visible=False).books.open(master_file)
+    sheet = FlakySheet(book.sheets["站内数据源"], fail_calls, **kwargs)
+    plan = {"sources": {7: ("data", 0), 8: ("data", 1), 9: ("data", 2)}, "runs": [[7, 9]], "formula_columns": [],
+            "legacy_calls_per_chunk": 1}
+    return book, sheet, plan
+
+
+def test_timeout_resumes_from_last_written_chunk_with_smaller_chunks(em, merger, master_file):
+    book, sheet, plan = setup_writer(em, merger, master_file, fail_calls=[2])
+
+    stats = merger.write_data_block(sheet, 5, DATA, plan)
+
+    # 第1块4行写入成功后块大小翻倍为8；第2块超时，块大小减半为4后从第9行重新写入
+    assert sheet.writes == [("G5", 4), ("G9", 4), ("G13", 2)]
+    assert stats["rows"] == 10 and stats["retries"] == 1 and stats["calls"] == 3
+    book.save(master_file)
+    assert [row[7] for row in read_sheet_rows(master_file)] == ["p0", "p1", "p2"] + DATA["计划"].tolist()
+
+
+def test_chunk_size_grows_up_to_the_configured_maximum(em, merger, master_file):
+    book, sheet, plan = setup_writer(em, merger, master_file)
+
+    stats = merger.write_data_block(sheet, 5, pd.concat([DATA, DATA], ignore_index=True), plan)
+
+    assert sheet.writes == [("G5", 4), ("G9", 8), ("G17", 8)]
+    assert stats["chunk_rows"] == 8
+
+
+def test_slow_calls_shrink_the_next_chunk(em, merger, master_file, monkeypatch):
+    book, sheet, plan = setup_writer(em, merger, master_file)
+    merger.write_chunk_config["target_seconds"] = 1.0
+    clock = iter(range(0, 100, 2))
+    monkeypatch.setattr(em.time, "perf_counter", lambda: next(clock))
+
+    stats = merger.write_data_block(sheet, 5, DATA, plan)
+
+    # 每次调用耗时2秒，超过目标1秒，块大小按比例减半：4、2、1...
+    assert [rows for _, rows in sheet.writes[:3]] == [4, 2, 1]
+    assert stats["rows"] == 10
+
+
+def test_other_errors_and_repeated_timeouts_are_raised(em, merger, master_file):
+    book, sheet, plan = setup_writer(em, merger, master_file, fail_calls=[1], error="磁盘已满")
+    with pytest.raises(OSError, match="磁盘已满"):
+        merger.write_data_block(sheet, 5, DATA, plan)
+
+    book, sheet, plan = setup_writer(em, merger, master_file, fail_calls=[1, 2, 3, 4])
+    with pytest.raises(OSError, match="timed out"):
+        merger.write_data_block(sheet, 5, DATA, plan)
+    assert sheet.writes == []
@@ -0,0 +1,54 @@
+import pandas as pd
+import pytest
+
+duckdb = pytest.importorskip("duckdb")
+
+
+@pytest.fixture
+def connection(em, tmp_path):
+    connection = em.DuckDBStagingStore.open_connection(str(tmp_path / "staging.duckdb"))
+    yield connection
+    connection.close()
+
+
+def history(connection):
+    return connection.execute(
+        "SELECT hash, merged_at IS NOT NULL FROM staged_files ORDER BY load_order").fetchall()
+
+
+def test_restaging_a_merged_file_keeps_its_history(em, connection):
+    df = pd.DataFrame({"日期": ["2024-01-01"], "计划": ["a"]})
+    store = em.DuckDBStagingStore(connection, "站内数据源")
+    store.append(df, "a.xlsx", "hash_a")
+    store.mark_merged(store.chunks)
+
+    # 撤销合并后重新导入同一文件，再重复导入一次
+    again = em.DuckDBStagingStore(connection, "站内数据源")
+    again.append(df, "a.xlsx", "hash_a")
+    again.append(df, "a.xlsx", "hash_a")
+
+    assert history(connection) == [("hash_a", True), ("hash_a", False)]
+    # 放弃未合并的导入时，已合并登记仍在使用的数据表保留
+    again.discard_pending()
+    assert history(connection) == [("hash_a", True)]
+    assert connection.execute('SELECT COUNT(*) FROM "file_hash_a"').fetchone() == (1,)
+
+
+def test_pending_files_survive_reconnect_and_merge_in_date_order(em, tmp_path):
+    db_path = str(tmp_path / "staging.duckdb")
+    connection = em.DuckDBStagingStore.open_connection(db_path)
+    store = em.DuckDBStagingStore(connection, "站内数据源")
+    store.append(pd.DataFrame({"日期": ["2024-01-03", "2024-01-01"], "计划": ["a1", "a0"]}), "a.xlsx", "hash_a")
+    store.append(pd.DataFrame({"日期": ["2024-01-02", "坏日期"], "计划": ["b0", "b1"]}), "b.xlsx", "hash_b")
+    connection.close()
+
+    connection = em.DuckDBStagingStore.open_connection(db_path)
+    restored = em.DuckDBStagingStore(connection, "站内数据源")
+    restored.restore()
+    pieces = list(restored.iter_query_pieces(restored.chunks, "日期"))
+    connection.close()
+
+    assert [chunk["file"] for chunk in restored.chunks] == ["a.xlsx", "b.xlsx"]
+    # 按日期排序，无法解析的日期排在最后；每段数据都属于单个文件
+    assert [(chunk["hash"], df["计划"].tolist()) for chunk, df in pieces] == [
+        ("hash_a", ["a0"]), ("hash_b", ["b0"]), ("hash_a", ["a1"]), ("hash_b", ["b1"])]
@@ -0,0 +1,74 @@
+import os
+
+import pandas as pd
+
+from conftest import read_sheet_rows
+
+NEW_ROWS = pd.DataFrame({"日期": ["2024-02-01", "2024-02-02"], "计划": ["a0", "a1"], "花费": [1, 2]})
+
+
+def read_bytes(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def fallback_path(master_file):
+    return os.path.join(os.path.dirname(master_file), "合并结果_主表.xlsx")
+
+
+def test_locked_master_keeps_verified_result_as_new_file(prepare_merge, master_file, monkeypatch):
+    merger = prepare_merge(master_file, [("a.xlsx", "hash_a", NEW_ROWS)])
+    original = read_bytes(master_file)
+
+    def locked(staged_path, path):
+        raise PermissionError("文件被占用")
+    monkeypatch.setattr(merger, "commit_staged_workbook", locked)
+    messages = []
+    merger.dialogs.showinfo = lambda title, message: messages.append(message)
+
+    merger.merge_files()
+
+    # 已校验的暂存文件改名为新文件，内容是完整的合并结果（含公式填充）
+    rows = read_sheet_rows(fallback_path(master_file))
+    assert [row[7] for row in rows] == ["p0", "p1", "p2", "a0", "a1"]
+    assert rows[4][0] == '=H6&"x"'
+    assert messages == [f"数据已成功合并并保存至新文件：\n{fallback_path(master_file)}"]
+    # 主表、合并记录都未改动，也没有遗留暂存文件
+    assert read_bytes(master_file) == original
+    assert merger.load_merge_manifest() == {}
+    assert merger.list_sidecar_state_files() == []
+    assert [name for name in os.listdir(os.path.dirname(master_file)) if ".saving-" in name] == []
+
+
+def test_error_before_saving_writes_workbook_to_new_file(prepare_merge, master_file, monkeypatch):
+    merger = prepare_merge(master_file, [("a.xlsx", "hash_a", NEW_ROWS)])
+    original = read_bytes(master_file)
+
+    def fail(*args, **kwargs):
+        raise OSError("公式填充失败")
+    monkeypatch.setattr(merger, "fill_sheet_formula", fail)
+
+    merger.merge_files()
+
+    assert [row[7] for row in read_sheet_rows(fallback_path(master_file))] == ["p0", "p1", "p2", "a0", "a1"]
+    assert read_bytes(master_file) == original
+    assert merger.dialogs.error_count == 0
+
+
+def test_failed_staging_does_not_write_new_file(prepare_merge, master_file, monkeypatch):
+    merger = prepare_merge(master_file, [("a.xlsx", "hash_a", NEW_ROWS)])
+    original = read_bytes(master_file)
+
+    def fail(book, path, sheet_names=()):
+        raise OSError("磁盘已满")
+    monkeypatch.setattr(merger, "stage_workbook", fail)
+    messages = []
+    merger.dialogs.showerror = lambda title, message: messages.append(message)
+
+    merger.merge_files()
+
+    # 保存暂存文件时出错，内存中的结果不可靠，不生成新文件
+    assert not os.path.exists(fallback_path(master_file))
+    assert len(messages) == 1 and "未生成新文件" in messages[0]
+    assert read_bytes(master_file) == original
+    assert merger.load_merge_manifest() == {}
@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+
+
+def chunk(seq):
+    return {"seq": seq, "file": f"file_{seq}.xlsx"}
+
+
+def new_state(merger, merged=None):
+    seen = np.empty(0, dtype=np.uint64) if merged is None else np.unique(merger.compute_row_fingerprints(merged))
+    return {"seen": seen, "duplicates": 0, "by_chunk": {}}
+
+
+def test_sorted_contains(em):
+    sorted_values = np.array([2, 5, 9], dtype=np.uint64)
+    values = np.array([1, 2, 6, 9, 10], dtype=np.uint64)
+
+    assert em.sorted_contains(sorted_values, values).tolist() == [False, True, False, True, False]
+    assert em.sorted_contains(np.empty(0, dtype=np.uint64), values).tolist() == [False] * 5
+
+
+def test_fingerprints_ignore_numeric_format_and_whitespace(merger):
+    excel = pd.DataFrame({"a": [1.0, 2.5], "b": ["计划", None]})
+    csv = pd.DataFrame({"x": ["1", "2.5"], "y": [" 计划 ", None]})
+
+    assert merger.compute_row_fingerprints(excel).tolist() == merger.compute_row_fingerprints(csv).tolist()
+
+
+def test_rows_already_merged_are_skipped(merger):
+    state = new_state(merger, pd.DataFrame({"a": [1, 2], "b": ["x", "y"]}))
+    df = pd.DataFrame({"a": [2, 3], "b": ["y", "z"]})
+
+    kept = list(merger.filter_duplicate_pieces([(chunk(0), df)], state))
+
+    assert kept[0][1]["a"].tolist() == [3]
+    assert state["duplicates"] == 1
+    assert len(state["seen"]) == 3
+    assert np.array_equal(state["seen"], np.sort(state["seen"]))
+
+
+def test_duplicates_across_chunks_are_dropped_but_kept_within_a_chunk(merger):
+    state = new_state(merger)
+    first = pd.DataFrame({"a": [1, 1, 2]})
+    second = pd.DataFrame({"a": [2, 4]})
+
+    kept = list(merger.filter_duplicate_pieces([(chunk(0), first), (chunk(1), second)], state))
+
+    assert [df["a"].tolist() for _, df in kept] == [[1, 1, 2], [4]]
+    assert state["duplicates"] == 1
+    # by_chunk只记录各数据块新增的指纹，撤销合并时据此从索引中移除
+    assert [len(np.concatenate(state["by_chunk"][seq])) for seq in (0, 1)] == [2, 1]
+    assert np.array_equal(state["seen"], np.unique(merger.compute_row_fingerprints(pd.DataFrame({"a": [1, 2, 4]}))))
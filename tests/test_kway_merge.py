@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def make_run(em, seq, keys, tag):
+    keys = np.asarray(keys, dtype=np.int64)
+    df = pd.DataFrame({"key": keys, "tag": [f"{tag}{i}" for i in range(len(keys))]})
+    return em.SortedRun({"seq": seq, "file": f"{tag}.xlsx"}, df, keys)
+
+
+def merged_tags(merger, runs):
+    return [tag for _, df in merger.kway_merge_sorted(runs) for tag in df["tag"]]
+
+
+def test_output_is_sorted_across_runs(merger, em):
+    runs = [make_run(em, 0, [1, 4, 7], "a"), make_run(em, 1, [2, 3, 8], "b"), make_run(em, 2, [5, 6], "c")]
+
+    pieces = list(merger.kway_merge_sorted(runs))
+
+    assert pd.concat([df for _, df in pieces])["key"].tolist() == [1, 2, 3, 4, 5, 6, 7, 8]
+    # 按段输出：每段都来自单个数据块，且数据块记录与数据对应
+    assert all(df["tag"].str[0].eq(chunk["file"][0]).all() for chunk, df in pieces)
+
+
+def test_equal_keys_keep_run_order(merger, em):
+    runs = [make_run(em, 0, [1, 2, 2], "a"), make_run(em, 1, [2, 2, 3], "b"), make_run(em, 2, [2], "c")]
+
+    assert merged_tags(merger, runs) == ["a0", "a1", "a2", "b0", "b1", "c0", "b2"]
+
+
+def test_spilled_runs_merge_identically_and_remove_batches(merger, em, tmp_path):
+    def build():
+        return [make_run(em, 0, [1, 3, 5, 7, 9], "a"), make_run(em, 1, [2, 3, 6, 10], "b")]
+    expected = merged_tags(merger, build())
+
+    runs = build()
+    for run in runs:
+        run.spill(str(tmp_path), batch_rows=2)
+    assert all(run.df is None for run in runs)
+    assert len(os.listdir(tmp_path)) == 5
+
+    assert merged_tags(merger, runs) == expected
+    assert os.listdir(tmp_path) == []
+
+
+def test_ordered_merge_interleaves_overlapping_files(merger):
+    merger.ordered_merge.set(True)
+    merger.order_columns["站内数据源"] = "日期"
+    store = merger.create_sub_store("站内数据源")
+    store.append(pd.DataFrame({"日期": ["2024-01-03", "2024-01-01"], "计划": ["a1", "a0"]}), "a_20240101_.xlsx", "ha")
+    store.append(pd.DataFrame({"日期": ["2024-01-02", "2024-01-04"], "计划": ["b0", "b1"]}), "b_20240101_.xlsx", "hb")
+    store.append(pd.DataFrame({"日期": ["2024-01-05"], "计划": ["c0"]}), "c_20240105_.xlsx", "hc")
+
+    pieces = list(merger.iter_merge_pieces("站内数据源", store, store.chunks))
+
+    assert [plan for _, df in pieces for plan in df["计划"]] == ["a0", "b0", "a1", "b1", "c0"]
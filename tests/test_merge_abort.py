@@ -0,0 +1,47 @@
+import os
+
+import pandas as pd
+
+from conftest import add_shop_sheet, read_sheet_rows
+
+NEW_ROWS = pd.DataFrame({"日期": ["2024-02-01", "2024-02-02"], "计划": ["a0", "a1"], "花费": [1, 2]})
+# 店铺成交数据源主表从H列起有2列，副表有3列，列数不匹配
+SHOP_ROWS = pd.DataFrame({"店铺": ["s"], "成交": [1], "多余": [0]})
+
+
+def merge_with_mismatch(prepare_merge, master_file):
+    add_shop_sheet(master_file)
+    with open(master_file, 'rb') as file:
+        original = file.read()
+    merger = prepare_merge(master_file, [("a_20240201_.xlsx", "hash_a", NEW_ROWS)])
+    prepare_merge(master_file, [("店铺_20240201_.xlsx", "hash_s", SHOP_ROWS)], sheet_name="店铺成交数据源")
+    merger.merge_files()
+    assert merger.dialogs.error_count == 1
+    with open(master_file, 'rb') as file:
+        assert file.read() == original
+    return merger
+
+
+def test_column_mismatch_discards_pending_columnar_partitions(prepare_merge, master_file, tmp_path):
+    columnar_dir = str(tmp_path / "columnar")
+    merger = prepare_merge(master_file, [])
+    merger.columnar_export_dir = columnar_dir
+    merger.export_columnar.set(True)
+
+    merge_with_mismatch(prepare_merge, master_file)
+
+    # 第一个工作表已导出到暂存目录的分区在中止时删除
+    assert not os.path.isdir(columnar_dir) or os.listdir(columnar_dir) == []
+    assert merger.list_sidecar_state_files() == []
+    assert [row[7] for row in read_sheet_rows(master_file)] == ["p0", "p1", "p2"]
+
+
+def test_column_mismatch_removes_shard_created_by_earlier_sheet(prepare_merge, master_file):
+    merger = prepare_merge(master_file, [])
+    merger.shard_config["max_rows"] = 5
+
+    merge_with_mismatch(prepare_merge, master_file)
+
+    # 站内数据源先写满主表并新建了分片，店铺成交数据源列数不匹配时分片删除，且未登记到分片记录
+    assert not [name for name in os.listdir(os.path.dirname(master_file)) if "分片" in name]
+    assert not os.path.exists(merger.get_sidecar_path("shards.json"))
@@ -0,0 +1,47 @@
+import openpyxl
+import pytest
+
+
+@pytest.mark.parametrize("formula, expected", [
+    ("=H2&\"x\"", "=H2&\"x\""),             # 删除区域上方不变
+    ("=H5", "=#REF!"),                        # 位于删除区域内
+    ("=H7+$H$10", "=H5+$H$7"),              # 两个区域之间上移2行，下方上移3行
+    ("=SUM(G2:G12)", "=SUM(G2:G9)"),          # 跨越两个区域的引用收缩
+    ("=SUM(G4:G8)", "=SUM(G4:G5)"),           # 起点位于删除区域内
+    ("=数据!H9", "=数据!H9"),                  # 其他工作表的引用不变
+    ("=[1]站内数据源!H9", "=[1]站内数据源!H9"),  # 外部工作簿的引用不变
+    ("=SUM(G:G)", "=SUM(G:G)"),              # 整列引用不含行号
+])
+def test_shift_formula_rows_applies_all_blocks(em, formula, expected):
+    # 删除第4到5行和第8行（删除前的行号）
+    assert em.shift_formula_rows(formula, [(8, 8), (4, 5)], "站内数据源", "站内数据源") == expected
+
+
+def test_delete_row_blocks_shifts_each_formula_once(em, tmp_path, monkeypatch):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "站内数据源"
+    for row in range(1, 11):
+        ws.append([f"=H{row}", None, None, None, None, None, None, f"v{row}"])
+    other = wb.create_sheet("汇总")
+    other["A1"] = "=SUM(站内数据源!H2:H10)"
+    other["A2"] = "=SUM(B1:B3)"
+    quoted = wb.create_sheet("O'Brien")
+    quoted["A1"] = "='站内数据源'!H10"
+    path = str(tmp_path / "book.xlsx")
+    wb.save(path)
+    parsed = []
+    shift = em.shift_formula_rows
+    monkeypatch.setattr(em, "shift_formula_rows", lambda formula, *args: parsed.append(formula) or shift(formula, *args))
+
+    book = em.OpenpyxlApp(visible=False).books.open(path)
+    book.sheets["站内数据源"].delete_row_blocks([(3, 4), (7, 7)])
+
+    ws = book.wb["站内数据源"]
+    assert [ws.cell(row=row, column=8).value for row in range(1, 8)] == ["v1", "v2", "v5", "v6", "v8", "v9", "v10"]
+    assert [ws.cell(row=row, column=1).value for row in range(1, 8)] == [f"=H{row}" for row in range(1, 8)]
+    assert book.wb["汇总"]["A1"].value == "=SUM(站内数据源!H2:H7)"
+    assert book.wb["O'Brien"]["A1"].value == "='站内数据源'!H7"
+    # 每个公式只解析一次，不引用该工作表的公式不解析
+    assert len(parsed) == 7 + 2
+    assert "=SUM(B1:B3)" not in parsed
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from conftest import read_sheet_rows
+
+FILE_A = pd.DataFrame({"日期": ["2024-02-01", "2024-02-02"], "计划": ["a0", "a1"], "花费": [10, 11]})
+FILE_B = pd.DataFrame({"日期": ["2024-02-03"], "计划": ["b0"], "花费": [20]})
+
+
+def merge(prepare_merge, master_file, files):
+    merger = prepare_merge(master_file, files)
+    merger.skip_duplicates.set(True)
+    merger.merge_files()
+    assert merger.dialogs.error_count == 0
+    return merger
+
+
+def data_rows(master_file):
+    return [row[6:] for row in read_sheet_rows(master_file)]
+
+
+def test_rollback_round_trip(prepare_merge, master_file):
+    merger = merge(prepare_merge, master_file, [("a.xlsx", "hash_a", FILE_A), ("b.xlsx", "hash_b", FILE_B)])
+    assert [row[1] for row in data_rows(master_file)] == ["p0", "p1", "p2", "a0", "a1", "b0"]
+    # 指纹索引包含主表原有的3行和本次写入的3行
+    fingerprint_path = merger.get_sidecar_path("fingerprints_站内数据源.npy")
+    assert len(np.load(fingerprint_path)) == 6
+
+    lineage = merger.load_lineage()
+    file_a = next(block["file_id"] for block in lineage if block["file"].endswith("a.xlsx"))
+    merger.rollback_file(file_a)
+
+    rows = read_sheet_rows(master_file)
+    assert [row[7] for row in rows] == ["p0", "p1", "p2", "b0"]
+    # 下方数据块上移后，公式仍引用本行
+    assert rows[3][0] == '=H5&"x"'
+    assert [(block["start_row"], block["end_row"]) for block in merger.load_lineage()] == [(5, 5)]
+    assert len(np.load(fingerprint_path)) == 4
+
+    # 撤销后同一文件可以重新合并，已保留的b文件行仍按指纹跳过
+    merge(prepare_merge, master_file, [("a.xlsx", "hash_a", FILE_A), ("b2.xlsx", "hash_b2", FILE_B)])
+    assert [row[1] for row in data_rows(master_file)] == ["p0", "p1", "p2", "b0", "a0", "a1"]
+    assert len(np.load(fingerprint_path)) == 6
+
+
+def test_rollback_snapshots_master_and_updates_loaded_rows(prepare_merge, master_file):
+    merger = merge(prepare_merge, master_file, [("a.xlsx", "hash_a", FILE_A), ("b.xlsx", "hash_b", FILE_B)])
+    merger.main_data["站内数据源"] = pd.read_excel(master_file, sheet_name="站内数据源")
+    with open(master_file, 'rb') as file:
+        merged = file.read()
+
+    merger.rollback_file("hash_a")
+
+    # 撤销前的主表保留在快照和上一版本中
+    [latest, _] = merger.list_snapshots()
+    assert latest["reason"] == "撤销合并前"
+    with open(f"{latest['path']}/主表.xlsx", 'rb') as file:
+        assert file.read() == merged
+    with open(merger.get_sidecar_path("previous_主表.xlsx"), 'rb') as file:
+        assert file.read() == merged
+    # 加载主表时读取的已有数据同步删除被撤销的行
+    assert merger.main_data["站内数据源"]["计划"].tolist() == ["p0", "p1", "p2", "b0"]
+
+
+def test_failed_staged_save_leaves_master_and_records_unchanged(prepare_merge, master_file, monkeypatch):
+    merger = merge(prepare_merge, master_file, [("a.xlsx", "hash_a", FILE_A)])
+    with open(master_file, 'rb') as file:
+        merged = file.read()
+    lineage = merger.load_lineage()
+    fingerprints = np.load(merger.get_sidecar_path("fingerprints_站内数据源.npy"))
+
+    def broken_verify(*args, **kwargs):
+        raise Exception("暂存文件已损坏")
+    monkeypatch.setattr(merger, "verify_staged_workbook", broken_verify)
+    merger.rollback_file("hash_a")
+
+    assert merger.dialogs.error_count == 1
+    with open(master_file, 'rb') as file:
+        assert file.read() == merged
+    assert merger.load_lineage() == lineage
+    assert np.array_equal(np.load(merger.get_sidecar_path("fingerprints_站内数据源.npy")), fingerprints)
+    assert "hash_a" in merger.load_merge_manifest()
+    assert not [name for name in os.listdir(os.path.dirname(master_file)) if ".saving-" in name]
@@ -0,0 +1,50 @@
+import json
+import os
+
+import pandas as pd
+
+from conftest import read_sheet_rows
+
+
+def new_rows(count, prefix):
+    return pd.DataFrame({"日期": ["2024-02-01"] * count, "计划": [f"{prefix}{i}" for i in range(count)], "花费": range(count)})
+
+
+def merge(prepare_merge, master_file, name, df, max_rows=6):
+    merger = prepare_merge(master_file, [(name, name, df)])
+    merger.shard_config["max_rows"] = max_rows
+    merger.merge_files()
+    assert merger.dialogs.error_count == 0
+    return merger
+
+
+def shard_path(master_file, number):
+    return os.path.join(os.path.dirname(master_file), f"主表_站内数据源_分片{number}.xlsx")
+
+
+def test_rows_beyond_max_rows_roll_over_into_a_shard(prepare_merge, master_file):
+    merger = merge(prepare_merge, master_file, "a.xlsx", new_rows(5, "a"))
+
+    # 主表第2到4行为已有数据，第5、6行写满到阈值，其余3行写入分片的第2到4行
+    assert [row[7] for row in read_sheet_rows(master_file)] == ["p0", "p1", "p2", "a0", "a1"]
+    shard_rows = read_sheet_rows(shard_path(master_file, 2))
+    assert [row[7] for row in shard_rows] == ["a2", "a3", "a4"]
+    assert [row[0] for row in shard_rows] == ['=H2&"x"', '=H3&"x"', '=H4&"x"']
+    with open(merger.get_sidecar_path("shards.json"), encoding='utf-8') as file:
+        assert [shard["path"] for shard in json.load(file)["站内数据源"]] == [shard_path(master_file, 2)]
+    blocks = [(block.get("workbook"), block["start_row"], block["end_row"]) for block in merger.load_lineage()]
+    assert blocks == [(None, 5, 6), (shard_path(master_file, 2), 2, 4)]
+
+
+def test_full_shard_rolls_over_into_the_next_one(prepare_merge, master_file):
+    # 恰好写到阈值所在的行不创建分片
+    merge(prepare_merge, master_file, "a.xlsx", new_rows(2, "a"))
+    assert not os.path.exists(shard_path(master_file, 2))
+
+    merge(prepare_merge, master_file, "b.xlsx", new_rows(3, "b"))
+    # 已分片的工作表之后的合并直接写入当前分片，写满后创建下一个分片
+    merge(prepare_merge, master_file, "c.xlsx", new_rows(3, "c"))
+
+    assert [row[7] for row in read_sheet_rows(master_file)] == ["p0", "p1", "p2", "a0", "a1"]
+    assert [row[7] for row in read_sheet_rows(shard_path(master_file, 2))] == ["b0", "b1", "b2", "c0", "c1"]
+    assert [row[7] for row in read_sheet_rows(shard_path(master_file, 3))] == ["c2"]
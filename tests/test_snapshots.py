@@ -0,0 +1,91 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import read_sheet_rows
+
+
+def read_bytes(path):
+    with open(path, 'rb') as file:
+        return file.read()
+
+
+def write_json(path, data):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(data, file)
+
+
+def test_clone_file_copies_content_independently(em, tmp_path):
+    source = tmp_path / "source.xlsx"
+    source.write_bytes(b"original" * 1000)
+    target = tmp_path / "target.xlsx"
+
+    assert em.clone_file(str(source), str(target)) in ("reflink", "copy")
+    assert target.read_bytes() == source.read_bytes()
+
+    source.write_bytes(b"changed")
+    assert target.read_bytes() == b"original" * 1000
+
+
+def test_snapshots_are_listed_newest_first_and_pruned(merger, master_file):
+    merger.main_file = master_file
+    merger.snapshot_config["keep"] = 2
+    created = [merger.create_snapshot(reason=f"第{i}次")[0] for i in range(3)]
+
+    snapshots = merger.list_snapshots()
+
+    assert [snapshot["path"] for snapshot in snapshots] == created[:0:-1]
+    assert [snapshot["reason"] for snapshot in snapshots] == ["第2次", "第1次"]
+    assert not os.path.exists(created[0])
+    assert snapshots[0]["size"] == os.path.getsize(master_file)
+
+
+def test_restore_returns_master_and_sidecar_to_snapshot(merger, master_file):
+    merger.main_file = master_file
+    manifest_path = merger.get_sidecar_path("manifest.json")
+    write_json(manifest_path, {"hash_a": {"file": "a.xlsx"}})
+    original = read_bytes(master_file)
+    snapshot_dir, _ = merger.create_snapshot()
+
+    with open(master_file, 'ab') as file:
+        file.write(b"not a workbook anymore")
+    write_json(manifest_path, {"hash_a": {}, "hash_b": {}})
+    write_json(merger.get_sidecar_path("lineage.json"), [])
+    merger.restore_snapshot(snapshot_dir)
+
+    assert read_bytes(master_file) == original
+    assert merger.list_sidecar_state_files() == ["manifest.json"]
+    with open(manifest_path, encoding='utf-8') as file:
+        assert json.load(file) == {"hash_a": {"file": "a.xlsx"}}
+    # 被替换的主表保留为上一版本
+    assert read_bytes(merger.get_sidecar_path("previous_主表.xlsx")).endswith(b"not a workbook anymore")
+
+
+def test_restore_rejects_empty_snapshot_and_keeps_master(merger, master_file):
+    merger.main_file = master_file
+    snapshot_dir, _ = merger.create_snapshot()
+    open(os.path.join(snapshot_dir, "主表.xlsx"), 'wb').close()
+    original = read_bytes(master_file)
+
+    with pytest.raises(Exception, match="为空"):
+        merger.restore_snapshot(snapshot_dir)
+
+    assert read_bytes(master_file) == original
+    assert not [name for name in os.listdir(os.path.dirname(master_file)) if ".restoring-" in name]
+
+
+def test_merge_snapshot_restores_pre_merge_state(prepare_merge, master_file):
+    new_rows = pd.DataFrame({"日期": ["2024-02-01"], "计划": ["新计划"], "花费": [1]})
+    merger = prepare_merge(master_file, [("a.xlsx", "hash_a", new_rows)])
+    merger.skip_duplicates.set(True)
+    merger.merge_files()
+    assert [row[7] for row in read_sheet_rows(master_file)] == ["p0", "p1", "p2", "新计划"]
+    [snapshot] = merger.list_snapshots()
+
+    merger.restore_snapshot(snapshot["path"])
+
+    # 快照在替换主表之前创建，恢复后主表和合并记录都回到合并前
+    assert [row[7] for row in read_sheet_rows(master_file)] == ["p0", "p1", "p2"]
+    assert merger.list_sidecar_state_files() == []
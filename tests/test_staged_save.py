@@ -0,0 +1,68 @@
+import os
+import struct
+import zipfile
+
+import pytest
+
+from conftest import read_sheet_rows
+
+
+def open_master(em, path):
+    return em.OpenpyxlApp(visible=False).books.open(path)
+
+
+def staged_files(path):
+    return [name for name in os.listdir(os.path.dirname(path)) if ".saving-" in name]
+
+
+def test_stage_and_commit_replace_master_and_keep_previous(em, merger, master_file):
+    merger.main_file = master_file
+    with open(master_file, 'rb') as file:
+        original = file.read()
+    book = open_master(em, master_file)
+    book.sheets["站内数据源"].range("G5").value = [["2024-02-01", "新计划", 5]]
+
+    staged_path = merger.stage_workbook(book, master_file, ["站内数据源"])
+
+    # 暂存文件与主表在同一目录，提交前主表保持不变
+    assert os.path.dirname(staged_path) == os.path.dirname(master_file)
+    with open(master_file, 'rb') as file:
+        assert file.read() == original
+    merger.commit_staged_workbook(staged_path, master_file)
+    assert not os.path.exists(staged_path)
+    assert read_sheet_rows(master_file)[3][7] == "新计划"
+    with open(merger.get_sidecar_path("previous_主表.xlsx"), 'rb') as file:
+        assert file.read() == original
+
+
+def test_missing_sheet_fails_verification_and_removes_staged_file(em, merger, master_file):
+    merger.main_file = master_file
+    with open(master_file, 'rb') as file:
+        original = file.read()
+    book = open_master(em, master_file)
+
+    with pytest.raises(Exception, match="缺少工作表：店铺成交数据源"):
+        merger.stage_workbook(book, master_file, ["站内数据源", "店铺成交数据源"])
+
+    assert staged_files(master_file) == []
+    with open(master_file, 'rb') as file:
+        assert file.read() == original
+
+
+def test_verification_rejects_empty_and_corrupt_files(merger, master_file, tmp_path):
+    empty = tmp_path / "empty.xlsx"
+    empty.write_bytes(b"")
+    with pytest.raises(Exception, match="为空"):
+        merger.verify_staged_workbook(str(empty))
+
+    # 改动压缩数据中的一个字节，使对应部件的CRC校验失败
+    data = bytearray(open(master_file, 'rb').read())
+    with zipfile.ZipFile(master_file) as archive:
+        info = archive.getinfo("xl/worksheets/sheet1.xml")
+    name_length, extra_length = struct.unpack("<HH", data[info.header_offset + 26:info.header_offset + 30])
+    offset = info.header_offset + 30 + name_length + extra_length + info.compress_size // 2
+    data[offset] ^= 0xFF
+    corrupt = tmp_path / "corrupt.xlsx"
+    corrupt.write_bytes(bytes(data))
+    with pytest.raises(Exception):
+        merger.verify_staged_workbook(str(corrupt))
@@ -0,0 +1,67 @@
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+
+def make_store(em, frames):
+    store = em.SubDataStore()
+    for i, df in enumerate(frames):
+        store.append(df, f"file_{i}.xlsx", f"hash_{i}")
+    return store
+
+
+def make_store_for(merger, frames):
+    store = merger.create_sub_store("站内数据源")
+    for i, df in enumerate(frames):
+        store.append(df, f"file_{i}.xlsx", f"hash_{i}")
+    return store
+
+
+def test_chunks_iterate_in_load_order(em):
+    frames = [pd.DataFrame({"a": [1, 2], "b": ["x", "y"]}), pd.DataFrame({"a": [3], "b": ["z"]})]
+    store = make_store(em, frames)
+
+    assert len(store) == 3
+    assert store.file_row_counts() == [("file_0.xlsx", 2), ("file_1.xlsx", 1)]
+    assert [path for path, _ in store.iter_chunks()] == ["file_0.xlsx", "file_1.xlsx"]
+    assert_frame_equal(store.to_frame(), pd.concat(frames, ignore_index=True))
+
+
+def test_spilled_chunk_reads_back_with_original_columns(em, tmp_path):
+    df = pd.DataFrame({1: [1.5, 2.5], "计划": ["a", "b"]})
+    store = make_store(em, [df, pd.DataFrame({1: [3.5], "计划": ["c"]})])
+
+    freed = store.spill_chunk(store.chunks[0], str(tmp_path))
+
+    assert freed > 0
+    assert store.chunks[0]["spill_path"].endswith(".parquet")
+    assert store.in_memory_chunks() == [store.chunks[1]]
+    assert_frame_equal(store.load_chunk(store.chunks[0]), df)
+    assert len(store) == 3
+    # 已溢出的数据块再次溢出不会重复写入
+    assert store.spill_chunk(store.chunks[0], str(tmp_path)) == 0
+
+
+def test_mixed_type_chunk_falls_back_to_pickle(em, tmp_path):
+    df = pd.DataFrame({"混合": [1, "二", 3.0]})
+    store = make_store(em, [df])
+
+    store.spill_chunk(store.chunks[0], str(tmp_path))
+
+    assert store.chunks[0]["spill_path"].endswith(".pkl.gz")
+    assert_frame_equal(store.load_chunk(store.chunks[0]), df)
+
+
+def test_memory_budget_spills_chunks_and_keeps_data(merger):
+    frames = [pd.DataFrame({"a": range(i * 10, i * 10 + 10)}) for i in range(3)]
+    merger.sub_data = {"站内数据源": make_store_for(merger, frames)}
+
+    merger.memory_budget_mb = 0
+    merger.enforce_memory_budget()
+    assert len(merger.sub_data["站内数据源"].in_memory_chunks()) == 3
+
+    # 预算远小于进程占用时全部数据块溢出，数据仍可按原顺序读回
+    merger.memory_budget_mb = 1
+    merger.enforce_memory_budget()
+    store = merger.sub_data["站内数据源"]
+    assert store.in_memory_chunks() == []
+    assert store.to_frame()["a"].tolist() == list(range(30))
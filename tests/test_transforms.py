@@ -0,0 +1,81 @@
+import openpyxl
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def source():
+    return pd.DataFrame({"日期": ["2024-01-02", "2024-01-03", None], "计划": ["a", "b", "c"],
+                         "花费": ["10", "2.6", "x"], "点击": [5, 0, 2]})
+
+
+def test_cast_changes_data_but_keeps_original_columns(merger, source):
+    steps = [{"op": "rename", "columns": {"花费": "cost"}},
+             {"op": "cast", "columns": {"cost": "int", "日期": "date"}}]
+
+    data, derived = merger.apply_transforms("站内数据源", source, steps)
+
+    assert list(data.columns) == list(source.columns)
+    assert derived.shape == (3, 0)
+    # 可空整数和日期转换为Excel可写入的值，缺失值为None
+    assert data["花费"].tolist() == [10, 3, None]
+    assert data["日期"].tolist()[:2] == [pd.Timestamp("2024-01-02"), pd.Timestamp("2024-01-03")]
+    assert data["日期"].iloc[2] is None
+    assert source["花费"].tolist() == ["10", "2.6", "x"]
+
+
+def test_derived_columns_are_returned_by_target_letter(merger, source):
+    steps = [{"op": "cast", "columns": {"花费": "float"}},
+             {"op": "derive", "target": "E", "expr": "花费 / 点击"},
+             {"op": "concat", "target": "B", "columns": ["计划", "点击"], "sep": "-"},
+             {"op": "date", "target": "C", "column": "日期", "format": "%Y/%m/%d"}]
+
+    data, derived = merger.apply_transforms("站内数据源", source, steps)
+
+    assert list(derived.columns) == ["B", "C", "E"]
+    assert derived["B"].tolist() == ["a-5", "b-0", "c-2"]
+    assert derived["C"].tolist()[:2] == ["2024/01/02", "2024/01/03"]
+    assert pd.isna(derived["C"].iloc[2])
+    assert derived["E"].iloc[0] == 2
+    assert list(data.columns) == list(source.columns)
+
+
+def test_lookup_matches_normalized_keys_with_default(merger, source):
+    steps = [{"op": "lookup", "target": "D", "column": "点击", "mapping": {"5": "五", 2.0: "二"}, "default": "未知"}]
+
+    _, derived = merger.apply_transforms("站内数据源", source, steps)
+
+    assert derived["D"].tolist() == ["五", "未知", "二"]
+
+
+def test_lookup_reads_mapping_sheet_from_master(merger, source, tmp_path):
+    path = str(tmp_path / "主表.xlsx")
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "映射"
+    for row in (["计划", "负责人"], ["a", "张三"], ["b", "李四"], ["a", "重复"]):
+        ws.append(row)
+    wb.save(path)
+    merger.main_file = path
+    steps = [{"op": "lookup", "target": "D", "column": "计划", "sheet": "映射", "key": "计划", "value": "负责人"}]
+
+    _, derived = merger.apply_transforms("站内数据源", source, steps)
+
+    assert derived["D"].tolist()[:2] == ["张三", "李四"]
+    assert pd.isna(derived["D"].iloc[2])
+    assert ("映射", "计划", "负责人") in merger.lookup_cache
+
+
+def test_unknown_column_and_step_raise(merger, source):
+    with pytest.raises(Exception, match="找不到列"):
+        merger.apply_transforms("站内数据源", source, [{"op": "concat", "target": "B", "columns": ["不存在"]}])
+    with pytest.raises(Exception, match="不支持的计算步骤"):
+        merger.apply_transforms("站内数据源", source, [{"op": "pivot", "target": "B"}])
+
+
+def test_integer_dates_parse_as_yyyymmdd(merger):
+    df = pd.DataFrame({"日期": [20240102, 20240131]})
+
+    data, _ = merger.apply_transforms("站内数据源", df, [{"op": "cast", "columns": {"日期": "date"}}])
+
+    assert data["日期"].tolist() == [pd.Timestamp("2024-01-02"), pd.Timestamp("2024-01-31")]
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+EXPECTED = pd.DataFrame({"日期": ["2024-02-01", "2024-02-02", "2024-02-03", "2024-02-04", "2024-02-05"],
+                         "计划": ["a0", "a1", "a2", "a3", "a4"], "花费": [0, 1, 2, 3, 4]})
+
+
+def test_verify_classifies_mismatched_missing_and_shifted_rows(em, merger, master_file):
+    sheet = em.OpenpyxlApp(visible=False).books.open(master_file).sheets["站内数据源"]
+    written = EXPECTED.values.tolist()
+    written[1][2] = 99                          # 第6行内容不一致
+    written[2] = [None, None, None]             # 第7行缺失
+    written[3], written[4] = written[4], written[3]  # 第8、9行错位
+    sheet.range("G5").value = written
+
+    result = merger.verify_written_rows(sheet, "G", 3, np.arange(5, 10), merger.compute_verify_hashes(EXPECTED))
+
+    assert result == {"checked": 5, "mismatched": [6], "missing": [7], "shifted": [8, 9]}
+
+
+def test_verify_reads_runs_in_batches_and_keeps_last_update(em, merger, master_file):
+    sheet = em.OpenpyxlApp(visible=False).books.open(master_file).sheets["站内数据源"]
+    sheet.range("G5").value = EXPECTED.values.tolist()
+    hashes = merger.compute_verify_hashes(EXPECTED)
+    # 第2行先按旧内容更新、再按第5行内容更新，以最后一次写入为准；第3、4行不在校验范围内
+    rows = np.array([2, 2, 5, 6, 7, 8, 9])
+    old = merger.compute_verify_hashes(pd.DataFrame([["2024-01-01", "p0", 0]]))
+    sheet.range("G2").value = [EXPECTED.values.tolist()[0]]
+
+    result = merger.verify_written_rows(sheet, "G", 3, rows, np.concatenate([old, hashes[:1], hashes]), batch_rows=2)
+
+    assert result == {"checked": 6, "mismatched": [], "missing": [], "shifted": []}
+
+
+def test_merge_with_verification_reports_success(prepare_merge, master_file):
+    merger = prepare_merge(master_file, [("a.xlsx", "hash_a", EXPECTED)])
+    merger.verify_after_merge.set(True)
+    messages = []
+    update_status = merger.update_status
+    merger.update_status = lambda message, level='info': (messages.append(message), update_status(message, level=level))
+
+    merger.merge_files()
+
+    assert any(message.startswith("写入校验通过：5行全部一致") for message in messages)
+    assert merger.dialogs.error_count == 0
+
+
+def test_merge_with_verification_warns_about_changed_rows(prepare_merge, master_file, monkeypatch):
+    merger = prepare_merge(master_file, [("a.xlsx", "hash_a", EXPECTED)])
+    merger.verify_after_merge.set(True)
+    verify_written_rows = merger.verify_written_rows
+
+    def overwrite_then_verify(sheet, start_col, columns_count, rows, hashes, batch_rows=50000):
+        sheet.range("H7").value = "被改动"
+        return verify_written_rows(sheet, start_col, columns_count, rows, hashes, batch_rows)
+    monkeypatch.setattr(merger, "verify_written_rows", overwrite_then_verify)
+    warnings = []
+    merger.dialogs.showwarning = lambda title, message: warnings.append(message)
+
+    merger.merge_files()
+
+    assert warnings == ["以下行的写入结果与副表数据不一致：\n站内数据源：1行内容不一致（第7行）"]
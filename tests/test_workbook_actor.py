@@ -0,0 +1,114 @@
+import threading
+
+import openpyxl
+
+from conftest import read_sheet_rows
+
+
+class RecordingSheet:
+    """记录每次公式写入的区域、内容和执行线程，failing中的区域写入时抛出异常"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.writes = []
+
+    def range(self, address):
+        return RecordingRange(self, address)
+
+
+class RecordingRange:
+    def __init__(self, sheet, address):
+        self.sheet = sheet
+        self.address = address
+
+    @property
+    def formula(self):
+        return None
+
+    @formula.setter
+    def formula(self, value):
+        if self.address in self.sheet.failing:
+            raise OSError(f"无法写入{self.address}")
+        self.sheet.writes.append((self.address, value, threading.current_thread()))
+
+
+def formulas(col, start, end):
+    return [f"={col}{row}" for row in range(start, end + 1)]
+
+
+def test_coalesce_merges_adjacent_columns_with_the_same_rows(em):
+    actor = em.WorkbookActor(RecordingSheet(), max_cells=6)
+    commands = [("formula", 2, 3, 4, formulas("B", 3, 4)), ("formula", 1, 3, 4, formulas("A", 3, 4)),
+                ("formula", 3, 3, 4, formulas("C", 3, 4)), ("formula", 4, 3, 4, formulas("D", 3, 4)),
+                ("formula", 1, 5, 5, formulas("A", 5, 5)), ("formula", 6, 5, 5, formulas("F", 5, 5))]
+
+    groups = list(actor.coalesce(commands))
+
+    # A到C列合并为一次写入（不超过6个单元格），D列单独写入；不相邻的F列不合并
+    assert [(cols, start, end) for cols, start, end, _ in groups] == [
+        ([1, 2, 3], 3, 4), ([4], 3, 4), ([1], 5, 5), ([6], 5, 5)]
+    assert groups[0][3] == [["=A3", "=B3", "=C3"], ["=A4", "=B4", "=C4"]]
+
+
+def test_producers_submit_and_the_running_thread_writes(em):
+    sheet = RecordingSheet()
+    actor = em.WorkbookActor(sheet, max_pending=2)
+    calls = []
+
+    def produce(col):
+        for start in (3, 6):
+            actor.submit(("formula", em.column_index(col), start, start + 2, formulas(col, start, start + 2)))
+        actor.submit(("call", lambda: calls.append(threading.current_thread())))
+        actor.submit(None)
+    producers = [threading.Thread(target=produce, args=(col,)) for col in "AB"]
+    for producer in producers:
+        producer.start()
+    actor.run(len(producers), on_error=lambda cols, error: None)
+    for producer in producers:
+        producer.join()
+
+    # 所有工作表调用都在执行run的线程中执行
+    assert {thread for _, _, thread in sheet.writes} | set(calls) == {threading.current_thread()}
+    cells = {}
+    for address, value, _ in sheet.writes:
+        first, last = address.split(":")
+        cols = [chr(code) for code in range(ord(first[0]), ord(last[0]) + 1)]
+        for offset, row in enumerate(value):
+            for col, formula in zip(cols, row):
+                cells[f"{col}{int(first[1:]) + offset}"] = formula
+    assert cells == {f"{col}{row}": f"={col}{row}" for col in "AB" for row in range(3, 9)}
+    assert actor.submitted == 4 and actor.calls == len(sheet.writes) <= 4
+
+
+def test_failed_block_is_retried_per_column_and_failed_column_skipped(em):
+    sheet = RecordingSheet(failing={"A3:B4", "B3:B4"})
+    actor = em.WorkbookActor(sheet)
+    errors = []
+    for col in "AB":
+        actor.submit(("formula", em.column_index(col), 3, 4, formulas(col, 3, 4)))
+    actor.submit(("formula", 2, 5, 5, formulas("B", 5, 5)))
+    actor.submit(None)
+
+    actor.run(1, on_error=lambda cols, error: errors.append((cols, str(error))))
+
+    # 合并写入失败后逐列重试，只有单独写入也失败的B列标记为失败，之后的B列命令不再写入
+    assert [(address, value) for address, value, _ in sheet.writes] == [("A3:A4", [["=A3"], ["=A4"]])]
+    assert errors == [([2], "无法写入B3:B4")]
+    assert actor.failed_columns == {2}
+
+
+def test_fill_sheet_formula_fills_new_rows_through_the_actor(em, merger, master_file):
+    wb = openpyxl.load_workbook(master_file)
+    ws = wb["站内数据源"]
+    ws["B2"].value = "=I2*2"
+    for row in range(5, 8):
+        ws.cell(row=row, column=8, value=f"n{row}")
+    wb.save(master_file)
+    book = em.OpenpyxlApp(visible=False).books.open(master_file)
+
+    merger.fill_sheet_formula(book, "站内数据源", "F")
+    book.save(master_file)
+
+    rows = read_sheet_rows(master_file)
+    assert [row[0] for row in rows] == [f'=H{row}&"x"' for row in range(2, 8)]
+    assert [row[1] for row in rows] == ["=I2*2"] + [f"=I{row}*2" for row in range(3, 8)]
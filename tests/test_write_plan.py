@@ -0,0 +1,70 @@
+import numpy as np
+import openpyxl
+import pandas as pd
+
+from conftest import add_shop_sheet, read_sheet_rows
+
+
+def open_sheet(em, path, sheet_name):
+    return em.OpenpyxlApp(visible=False).books.open(path).sheets[sheet_name]
+
+
+def test_plan_groups_adjacent_columns_into_runs(em, merger, master_file):
+    add_shop_sheet(master_file)
+    sheet = open_sheet(em, master_file, "店铺成交数据源")
+
+    plan = merger.plan_sheet_writes(sheet, "店铺成交数据源", 2, derived_columns=["J", "L"])
+
+    # A列为公式，B到F列没有模板不在此写入；日期列G、数据列H:I与派生列J相邻，合并为一个区间
+    assert plan["sources"] == {1: ("formula", "=H2"), 7: ("date", None), 8: ("data", 0), 9: ("data", 1),
+                               10: ("derived", "J"), 12: ("derived", "L")}
+    assert plan["runs"] == [[1, 1], [7, 10], [12, 12]]
+    assert plan["formula_columns"] == ["A"]
+    # 逐列写入时每块：数据1次、日期列1次、派生列J和L各1次
+    assert plan["legacy_calls_per_chunk"] == 4
+
+
+def test_plan_skips_external_references_and_uses_header_template(em, merger, master_file):
+    wb = openpyxl.load_workbook(master_file)
+    ws = wb["站内数据源"]
+    ws["A2"].value = "='[外部.xlsx]表1'!A1"
+    ws["B1"].value = "=G1"
+    wb.save(master_file)
+    sheet = open_sheet(em, master_file, "站内数据源")
+
+    plan = merger.plan_sheet_writes(sheet, "站内数据源", 3)
+
+    assert plan["formula_columns"] == ["B"]
+    assert plan["runs"] == [[2, 2], [7, 9]]
+    assert plan["legacy_calls_per_chunk"] == 1
+
+
+def test_run_block_adjusts_formulas_and_fills_dates_per_row(em, merger, master_file):
+    add_shop_sheet(master_file)
+    plan = merger.plan_sheet_writes(open_sheet(em, master_file, "店铺成交数据源"), "店铺成交数据源", 2)
+    values = np.array([["s0", 1], ["s1", 2]], dtype=object)
+
+    formulas = merger.build_run_block(plan, 1, 1, 5, values, 20240201, None)
+    data = merger.build_run_block(plan, 7, 9, 5, values, np.array([20240201, 20240202], dtype=object), None)
+
+    assert formulas.tolist() == [["=H5"], ["=H6"]]
+    assert data.tolist() == [[20240201, "s0", 1], [20240202, "s1", 2]]
+
+
+def test_merge_writes_dates_data_and_formulas_in_one_pass(prepare_merge, master_file):
+    add_shop_sheet(master_file)
+    merger = prepare_merge(master_file, [
+        ("店铺_20240201_.xlsx", "hash_a", pd.DataFrame({"店铺": ["s0"], "成交": [1]})),
+        ("店铺_20240202_.xlsx", "hash_b", pd.DataFrame({"店铺": ["s1", "s2"], "成交": [2, 3]})),
+    ], sheet_name="店铺成交数据源")
+    messages = []
+    update_status = merger.update_status
+    merger.update_status = lambda message, level='info': (messages.append(message), update_status(message, level=level))
+
+    merger.merge_files()
+
+    rows = read_sheet_rows(master_file, "店铺成交数据源")
+    assert [[row[0], row[6], row[7], row[8]] for row in rows] == [
+        ["=H2", 20240101, "店铺0", 0], ["=H3", 20240201, "s0", 1], ["=H4", 20240202, "s1", 2], ["=H5", 20240202, "s2", 3]]
+    # 两个文件的数据段缓冲后一次写入：公式列和日期加数据列各一次
+    assert any(message.startswith("店铺成交数据源工作表写入3行，共2次写入") for message in messages)
@@ -0,0 +1,219 @@
+import io
+import os
+import zipfile
+from datetime import datetime
+
+import openpyxl
+import pandas as pd
+import pytest
+
+from conftest import read_sheet_rows
+
+
+@pytest.fixture
+def workbook_path(master_file):
+    wb = openpyxl.load_workbook(master_file)
+    # 新行沿用第2行同列的样式，日期列需要日期格式才能读回日期
+    wb["站内数据源"]["G2"].number_format = "yyyy-mm-dd"
+    other = wb.create_sheet("店铺成交数据源")
+    other.append(["A", "B", "C", "D", "E", "F", "日期", "店铺"])
+    other.append(["=H2", None, None, None, None, None, "2024-01-01", "旧店铺"])
+    notes = wb.create_sheet("说明")
+    notes["A1"] = "不参与合并"
+    wb.save(master_file)
+    return master_file
+
+
+def open_book(em, path):
+    return em.ZipAppendApp(visible=False).books.open(path)
+
+
+def read_entries(path):
+    with zipfile.ZipFile(path) as archive:
+        return {name: archive.read(name) for name in archive.namelist()}
+
+
+def read_raw_entries(path):
+    """返回每个条目的(压缩方式, CRC, 压缩数据)，压缩数据按本地文件头定位后原样读取"""
+    import struct
+    entries = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as file:
+        for info in archive.infolist():
+            file.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', file.read(4))
+            file.seek(info.header_offset + 30 + name_length + extra_length)
+            entries[info.filename] = (info.compress_type, info.CRC, file.read(info.compress_size))
+    return entries
+
+
+def test_appended_rows_reload_with_openpyxl(em, workbook_path):
+    before = read_entries(workbook_path)
+    raw_before = read_raw_entries(workbook_path)
+    book = open_book(em, workbook_path)
+    sheet = book.sheets["站内数据源"]
+    assert sheet.last_value_row(em.column_index("G")) == 4
+    assert sheet.template_formulas[1] == '=H2&"x"'
+
+    sheet.range("G5").value = [["2024-02-01", "新计划", 1.5], [datetime(2024, 2, 2), "含<特殊>&字符", 2]]
+    sheet.range("A5:A6").formula = [['=H5&"x"'], ['=H6&"x"']]
+    book.save()
+    book.close()
+
+    rows = read_sheet_rows(workbook_path)
+    assert [row[6:] for row in rows[3:]] == [["2024-02-01", "新计划", 1.5], [datetime(2024, 2, 2), "含<特殊>&字符", 2]]
+    assert [row[0] for row in rows] == ['=H2&"x"', '=H3&"x"', '=H4&"x"', '=H5&"x"', '=H6&"x"']
+    reloaded = openpyxl.load_workbook(workbook_path)
+    assert reloaded["站内数据源"].dimensions == "A1:I6"
+    assert reloaded["说明"]["A1"].value == "不参与合并"
+    assert reloaded.calculation.fullCalcOnLoad
+
+    # 未改动的部件按原样复制；openpyxl保存的工作簿已设置打开时重算，workbook.xml也可能不变
+    after = read_entries(workbook_path)
+    changed = {name for name in before if before[name] != after.get(name)}
+    assert changed - {"xl/workbook.xml"} == {"xl/worksheets/sheet1.xml"}
+    assert set(after) == set(before)
+    # 未改动部件的压缩数据不经解压和重新压缩，逐字节相同
+    raw_after = read_raw_entries(workbook_path)
+    assert all(raw_after[name] == raw_before[name] for name in before if name not in changed)
+
+
+def test_two_sheets_are_saved_in_one_pass(em, workbook_path):
+    book = open_book(em, workbook_path)
+    book.sheets["站内数据源"].range("G5").value = [["2024-02-01", "计划", 3]]
+    book.sheets["店铺成交数据源"].range("G3").value = [["2024-02-01", "新店铺"]]
+    book.save()
+    # 保存后可以继续追加
+    book.sheets["站内数据源"].range("G6").value = [["2024-02-02", "计划2", 4]]
+    book.save()
+    book.close()
+
+    assert [row[7] for row in read_sheet_rows(workbook_path)] == ["p0", "p1", "p2", "计划", "计划2"]
+    assert read_sheet_rows(workbook_path, "店铺成交数据源")[1][6:] == ["2024-02-01", "新店铺"]
+
+
+def test_existing_rows_cannot_be_rewritten(em, workbook_path):
+    sheet = open_book(em, workbook_path).sheets["站内数据源"]
+
+    with pytest.raises(NotImplementedError):
+        sheet.range("G4").value = [["x"]]
+
+
+def test_content_below_last_start_column_value_is_rejected(em, merger, workbook_path):
+    wb = openpyxl.load_workbook(workbook_path)
+    wb["站内数据源"]["A8"] = '=H8&"x"'
+    wb.save(workbook_path)
+    sheet = open_book(em, workbook_path).sheets["站内数据源"]
+
+    with pytest.raises(Exception, match="还有其他内容"):
+        merger.find_append_row(sheet, "G")
+    assert merger.find_append_row(sheet, "A") == 9
+
+
+def test_package_writer_copies_entries_with_data_descriptors(em, tmp_path):
+    class Unseekable(io.RawIOBase):
+        """不可定位的输出流，zipfile写入时在数据后使用数据描述符"""
+        def __init__(self, file):
+            self.file = file
+
+        def writable(self):
+            return True
+
+        def write(self, data):
+            return self.file.write(data)
+
+    source_path = tmp_path / "source.zip"
+    with open(source_path, 'wb') as file, zipfile.ZipFile(Unseekable(file), 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("xl/数据.xml", "<a>" + "x" * 5000 + "</a>")
+        archive.writestr(zipfile.ZipInfo("stored.bin"), b"\x00\x01" * 100)
+    target_path = tmp_path / "target.zip"
+
+    with zipfile.ZipFile(source_path) as source, open(source_path, 'rb') as source_file:
+        with em.ZipPackageWriter(str(target_path)) as writer:
+            for info in source.infolist():
+                writer.copy_entry(source_file, info)
+            with writer.open(zipfile.ZipInfo("new.xml")) as output:
+                output.write(b"<new/>")
+
+    with zipfile.ZipFile(target_path) as target:
+        assert target.testzip() is None
+        assert target.read("xl/数据.xml") == ("<a>" + "x" * 5000 + "</a>").encode()
+        assert target.getinfo("stored.bin").compress_type == zipfile.ZIP_STORED
+        assert target.read("new.xml") == b"<new/>"
+
+
+def test_staged_save_verifies_only_rewritten_parts(em, merger, workbook_path, monkeypatch):
+    merger.main_file = workbook_path
+    book = open_book(em, workbook_path)
+    book.sheets["站内数据源"].range("G5").value = [["2024-02-01", "计划", 3]]
+
+    # 暂存校验不解压整个zip包
+    monkeypatch.setattr(zipfile.ZipFile, "testzip", lambda archive: pytest.fail("不应解压校验全部部件"))
+    staged_path = merger.stage_workbook(book, workbook_path, ["站内数据源"])
+    monkeypatch.undo()
+
+    assert book.rewritten_parts == ["xl/workbook.xml", "xl/worksheets/sheet1.xml"]
+    merger.commit_staged_workbook(staged_path, workbook_path)
+    assert read_sheet_rows(workbook_path)[3][7] == "计划"
+
+
+def test_changed_sheets_are_built_in_worker_processes(em, workbook_path, monkeypatch):
+    import concurrent.futures
+    pools = []
+
+    class RecordingPool(concurrent.futures.ProcessPoolExecutor):
+        def __init__(self, max_workers=None):
+            super().__init__(max_workers=max_workers)
+            pools.append(max_workers)
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", RecordingPool)
+    book = open_book(em, workbook_path)
+    book.sheets["站内数据源"].range("G5").value = [["2024-02-01", "计划", 3]]
+    book.sheets["站内数据源"].range("A5").formula = [['=H5&"x"']]
+    book.sheets["店铺成交数据源"].range("G3").value = [["2024-02-01", "新店铺"]]
+    book.sheets["店铺成交数据源"].range("A3").formula = [["=H3"]]
+    book.save()
+    book.close()
+
+    # 两个工作表各在一个工作进程中生成，只改动一个工作表时不启动工作进程
+    assert pools == [min(2, os.cpu_count() or 1)]
+    assert read_sheet_rows(workbook_path)[3][0] == '=H5&"x"'
+    assert read_sheet_rows(workbook_path, "店铺成交数据源")[1][0] == "=H3"
+    book = open_book(em, workbook_path)
+    book.sheets["站内数据源"].range("G6").value = [["2024-02-02", "计划2", 4]]
+    book.save()
+    assert len(pools) == 1
+
+
+def test_failed_sheet_part_leaves_workbook_unchanged(em, workbook_path, monkeypatch):
+    import concurrent.futures
+    original = open(workbook_path, 'rb').read()
+
+    def fail(source_path, sheet, last_ref, output_path):
+        if sheet.name == "店铺成交数据源":
+            raise OSError("磁盘已满")
+        return build_sheet_part(source_path, sheet, last_ref, output_path)
+    build_sheet_part = em.build_sheet_part
+    # 工作线程与测试在同一进程中，替换后的函数对其可见
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", concurrent.futures.ThreadPoolExecutor)
+    monkeypatch.setattr(em, "build_sheet_part", fail)
+    book = open_book(em, workbook_path)
+    book.sheets["站内数据源"].range("G5").value = [["2024-02-01", "计划", 3]]
+    book.sheets["店铺成交数据源"].range("G3").value = [["2024-02-01", "新店铺"]]
+
+    with pytest.raises(OSError, match="磁盘已满"):
+        book.save()
+
+    assert open(workbook_path, 'rb').read() == original
+    assert sorted(os.listdir(os.path.dirname(workbook_path))) == ["主表.xlsx"]
+
+
+def test_zip_backend_merges_two_sheets(prepare_merge, workbook_path):
+    merger = prepare_merge(workbook_path, [("a.xlsx", "hash_a", pd.DataFrame({"日期": ["2024-02-01"], "计划": ["新"], "花费": [1]}))])
+    prepare_merge(workbook_path, [("店铺_20240201_.xlsx", "hash_s", pd.DataFrame({"店铺": ["新店铺"]}))],
+                  sheet_name="店铺成交数据源")
+    merger.workbook_backend.set("zip")
+
+    merger.merge_files()
+
+    assert merger.dialogs.error_count == 0
+    assert [row[0] for row in read_sheet_rows(workbook_path)][-1] == '=H5&"x"'
+    assert read_sheet_rows(workbook_path, "店铺成交数据源")[-1][6:] == [20240201, "新店铺"]